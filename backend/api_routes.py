@@ -3,16 +3,18 @@ RESTful API Routes for Timecard Management System
 Optimized for React frontend integration
 """
 
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, current_app, request, jsonify, session
 from datetime import datetime, timedelta
 import pytz
 from functools import wraps
 from sqlalchemy import and_, func, desc
 from sqlalchemy.exc import SQLAlchemyError
 
-from models import TimeRecord, Employee, User, DailyReport, WorkStatus, Notification, Tag, TagWorkTime
+from models import TimeRecord, Employee, User, DailyReport, DailyAttendance, WorkStatus, Notification, Tag, TagWorkTime
 from database import get_db_session
 from security import validate_input_data, ErrorHandler
+from utils_optimized import cache_response
+from server_timing import phase_timer
 
 # Create API blueprint
 api_bp = Blueprint('api', __name__, url_prefix='/api')
@@ -38,6 +40,27 @@ def error_response(error_msg, error_type='general_error', status_code=400):
         'type': error_type
     }), status_code
 
+def attendance_to_dict(record):
+    """Serialize a DailyAttendance rollup row"""
+    return {
+        'id': record.id,
+        'date': record.work_date.isoformat(),
+        'clockIn': record.first_check_in.isoformat() if record.first_check_in else None,
+        'clockOut': record.last_check_out.isoformat() if record.last_check_out else None,
+        'breakTime': record.break_seconds / 60,
+        'totalHours': record.worked_seconds / 3600
+    }
+
+def attendance_status(record):
+    """'complete' once the latest check-in has been closed by a check-out"""
+    if record.last_check_out and (not record.last_check_in or record.last_check_out >= record.last_check_in):
+        return 'complete'
+    return 'incomplete'
+
+def work_status_label(work_status):
+    """Map WorkStatus to the frontend status label"""
+    return 'working' if work_status and work_status.is_working else 'off'
+
 # Error handler decorator
 def handle_api_errors(f):
     @wraps(f)
@@ -56,26 +79,28 @@ def handle_api_errors(f):
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            return jsonify({'error': 'Authentication required', 'authenticated': False}), 401
-        
-        # Check session validity
-        if session.permanent and session.get('last_activity'):
-            last_activity = datetime.fromisoformat(session['last_activity'])
-            if datetime.now(JST) - last_activity > timedelta(hours=8):
-                session.clear()
-                return jsonify({'error': 'Session expired', 'authenticated': False}), 401
-        
-        # Update activity timestamp
-        session['last_activity'] = datetime.now(JST).isoformat()
+        with phase_timer('auth'):
+            if 'user_id' not in session:
+                return jsonify({'error': 'Authentication required', 'authenticated': False}), 401
+            
+            # Check session validity
+            if session.permanent and session.get('last_activity'):
+                last_activity = datetime.fromisoformat(session['last_activity'])
+                if datetime.now(JST) - last_activity > timedelta(hours=8):
+                    session.clear()
+                    return jsonify({'error': 'Session expired', 'authenticated': False}), 401
+            
+            # Update activity timestamp
+            session['last_activity'] = datetime.now(JST).isoformat()
         return f(*args, **kwargs)
     return decorated_function
 
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if not session.get('is_admin', False):
-            return jsonify({'error': 'Admin access required', 'admin_required': True}), 403
+        with phase_timer('auth'):
+            if not session.get('is_admin', False):
+                return jsonify({'error': 'Admin access required', 'admin_required': True}), 403
         return f(*args, **kwargs)
     return decorated_function
 
@@ -177,10 +202,10 @@ def get_today_attendance():
     employee_id = session['employee_id']
     
     with get_db_session() as db:
-        record = db.query(TimeRecord).filter(
+        record = db.query(DailyAttendance).filter(
             and_(
-                TimeRecord.employee_id == employee_id,
-                TimeRecord.date == today
+                DailyAttendance.employee_id == employee_id,
+                DailyAttendance.work_date == today
             )
         ).first()
         
@@ -189,21 +214,11 @@ def get_today_attendance():
             WorkStatus.employee_id == employee_id
         ).first()
         
-        current_status = 'off'
-        if work_status:
-            current_status = work_status.status
+        current_status = work_status_label(work_status)
         
         if record:
             return jsonify({
-                'record': {
-                    'id': record.id,
-                    'date': record.date.isoformat(),
-                    'clockIn': record.clock_in.isoformat() if record.clock_in else None,
-                    'clockOut': record.clock_out.isoformat() if record.clock_out else None,
-                    'breakTime': record.break_time or 0,
-                    'totalHours': float(record.total_hours or 0),
-                    'status': current_status
-                },
+                'record': dict(attendance_to_dict(record), status=current_status),
                 'status': current_status
             })
         
@@ -229,7 +244,7 @@ def clock_in():
         existing = db.query(TimeRecord).filter(
             and_(
                 TimeRecord.employee_id == employee_id,
-                TimeRecord.date == today
+                TimeRecord.work_date == today
             )
         ).first()
         
@@ -245,7 +260,7 @@ def clock_in():
             # Create new record
             record = TimeRecord(
                 employee_id=employee_id,
-                date=today,
+                work_date=today,
                 clock_in=now,
                 photo_filename=photo if photo else None
             )
@@ -274,7 +289,7 @@ def clock_in():
             'message': 'Clocked in successfully',
             'record': {
                 'id': record.id,
-                'date': record.date.isoformat(),
+                'date': record.work_date.isoformat(),
                 'clockIn': record.clock_in.isoformat(),
                 'clockOut': record.clock_out.isoformat() if record.clock_out else None,
                 'breakTime': record.break_time or 0,
@@ -298,7 +313,7 @@ def clock_out():
         record = db.query(TimeRecord).filter(
             and_(
                 TimeRecord.employee_id == employee_id,
-                TimeRecord.date == today
+                TimeRecord.work_date == today
             )
         ).first()
         
@@ -340,7 +355,7 @@ def clock_out():
             'message': 'Clocked out successfully',
             'record': {
                 'id': record.id,
-                'date': record.date.isoformat(),
+                'date': record.work_date.isoformat(),
                 'clockIn': record.clock_in.isoformat(),
                 'clockOut': record.clock_out.isoformat(),
                 'breakTime': record.break_time or 0,
@@ -402,7 +417,7 @@ def end_break():
             record = db.query(TimeRecord).filter(
                 and_(
                     TimeRecord.employee_id == employee_id,
-                    TimeRecord.date == today
+                    TimeRecord.work_date == today
                 )
             ).first()
             
@@ -430,20 +445,15 @@ def get_recent_records():
     limit = request.args.get('limit', 10, type=int)
     
     with get_db_session() as db:
-        records = db.query(TimeRecord).filter(
-            TimeRecord.employee_id == employee_id
-        ).order_by(desc(TimeRecord.date)).limit(limit).all()
+        records = db.query(DailyAttendance).filter(
+            DailyAttendance.employee_id == employee_id
+        ).order_by(desc(DailyAttendance.work_date)).limit(limit).all()
         
         return jsonify({
-            'records': [{
-                'id': record.id,
-                'date': record.date.isoformat(),
-                'clockIn': record.clock_in.isoformat() if record.clock_in else None,
-                'clockOut': record.clock_out.isoformat() if record.clock_out else None,
-                'breakTime': record.break_time or 0,
-                'totalHours': float(record.total_hours or 0),
-                'status': 'complete' if record.clock_out else 'incomplete'
-            } for record in records]
+            'records': [
+                dict(attendance_to_dict(record), status=attendance_status(record))
+                for record in records
+            ]
         })
 
 @api_bp.route('/attendance/monthly', methods=['GET'])
@@ -470,24 +480,19 @@ def get_monthly_records():
         return jsonify({'error': 'Invalid month format. Use YYYY-MM'}), 400
     
     with get_db_session() as db:
-        records = db.query(TimeRecord).filter(
+        records = db.query(DailyAttendance).filter(
             and_(
-                TimeRecord.employee_id == employee_id,
-                TimeRecord.date >= start_date,
-                TimeRecord.date < end_date
+                DailyAttendance.employee_id == employee_id,
+                DailyAttendance.work_date >= start_date,
+                DailyAttendance.work_date < end_date
             )
-        ).order_by(TimeRecord.date).all()
+        ).order_by(DailyAttendance.work_date).all()
         
         return jsonify({
-            'records': [{
-                'id': record.id,
-                'date': record.date.isoformat(),
-                'clockIn': record.clock_in.isoformat() if record.clock_in else None,
-                'clockOut': record.clock_out.isoformat() if record.clock_out else None,
-                'breakTime': record.break_time or 0,
-                'totalHours': float(record.total_hours or 0),
-                'status': 'complete' if record.clock_out else 'incomplete'
-            } for record in records]
+            'records': [
+                dict(attendance_to_dict(record), status=attendance_status(record))
+                for record in records
+            ]
         })
 
 # ==========================================
@@ -545,6 +550,7 @@ def get_employees():
 @api_bp.route('/admin/attendance/summary', methods=['GET'])
 @login_required
 @admin_required
+@cache_response(timeout=30, tags=('attendance', 'employees'))
 @handle_api_errors
 def get_attendance_summary():
     """Get attendance summary for all employees"""
@@ -559,31 +565,29 @@ def get_attendance_summary():
         target_date = datetime.now(JST).date()
     
     with get_db_session() as db:
-        # Get all employees
-        employees = db.query(Employee).filter(Employee.status == 'active').all()
-        
-        # Get attendance records for the date
-        records = db.query(TimeRecord).filter(TimeRecord.date == target_date).all()
-        record_dict = {record.employee_id: record for record in records}
-        
-        # Get work statuses
-        statuses = db.query(WorkStatus).all()
-        status_dict = {status.employee_id: status for status in statuses}
+        # One row per employee with that day's rollup and current work status
+        results = db.query(Employee, DailyAttendance, WorkStatus).outerjoin(
+            DailyAttendance,
+            and_(
+                DailyAttendance.employee_id == Employee.employee_id,
+                DailyAttendance.work_date == target_date
+            )
+        ).outerjoin(
+            WorkStatus, WorkStatus.employee_id == Employee.employee_id
+        ).order_by(Employee.employee_id).all()
         
         summary = []
-        for employee in employees:
-            record = record_dict.get(employee.employee_id)
-            status = status_dict.get(employee.employee_id)
-            
+        for employee, record, status in results:
             summary.append({
                 'employeeId': employee.employee_id,
                 'name': employee.name,
                 'department': employee.department,
-                'clockIn': record.clock_in.isoformat() if record and record.clock_in else None,
-                'clockOut': record.clock_out.isoformat() if record and record.clock_out else None,
-                'totalHours': float(record.total_hours or 0) if record else 0,
-                'currentStatus': status.status if status else 'off',
-                'isPresent': record is not None and record.clock_in is not None
+                'clockIn': record.first_check_in.isoformat() if record and record.first_check_in else None,
+                'clockOut': record.last_check_out.isoformat() if record and record.last_check_out else None,
+                'totalHours': record.worked_seconds / 3600 if record else 0,
+                'breakMinutes': record.break_seconds / 60 if record else 0,
+                'currentStatus': work_status_label(status),
+                'isPresent': record is not None and record.first_check_in is not None
             })
         
         return jsonify({
@@ -597,27 +601,27 @@ def get_attendance_summary():
 
 @api_bp.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint"""
-    try:
-        with get_db_session() as db:
-            # Test database connection
-            db.execute('SELECT 1')
-            db_status = 'healthy'
-    except Exception as e:
-        db_status = f'unhealthy: {str(e)}'
-    
+    """Liveness check: the process is up and serving requests (no I/O)"""
     return jsonify({
-        'status': 'healthy' if db_status == 'healthy' else 'unhealthy',
+        'status': 'healthy',
         'timestamp': datetime.now(JST).isoformat(),
-        'version': '2.0.0',
-        'database': db_status,
-        'services': {
-            'authentication': 'healthy',
-            'attendance': 'healthy',
-            'admin': 'healthy'
-        }
+        'version': '2.0.0'
     })
 
+@api_bp.route('/health/ready', methods=['GET'])
+def readiness_check():
+    """Readiness check: database, disk, Notion sync and queues (cached for a few seconds).
+    Per-check details are only included for administrators."""
+    report = current_app.extensions['health_check'].report()
+    status_code = 503 if report['status'] == 'fail' else 200
+    if session.get('is_admin', False):
+        return jsonify(dict(report, version='2.0.0')), status_code
+    return jsonify({
+        'status': report['status'],
+        'checked_at': report['checked_at'],
+        'checks': {name: result['status'] for name, result in report['checks'].items()}
+    }), status_code
+
 @api_bp.route('/status', methods=['GET'])
 @login_required
 @handle_api_errors
@@ -629,10 +633,10 @@ def get_system_status():
         
         # Count today's attendance records
         today = datetime.now(JST).date()
-        today_records = db.query(TimeRecord).filter(TimeRecord.date == today).count()
+        today_records = db.query(DailyAttendance).filter(DailyAttendance.work_date == today).count()
         
         # Count currently working employees
-        working_now = db.query(WorkStatus).filter(WorkStatus.status == 'working').count()
+        working_now = db.query(WorkStatus).filter(WorkStatus.is_working == True).count()
         
         return jsonify({
             'activeUsers': active_users,
@@ -1,18 +1,40 @@
-from flask import Flask, request, jsonify, send_file, send_from_directory, session, redirect, url_for
+from flask import Flask, Response, request, jsonify, send_file, send_from_directory, session, redirect, url_for, stream_with_context
 from flask_cors import CORS
 from datetime import datetime, timedelta, date
 import pytz
 import os
-import csv
-import io
 import requests
-from werkzeug.utils import secure_filename
 from werkzeug.security import check_password_hash, generate_password_hash
 from functools import wraps
 from sqlalchemy import and_, func
-from models import TimeRecord, Employee, User, DailyReport, WorkStatus, Notification, Tag, TagWorkTime
-from database import init_db, get_db_session
+from models import TimeRecord, Employee, User, DailyReport, DailyAttendance, ExportJob, WorkStatus, Notification, Tag, TagWorkTime, PhotoBlob
+from database import init_db, get_db_session, engine
 from utils import allowed_file, generate_csv
+from attendance import apply_punch
+from exports import (
+    iter_time_records_csv, create_export_job, export_job_to_dict, fail_interrupted_jobs, cleanup_export_jobs
+)
+from serializers import (
+    time_record_rows, serialize_time_record, daily_report_rows, serialize_daily_report,
+    employee_rows, serialize_employee, user_rows, serialize_user
+)
+from utils_optimized import (
+    keyset_paginate, get_page_params, set_pagination_headers,
+    cache_response, invalidate_cache, response_cache, init_performance_monitor
+)
+from metrics import request_metrics, PROMETHEUS_CONTENT_TYPE
+from query_stats import init_query_stats, slow_query_log
+from server_timing import init_server_timing, phase_timer
+from profiling import init_profiling, list_profiles, profile_path
+from log_pipeline import log_stats
+from health import init_health_check, notion_sync_status
+from photos import (
+    PhotoStore, photo_writer, photo_index, photo_etag, not_modified, send_photo,
+    find_packed_photo, send_packed_photo, attach_photo, recover_pending_photos,
+    guess_content_type, is_photo_digest,
+    PHOTO_PENDING, PHOTO_RECOVERING, PHOTO_READY, PHOTO_FAILED, PHOTO_DERIVATIVES, DERIVATIVE_CONTENT_TYPE,
+    PHOTO_SEND_MODE, PHOTO_ACCEL_PREFIX
+)
 from security import security_manager, secure_endpoint, validate_input_data, ErrorHandler, set_security_headers
 from api_routes import api_bp
 
@@ -20,11 +42,22 @@ from api_routes import api_bp
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-change-this-in-production')
 app.config['UPLOAD_FOLDER'] = 'uploads/photos'
+app.config['PHOTO_SEND_MODE'] = PHOTO_SEND_MODE  # direct / x-accel / x-sendfile
+app.config['PHOTO_ACCEL_PREFIX'] = PHOTO_ACCEL_PREFIX
+app.config['EXPORT_FOLDER'] = os.path.join('data', 'exports')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=8)  # セッション有効期限
 app.config['JSON_AS_ASCII'] = False  # JSON日本語対応
 app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False  # JSON最適化
 
+# 全エンドポイントのメトリクスとSQL発行数の記録（/api/metrics で取得）
+init_performance_monitor(app)
+init_query_stats(app, engine, request_metrics)
+# Server-Timing（SERVER_TIMING 設定で有効化。db はSQL集計を使うため init_query_stats の後に登録）
+init_server_timing(app)
+# 管理者の X-Profile: 1 ヘッダーまたはサンプリングで cProfile を取得（logs/profiles/）
+init_profiling(app)
+
 # CORSの設定（セキュリティ強化）
 CORS(app, 
      supports_credentials=True,
@@ -53,23 +86,40 @@ os.makedirs('logs', exist_ok=True)
 NOTION_API_KEY = os.environ.get('NOTION_API_KEY')
 NOTION_DATABASE_ID = os.environ.get('NOTION_DATABASE_ID')
 
+# /api/health/ready の詳細チェック（結果は数秒キャッシュ）
+init_health_check(app, engine, notion_configured=bool(NOTION_API_KEY and NOTION_DATABASE_ID))
+
+# 前回のプロセスで保存されずに残った写真（pending のままの打刻）の回復
+try:
+    recover_pending_photos(app.config['UPLOAD_FOLDER'])
+except Exception:
+    app.logger.exception('Failed to recover pending photos')
+
+# 前回のプロセスで中断されたエクスポートジョブの終了と、保存期間を過ぎたファイルの削除
+try:
+    fail_interrupted_jobs()
+    cleanup_export_jobs(os.path.abspath(app.config['EXPORT_FOLDER']))
+except Exception:
+    app.logger.exception('Failed to clean up export jobs')
+
 
 # ログイン必須デコレータ（セキュリティ強化）
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            return jsonify({'error': 'ログインが必要です', 'authenticated': False}), 401
-        
-        # セッションの有効性をチェック
-        if session.permanent and session.get('last_activity'):
-            last_activity = datetime.fromisoformat(session['last_activity'])
-            if datetime.now(JST) - last_activity > app.config['PERMANENT_SESSION_LIFETIME']:
-                session.clear()
-                return jsonify({'error': 'セッションが期限切れです', 'authenticated': False}), 401
-        
-        # アクティビティ時刻を更新
-        session['last_activity'] = datetime.now(JST).isoformat()
+        with phase_timer('auth'):
+            if 'user_id' not in session:
+                return jsonify({'error': 'ログインが必要です', 'authenticated': False}), 401
+            
+            # セッションの有効性をチェック
+            if session.permanent and session.get('last_activity'):
+                last_activity = datetime.fromisoformat(session['last_activity'])
+                if datetime.now(JST) - last_activity > app.config['PERMANENT_SESSION_LIFETIME']:
+                    session.clear()
+                    return jsonify({'error': 'セッションが期限切れです', 'authenticated': False}), 401
+            
+            # アクティビティ時刻を更新
+            session['last_activity'] = datetime.now(JST).isoformat()
         return f(*args, **kwargs)
     return decorated_function
 
@@ -78,21 +128,22 @@ def login_required(f):
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            return jsonify({'error': 'ログインが必要です', 'authenticated': False}), 401
-        
-        # セッションの有効性をチェック
-        if session.permanent and session.get('last_activity'):
-            last_activity = datetime.fromisoformat(session['last_activity'])
-            if datetime.now(JST) - last_activity > app.config['PERMANENT_SESSION_LIFETIME']:
-                session.clear()
-                return jsonify({'error': 'セッションが期限切れです', 'authenticated': False}), 401
-        
-        if not session.get('is_admin', False):
-            return jsonify({'error': '管理者権限が必要です', 'admin_required': True}), 403
-        
-        # アクティビティ時刻を更新
-        session['last_activity'] = datetime.now(JST).isoformat()
+        with phase_timer('auth'):
+            if 'user_id' not in session:
+                return jsonify({'error': 'ログインが必要です', 'authenticated': False}), 401
+            
+            # セッションの有効性をチェック
+            if session.permanent and session.get('last_activity'):
+                last_activity = datetime.fromisoformat(session['last_activity'])
+                if datetime.now(JST) - last_activity > app.config['PERMANENT_SESSION_LIFETIME']:
+                    session.clear()
+                    return jsonify({'error': 'セッションが期限切れです', 'authenticated': False}), 401
+            
+            if not session.get('is_admin', False):
+                return jsonify({'error': '管理者権限が必要です', 'admin_required': True}), 403
+            
+            # アクティビティ時刻を更新
+            session['last_activity'] = datetime.now(JST).isoformat()
         return f(*args, **kwargs)
     return decorated_function
 
@@ -100,14 +151,14 @@ def admin_required(f):
 def fetch_notion_tags():
     """Notionから物件名をタグとして取得（空のレコードをスキップ）"""
     if not NOTION_API_KEY:
-        print("ERROR: NOTION_API_KEY is not set")
+        app.logger.error("NOTION_API_KEY is not set")
         return []
     if not NOTION_DATABASE_ID:
-        print("ERROR: NOTION_DATABASE_ID is not set")
+        app.logger.error("NOTION_DATABASE_ID is not set")
         return []
 
-    print(f"DEBUG: Using Notion API Key: {NOTION_API_KEY[:10]}...")
-    print(f"DEBUG: Using Database ID: {NOTION_DATABASE_ID}")
+    app.logger.debug("Using Notion API Key: %s...", NOTION_API_KEY[:10])
+    app.logger.debug("Using Database ID: %s", NOTION_DATABASE_ID)
 
     url = f"https://api.notion.com/v1/databases/{NOTION_DATABASE_ID}/query"
     headers = {
@@ -130,18 +181,18 @@ def fetch_notion_tags():
             if start_cursor:
                 body["start_cursor"] = start_cursor
             
-            print(f"DEBUG: Fetching page... (cursor: {start_cursor})")
+            app.logger.debug("Fetching page... (cursor: %s)", start_cursor)
             resp = requests.post(url, headers=headers, json=body)
             
             if resp.status_code != 200:
-                print(f"ERROR: Notion API error: {resp.text}")
+                app.logger.error("Notion API error: %s", resp.text)
                 break
                 
             data = resp.json()
             results = data.get('results', [])
             total_records += len(results)
             
-            print(f"DEBUG: Got {len(results)} records in this page")
+            app.logger.debug("Got %d records in this page", len(results))
             
             # 各レコードを処理
             for r in results:
@@ -171,7 +222,7 @@ def fetch_notion_tags():
                         all_tags.append({'name': name, 'notion_id': notion_id})
                         # 最初の10個のタグのみログ出力
                         if len(all_tags) <= 10:
-                            print(f"DEBUG: Added tag #{len(all_tags)}: '{name}'")
+                            app.logger.debug("Added tag #%d: '%s'", len(all_tags), name)
             
             # 次のページがあるかチェック
             has_more = data.get('has_more', False)
@@ -179,30 +230,30 @@ def fetch_notion_tags():
             
             # 安全のため、最大1000件まで
             if total_records >= 1000:
-                print("WARNING: Reached 1000 records limit")
+                app.logger.warning("Reached 1000 records limit")
                 break
         
-        print(f"\n=== SUMMARY ===")
-        print(f"Total records scanned: {total_records}")
-        print(f"Empty records skipped: {empty_records}")
-        print(f"Unique tags found: {len(all_tags)}")
+        app.logger.info(
+            "Notion tag fetch: %d records scanned, %d empty records skipped, %d unique tags found",
+            total_records, empty_records, len(all_tags)
+        )
         
         if all_tags:
             # タグをアルファベット順にソート
             all_tags.sort(key=lambda x: x['name'])
             
             # 最初と最後のタグを表示
-            print(f"\nFirst 5 tags: {[tag['name'] for tag in all_tags[:5]]}")
+            app.logger.debug("First 5 tags: %s", [tag['name'] for tag in all_tags[:5]])
             if len(all_tags) > 5:
-                print(f"Last 5 tags: {[tag['name'] for tag in all_tags[-5:]]}")
+                app.logger.debug("Last 5 tags: %s", [tag['name'] for tag in all_tags[-5:]])
         else:
-            print("\nWARNING: No tags found! Possible causes:")
-            print("1. All records have empty '物件名' field")
-            print("2. Database has no records")
-            print("3. Permission issues")
+            app.logger.warning(
+                "No tags found! Possible causes: "
+                "1. All records have empty '物件名' field, 2. Database has no records, 3. Permission issues"
+            )
             
             # デバッグ用：最初の数レコードの物件名フィールドを詳しく表示
-            print("\nDEBUG: Checking first 5 records in detail...")
+            app.logger.debug("Checking first 5 records in detail...")
             body = {"page_size": 5}
             resp = requests.post(url, headers=headers, json=body)
             if resp.status_code == 200:
@@ -211,24 +262,19 @@ def fetch_notion_tags():
                     properties = r.get('properties', {})
                     if '物件名' in properties:
                         prop = properties['物件名']
-                        print(f"\nRecord {i+1}:")
-                        print(f"  Type: {prop.get('type')}")
-                        print(f"  Title array: {prop.get('title')}")
-                        if prop.get('title'):
-                            for j, title_item in enumerate(prop.get('title', [])):
-                                print(f"    Item {j+1}: {title_item}")
+                        app.logger.debug(
+                            "Record %d: type=%s, title array=%s", i + 1, prop.get('type'), prop.get('title')
+                        )
         
         return all_tags
         
     except Exception as e:
-        print(f"ERROR: Notion fetch error: {type(e).__name__}: {e}")
-        import traceback
-        traceback.print_exc()
+        app.logger.exception("Notion fetch error: %s: %s", type(e).__name__, e)
         return []
 
 def sync_tags():
     """Notionからタグを同期（詳細なレスポンス付き）"""
-    print("INFO: Starting tag sync...")
+    app.logger.info("Starting tag sync...")
     tags = fetch_notion_tags()
     
     if not tags:
@@ -255,6 +301,7 @@ def sync_tags():
                 synced_count += 1
                 
         db_session.commit()
+        invalidate_cache('tags', 'tag_work')
         
         return jsonify({
             'message': f'タグを同期しました（新規: {synced_count}件、更新: {updated_count}件）',
@@ -265,7 +312,7 @@ def sync_tags():
         
     except Exception as e:
         db_session.rollback()
-        print(f"ERROR: Database error during sync: {e}")
+        app.logger.error("Database error during sync: %s", e)
         return jsonify({'error': f'データベースエラー: {str(e)}'}), 500
     finally:
         db_session.close()
@@ -385,6 +432,7 @@ def delete_user(username):
 
         db_session.delete(user)
         db_session.commit()
+        invalidate_cache('employees')
         return jsonify({'message': 'ユーザーを削除しました'}), 200
     finally:
         db_session.close()
@@ -415,6 +463,7 @@ def update_my_account():
             user.password_hash = generate_password_hash(password)
 
         db_session.commit()
+        invalidate_cache('employees')
         session['username'] = user.username
         return jsonify({'message': 'アカウント情報を更新しました'}), 200
     finally:
@@ -436,6 +485,7 @@ def update_my_employee():
             employee.email = data['email']
 
         db_session.commit()
+        invalidate_cache('employees')
         return jsonify({'message': 'プロフィールを更新しました'}), 200
     finally:
         db_session.close()
@@ -488,26 +538,19 @@ def get_work_status(employee_id):
 
 @app.route('/api/employees', methods=['GET'])
 @login_required
+@cache_response(timeout=60, tags=('employees',))
 def get_employees():
     """従業員リストを取得（ユーザー情報を含む）"""
     db_session = get_db_session()
     try:
-        employees = db_session.query(Employee).all()
-        return jsonify([
-            {
-                'id': emp.id,
-                'employee_id': emp.employee_id,
-                'name': emp.name,
-                'email': emp.email,
-                'department': emp.department,
-                'position': emp.position,
-                'created_at': emp.created_at.isoformat() if emp.created_at else None,
-                'username': emp.user.username if emp.user else None,
-                'is_admin': emp.user.is_admin if emp.user else False,
-                'last_login': emp.user.last_login.isoformat() if emp.user and emp.user.last_login else None,
-            }
-            for emp in employees
-        ])
+        cursor, limit = get_page_params(default_limit=500, max_limit=1000)
+        page = keyset_paginate(
+            employee_rows(db_session), [Employee.id], cursor, limit, descending=False
+        )
+        response = jsonify([serialize_employee(row) for row in page['items']])
+        return set_pagination_headers(response, page)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     finally:
         db_session.close()
 
@@ -555,6 +598,7 @@ def create_employee():
             db_session.add(user)
 
         db_session.commit()
+        invalidate_cache('employees')
         return jsonify({'message': '従業員を登録しました'}), 201
     except Exception as e:
         db_session.rollback()
@@ -600,6 +644,7 @@ def create_user():
         )
         db_session.add(user)
         db_session.commit()
+        invalidate_cache('employees')
 
         return jsonify({'message': 'ユーザーアカウントを作成しました'}), 201
     except Exception as e:
@@ -615,22 +660,13 @@ def list_users():
     """ユーザーアカウント一覧を取得"""
     db_session = get_db_session()
     try:
-        users = (
-            db_session.query(User, Employee)
-            .join(Employee, User.employee_id == Employee.employee_id)
-            .all()
+        cursor, limit = get_page_params(default_limit=500, max_limit=1000)
+        page = keyset_paginate(
+            user_rows(db_session), [User.id], cursor, limit, descending=False
         )
-
-        result = []
-        for user, employee in users:
-            result.append({
-                'username': user.username,
-                'employee_id': user.employee_id,
-                'employee_name': employee.name,
-                'is_admin': user.is_admin,
-                'last_login': user.last_login.isoformat() if user.last_login else None,
-            })
-        return jsonify(result)
+        return set_pagination_headers(jsonify([serialize_user(row) for row in page['items']]), page)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     finally:
         db_session.close()
 
@@ -653,16 +689,17 @@ def record_time():
         if record_type not in ['check_in', 'check_out']:
             return jsonify({'error': '無効な打刻タイプです'}), 400
         
-        # 従業員の存在確認
-        employee = session_db.query(Employee).filter_by(employee_id=employee_id).first()
-        if not employee:
-            return jsonify({'error': '従業員が見つかりません'}), 404
-        
-        # 勤務状態の確認
-        work_status = session_db.query(WorkStatus).filter_by(employee_id=employee_id).first()
-        if not work_status:
-            work_status = WorkStatus(employee_id=employee_id, is_working=False)
-            session_db.add(work_status)
+        with phase_timer('lookup'):
+            # 従業員の存在確認
+            employee = session_db.query(Employee).filter_by(employee_id=employee_id).first()
+            if not employee:
+                return jsonify({'error': '従業員が見つかりません'}), 404
+            
+            # 勤務状態の確認
+            work_status = session_db.query(WorkStatus).filter_by(employee_id=employee_id).first()
+            if not work_status:
+                work_status = WorkStatus(employee_id=employee_id, is_working=False)
+                session_db.add(work_status)
         
         # 二重打刻チェック
         if record_type == 'check_in' and work_status.is_working:
@@ -670,20 +707,10 @@ def record_time():
         elif record_type == 'check_out' and not work_status.is_working:
             return jsonify({'error': 'まだ出勤していません。先に出勤してください。'}), 400
         
-        # 写真の保存（オプション）
-        photo_path = None
+        # 写真の受け取り（オプション）。コミット後に保存待ちのファイルへ書き出し、ストアへの保存は PhotoWriter が行う
+        has_photo = bool(photo and photo.filename and allowed_file(photo.filename))
         photo_warning = None
-        
-        if photo and photo.filename and allowed_file(photo.filename):
-            try:
-                timestamp = datetime.now(JST).strftime('%Y%m%d_%H%M%S')
-                filename = f"{employee_id}_{timestamp}_{secure_filename(photo.filename)}"
-                photo_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                photo.save(photo_path)
-            except Exception as e:
-                photo_warning = '写真の保存に失敗しましたが、打刻は記録されます'
-                print(f"写真保存エラー: {e}")
-        elif not photo or not photo.filename:
+        if not photo or not photo.filename:
             photo_warning = '写真が撮影されていませんが、打刻は記録されます'
         
         # 打刻記録の作成（トランザクション最適化）
@@ -693,11 +720,18 @@ def record_time():
         record = TimeRecord(
             employee_id=employee_id,
             timestamp=now,
+            work_date=now.date(),
             record_type=record_type,
-            photo_path=photo_path
+            photo_status=PHOTO_PENDING if has_photo else None
         )
         session_db.add(record)
         
+        # 日次集計の更新（退勤は対応する出勤日に計上）
+        apply_punch(
+            session_db, employee_id, record_type, now,
+            open_check_in=work_status.last_check_in if record_type == 'check_out' else None
+        )
+        
         # 勤務状態の更新
         if record_type == 'check_in':
             work_status.is_working = True
@@ -707,21 +741,46 @@ def record_time():
             work_status.last_check_out = now
         
         # 一度にコミットしてパフォーマンス向上
-        session_db.commit()
+        with phase_timer('commit'):
+            session_db.commit()
+        invalidate_cache('attendance')
         
-        response_data = {
-            'message': f'{record_type}を記録しました',
-            'timestamp': record.timestamp.strftime('%Y-%m-%d %H:%M:%S')
-        }
+        photo_status = record.photo_status
+        if has_photo:
+            store = PhotoStore(app.config['UPLOAD_FOLDER'])
+            content_type = guess_content_type(photo.filename) or photo.mimetype
+            with phase_timer('photo'):
+                try:
+                    # アップロードの一時ファイルはリクエスト終了時に閉じられるため書き出しておく
+                    spool_path = store.spool(record.id, photo.stream, '.' + photo.filename.rsplit('.', 1)[1].lower())
+                except OSError as e:
+                    app.logger.warning("写真保存エラー: %s", e)
+                    attach_photo(record.id, None, PHOTO_FAILED)
+                    photo_status = PHOTO_FAILED
+                    photo_warning = '写真の保存に失敗しましたが、打刻は記録されます'
+                else:
+                    # キューが満杯の場合はこのスレッドで保存（トランザクションはコミット済み）
+                    if not photo_writer.submit(record.id, store, spool_path, content_type):
+                        saved = photo_writer.write(record.id, store, spool_path, content_type, derivatives=False)
+                        photo_status = PHOTO_READY if saved else PHOTO_FAILED
         
-        if photo_warning:
-            response_data['warning'] = photo_warning
-        
-        return jsonify(response_data), 201
+        with phase_timer('serialize'):
+            response_data = {
+                'message': f'{record_type}を記録しました',
+                'timestamp': record.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                'record_id': record.id,
+                'photo_status': photo_status
+            }
+            
+            if photo_warning:
+                response_data['warning'] = photo_warning
+            
+            response = jsonify(response_data)
+        return response, 201
         
     except Exception as e:
         session_db.rollback()
-        app.logger.error(f"Time record error: {str(e)}")
+        app.logger.exception("Time record error: %s", e)
         return jsonify({'error': '打刻処理中にエラーが発生しました'}), 500
     finally:
         session_db.close()
@@ -772,6 +831,7 @@ def create_daily_report():
             message = '日報を作成しました'
         
         db_session.commit()
+        invalidate_cache('reports')
         return jsonify({'message': message}), 201
         
     except Exception as e:
@@ -783,6 +843,7 @@ def create_daily_report():
 
 @app.route('/api/daily-reports', methods=['GET'])
 @login_required
+@cache_response(timeout=60, tags=('reports',))
 def get_daily_reports():
     """日報一覧を取得"""
     user_id = session['user_id']
@@ -790,7 +851,7 @@ def get_daily_reports():
     
     db_session = get_db_session()
     try:
-        query = db_session.query(DailyReport).join(Employee).join(User)
+        query = daily_report_rows(db_session)
         
         # 管理者でない場合は自分の日報のみ
         if not is_admin:
@@ -804,21 +865,14 @@ def get_daily_reports():
         if end_date:
             query = query.filter(DailyReport.report_date <= datetime.strptime(end_date, '%Y-%m-%d').date())
         
-        reports = query.order_by(DailyReport.report_date.desc()).all()
+        cursor, limit = get_page_params(default_limit=100)
+        page = keyset_paginate(query, [DailyReport.report_date, DailyReport.id], cursor, limit)
         
-        return jsonify([{
-            'id': report.id,
-            'report_date': report.report_date.strftime('%Y-%m-%d'),
-            'employee_name': report.employee.name,
-            'work_content': report.work_content,
-            'achievements': report.achievements,
-            'issues': report.issues,
-            'tomorrow_plan': report.tomorrow_plan,
-            'remarks': report.remarks,
-            'created_at': report.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-            'updated_at': report.updated_at.strftime('%Y-%m-%d %H:%M:%S')
-        } for report in reports])
+        response = jsonify([serialize_daily_report(row) for row in page['items']])
+        return set_pagination_headers(response, page)
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     finally:
         db_session.close()
 
@@ -882,32 +936,25 @@ def get_my_stats():
     db_session = get_db_session()
     try:
         # 今月の勤務日数
-        today = date.today()
+        today = datetime.now(JST).date()
         start_of_month = date(today.year, today.month, 1)
         
-        work_days = db_session.query(func.count(func.distinct(func.date(TimeRecord.timestamp)))).filter(
+        work_days = db_session.query(func.count(DailyAttendance.id)).filter(
             and_(
-                TimeRecord.employee_id == employee_id,
-                TimeRecord.record_type == 'check_in',
-                func.date(TimeRecord.timestamp) >= start_of_month
+                DailyAttendance.employee_id == employee_id,
+                DailyAttendance.work_date >= start_of_month,
+                DailyAttendance.first_check_in.isnot(None)
             )
         ).scalar()
         
         # 今日の勤務時間
-        today_records = db_session.query(TimeRecord).filter(
-            and_(
-                TimeRecord.employee_id == employee_id,
-                func.date(TimeRecord.timestamp) == today
-            )
-        ).order_by(TimeRecord.timestamp).all()
+        today_attendance = db_session.query(DailyAttendance).filter_by(
+            employee_id=employee_id, work_date=today
+        ).first()
         
         work_time = None
-        if len(today_records) >= 2:
-            check_in = next((r for r in today_records if r.record_type == 'check_in'), None)
-            check_out = next((r for r in today_records if r.record_type == 'check_out'), None)
-            if check_in and check_out:
-                delta = check_out.timestamp - check_in.timestamp
-                work_time = str(delta).split('.')[0]  # 秒以下を削除
+        if today_attendance and today_attendance.last_check_out:
+            work_time = str(timedelta(seconds=today_attendance.worked_seconds))
         
         # 未読通知数
         unread_notifications = db_session.query(func.count(Notification.id)).filter(
@@ -938,42 +985,36 @@ def get_time_records():
         start_date = request.args.get('start_date')
         end_date = request.args.get('end_date')
         
-        # 基本クエリ
-        query = db_session.query(TimeRecord).join(Employee)
+        # 基本クエリ（一覧に出す列だけを射影）
+        query = time_record_rows(db_session)
         
         # フィルタリング
         if employee_id:
             query = query.filter(TimeRecord.employee_id == employee_id)
         if start_date:
-            start = datetime.strptime(start_date, '%Y-%m-%d').replace(tzinfo=JST)
-            query = query.filter(TimeRecord.timestamp >= start)
+            start = datetime.strptime(start_date, '%Y-%m-%d').date()
+            query = query.filter(TimeRecord.work_date >= start)
         if end_date:
-            end = datetime.strptime(end_date, '%Y-%m-%d').replace(hour=23, minute=59, second=59, tzinfo=JST)
-            query = query.filter(TimeRecord.timestamp <= end)
+            end = datetime.strptime(end_date, '%Y-%m-%d').date()
+            query = query.filter(TimeRecord.work_date <= end)
         
-        # 結果の取得（ページネーション対応）
-        records = query.order_by(TimeRecord.timestamp.desc()).limit(limit).all()
+        # 結果の取得（キーセット方式のページネーション）
+        cursor, limit = get_page_params(default_limit=100, max_limit=1000)
+        page = keyset_paginate(query, [TimeRecord.timestamp, TimeRecord.id], cursor, limit)
         
-        # レスポンスの最適化
-        result = []
-        for record in records:
-            result.append({
-                'id': record.id,
-                'employee_id': record.employee_id,
-                'employee_name': record.employee.name,
-                'timestamp': record.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-                'type': record.record_type,
-                'has_photo': bool(record.photo_path)
-            })
+        result = [serialize_time_record(row) for row in page['items']]
         
         return jsonify({
             'records': result,
             'count': len(result),
-            'has_more': len(result) == limit
+            'has_more': page['has_more'],
+            'next_cursor': page['next_cursor']
         })
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        app.logger.error(f"Get time records error: {str(e)}")
+        app.logger.exception("Get time records error: %s", e)
         return jsonify({'error': '記録の取得中にエラーが発生しました'}), 500
     finally:
         db_session.close()
@@ -984,6 +1025,8 @@ def get_time_records():
 def sync_tags():
     """Notionからタグを同期"""
     tags = fetch_notion_tags()
+    if not tags:
+        notion_sync_status.record(error='Notionからタグを取得できませんでした')
     db_session = get_db_session()
     try:
         for tag in tags:
@@ -993,6 +1036,9 @@ def sync_tags():
             else:
                 db_session.add(Tag(name=tag['name'], notion_id=tag['notion_id']))
         db_session.commit()
+        invalidate_cache('tags', 'tag_work')
+        if tags:
+            notion_sync_status.record(tag_count=len(tags))
         return jsonify({'message': 'タグを同期しました'}), 200
     finally:
         db_session.close()
@@ -1000,6 +1046,7 @@ def sync_tags():
 
 @app.route('/api/tags', methods=['GET'])
 @login_required
+@cache_response(timeout=300, tags=('tags',))
 def list_tags():
     """タグ一覧取得（検索対応）"""
     query = request.args.get('query', '')
@@ -1041,6 +1088,7 @@ def add_tag_work():
             entry = TagWorkTime(user_id=session['user_id'], tag_id=tag_id, date=work_date, hours=hours)
             db_session.add(entry)
         db_session.commit()
+        invalidate_cache('tag_work')
         return jsonify({'message': '工数を登録しました'}), 201
     finally:
         db_session.close()
@@ -1048,6 +1096,7 @@ def add_tag_work():
 
 @app.route('/api/tag-work-summary', methods=['GET'])
 @admin_required
+@cache_response(timeout=60, tags=('tag_work',))
 def tag_work_summary():
     """タグ別工数集計"""
     start_date = request.args.get('start_date')
@@ -1077,71 +1126,223 @@ def tag_work_summary():
 @app.route('/api/export-csv', methods=['GET'])
 @admin_required
 def export_csv():
-    """勤務記録をCSV出力"""
-    db_session = get_db_session()
+    """勤務記録をCSV出力（ストリーミング）"""
+    # パラメータの取得
     try:
-        # パラメータの取得
         start_date = request.args.get('start_date')
         end_date = request.args.get('end_date')
+        start = datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else None
+        end = datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else None
+    except ValueError:
+        return jsonify({'error': '日付形式が正しくありません'}), 400
+    
+    # セッションはストリーム終了（またはクライアント切断）時に閉じる
+    db_session = get_db_session()
+    
+    def generate():
+        try:
+            yield from iter_time_records_csv(db_session, start, end)
+        finally:
+            db_session.close()
+    
+    filename = f"timecard_{datetime.now(JST).strftime('%Y%m%d_%H%M%S')}.csv"
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+
+@app.route('/api/export-jobs', methods=['POST'])
+@admin_required
+def create_export_job_endpoint():
+    """エクスポートジョブを登録（締め済み期間は完成済みファイルを再利用）"""
+    data = request.get_json(silent=True) or {}
+    try:
+        start = datetime.strptime(data['start_date'], '%Y-%m-%d').date() if data.get('start_date') else None
+        end = datetime.strptime(data['end_date'], '%Y-%m-%d').date() if data.get('end_date') else None
+    except (TypeError, ValueError):
+        return jsonify({'error': '日付形式が正しくありません'}), 400
+    
+    db_session = get_db_session()
+    try:
+        job, reused = create_export_job(
+            db_session,
+            data.get('format', 'csv'),
+            start,
+            end,
+            os.path.abspath(app.config['EXPORT_FOLDER']),
+            requested_by=session['user_id']
+        )
+        result = export_job_to_dict(job)
+        result['reused'] = reused
+        return jsonify(result), 200 if reused else 202
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    finally:
+        db_session.close()
+
+
+@app.route('/api/export-jobs/<job_id>', methods=['GET'])
+@admin_required
+def get_export_job(job_id):
+    """エクスポートジョブの進捗を取得"""
+    db_session = get_db_session()
+    try:
+        job = db_session.query(ExportJob).filter_by(id=job_id).first()
+        if not job:
+            return jsonify({'error': 'ジョブが見つかりません'}), 404
         
-        # 記録の取得
-        query = db_session.query(TimeRecord).join(Employee)
-        if start_date:
-            start = datetime.strptime(start_date, '%Y-%m-%d').replace(tzinfo=JST)
-            query = query.filter(TimeRecord.timestamp >= start)
-        if end_date:
-            end = datetime.strptime(end_date, '%Y-%m-%d').replace(hour=23, minute=59, second=59, tzinfo=JST)
-            query = query.filter(TimeRecord.timestamp <= end)
-        
-        records = query.order_by(TimeRecord.timestamp).all()
-        
-        # CSV生成
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
-        # ヘッダー
-        writer.writerow(['従業員ID', '従業員名', '日付', '時刻', '種別', '写真'])
-        
-        # データ行
-        for record in records:
-            writer.writerow([
-                record.employee_id,
-                record.employee.name,
-                record.timestamp.strftime('%Y-%m-%d'),
-                record.timestamp.strftime('%H:%M:%S'),
-                '出勤' if record.record_type == 'check_in' else '退勤',
-                '有' if record.photo_path else '無'
-            ])
-        
-        # ファイルとして返す
-        output.seek(0)
-        output_bytes = io.BytesIO(output.getvalue().encode('utf-8-sig'))  # BOM付きUTF-8
-        
-        filename = f"timecard_{datetime.now(JST).strftime('%Y%m%d_%H%M%S')}.csv"
+        result = export_job_to_dict(job)
+        if job.status == 'done':
+            result['download_url'] = url_for('download_export_job', job_id=job.id)
+        return jsonify(result)
+    finally:
+        db_session.close()
+
+
+@app.route('/api/export-jobs/<job_id>/download', methods=['GET'])
+@admin_required
+def download_export_job(job_id):
+    """完成したエクスポートファイルをダウンロード"""
+    db_session = get_db_session()
+    try:
+        job = db_session.query(ExportJob).filter_by(id=job_id).first()
+        if not job or job.status != 'done' or not job.file_path or not os.path.exists(job.file_path):
+            return jsonify({'error': 'ファイルが見つかりません'}), 404
         
         return send_file(
-            output_bytes,
+            job.file_path,
             mimetype='text/csv',
             as_attachment=True,
-            download_name=filename
+            download_name=os.path.basename(job.file_path)
         )
-        
     finally:
         db_session.close()
 
 
+@app.route('/api/cache/stats', methods=['GET'])
+@admin_required
+def cache_stats():
+    """レスポンスキャッシュの統計を取得"""
+    return jsonify(response_cache.stats())
+
+
+@app.route('/api/metrics', methods=['GET'])
+@admin_required
+def get_metrics():
+    """エンドポイントごとのリクエストメトリクスを Prometheus のテキスト形式で取得"""
+    return Response(request_metrics.render_prometheus(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+
+@app.route('/api/slow-queries', methods=['GET'])
+@admin_required
+def list_slow_queries():
+    """起動以降の遅いクエリを文の形ごとに合計時間の大きい順で取得"""
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+    return jsonify({
+        'threshold_ms': slow_query_log.threshold * 1000,
+        'sample_rate': slow_query_log.sample_rate,
+        'dropped_shapes': slow_query_log.dropped_shapes,
+        'queries': slow_query_log.top(limit),
+    })
+
+
+@app.route('/api/profiles', methods=['GET'])
+@admin_required
+def get_profiles():
+    """保存済みのリクエストプロファイル一覧（新しい順）"""
+    return jsonify(list_profiles(app.config['PROFILE_DIR']))
+
+
+@app.route('/api/profiles/<filename>', methods=['GET'])
+@admin_required
+def download_profile(filename):
+    """プロファイル（.prof: pstats / .collapsed: flamegraph 用）をダウンロード"""
+    path = profile_path(app.config['PROFILE_DIR'], filename)
+    if not path:
+        return jsonify({'error': 'プロファイルが見つかりません'}), 404
+    return send_file(os.path.abspath(path), as_attachment=True, download_name=filename)
+
+
+@app.route('/api/logging/stats', methods=['GET'])
+@admin_required
+def logging_stats():
+    """ログパイプラインの統計（キュー長・集約件数・破棄件数）を取得"""
+    return jsonify(log_stats())
+
+
 @app.route('/api/photo/<int:record_id>')
 @login_required
 def get_photo(record_id):
-    """打刻時の写真を取得"""
+    """打刻時の写真を取得（?size=thumb / display で縮小版）"""
+    size = request.args.get('size', 'original')
+    if size != 'original' and size not in PHOTO_DERIVATIVES:
+        return jsonify({'error': f"size は original / {' / '.join(PHOTO_DERIVATIVES)} のいずれかです"}), 400
+    
+    # 保存済みの写真は digest が変わらないため、再表示では DB を参照しない
+    cached = photo_index.get(record_id)
+    if cached:
+        photo_path, content_type = cached
+    else:
+        db_session = get_db_session()
+        try:
+            record = db_session.query(
+                TimeRecord.photo_path, TimeRecord.photo_status, PhotoBlob.content_type
+            ).outerjoin(PhotoBlob, PhotoBlob.digest == TimeRecord.photo_path).filter(TimeRecord.id == record_id).first()
+        finally:
+            db_session.close()
+        
+        if record and record.photo_status in (PHOTO_PENDING, PHOTO_RECOVERING):
+            # 保存待ち（PhotoWriter のキュー内・recover_pending_photos が保存中）
+            response = jsonify({'photo_status': PHOTO_PENDING})
+            response.headers['Retry-After'] = '1'
+            return response, 202
+        if not record or not record.photo_path:
+            return jsonify({'error': '写真が見つかりません'}), 404
+        photo_path, content_type = record.photo_path, record.content_type
+        if record.photo_status == PHOTO_READY and is_photo_digest(photo_path):
+            photo_index.put(record_id, photo_path, content_type)
+    
+    store = PhotoStore(app.config['UPLOAD_FOLDER'])
+    etag = None
+    if is_photo_digest(photo_path):
+        etag = photo_etag(photo_path, size)
+        if request.if_none_match.contains(etag):
+            # ブラウザのキャッシュが有効（ファイルには触れない）
+            return not_modified(etag)
+    
+    path = store.resolve(photo_path)
+    mimetype = content_type
+    if size != 'original' and etag:
+        # 縮小版が無ければここで作成（画像として読めない写真は元の写真を返す）
+        derivative = store.derivative(photo_path, size)
+        if derivative:
+            path, mimetype = derivative, DERIVATIVE_CONTENT_TYPE
+        else:
+            etag = photo_etag(photo_path)
+    try:
+        return send_photo(
+            path, store.root, mimetype=mimetype, etag=etag,
+            mode=app.config['PHOTO_SEND_MODE'], accel_prefix=app.config['PHOTO_ACCEL_PREFIX']
+        )
+    except FileNotFoundError:
+        if not etag:
+            return jsonify({'error': '写真が見つかりません'}), 404
+    
+    # 保存期間を過ぎた写真はパックから読み出す
     db_session = get_db_session()
     try:
-        record = db_session.query(TimeRecord).filter_by(id=record_id).first()
-        if record and record.photo_path and os.path.exists(record.photo_path):
-            return send_file(record.photo_path)
-        return jsonify({'error': '写真が見つかりません'}), 404
+        entry = find_packed_photo(db_session, photo_path, size)
     finally:
         db_session.close()
+    try:
+        if entry:
+            return send_packed_photo(store, entry, content_type)
+    except FileNotFoundError:
+        pass
+    return jsonify({'error': '写真が見つかりません'}), 404
 
 
 # レスポンスヘッダーの設定
@@ -0,0 +1,157 @@
+# 日次勤怠集計（daily_attendance）の更新と再構築
+#
+# 打刻（time_records）から従業員×日ごとの出退勤時刻・勤務時間・休憩時間を集計する。
+# 通常は record_time が打刻と同じトランザクションで apply_punch を呼び出して逐次更新し、
+# 集計ロジックの変更や不整合時は rebuild_daily_attendance で打刻から作り直す。
+#
+# 使い方:
+#   python attendance.py rebuild --start 2024-04-01 --end 2024-04-30 [--employee EMP001]
+
+from datetime import datetime, timedelta
+
+import pytz
+
+from models import DailyAttendance, TimeRecord
+
+JST = pytz.timezone('Asia/Tokyo')
+
+
+def _to_wall_time(value):
+    """JSTの壁時計時刻（tzinfoなし）に揃える（SQLiteはtzinfoを保持しないため）"""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(JST).replace(tzinfo=None)
+    return value
+
+
+def _accumulate(row, record_type, punch_time):
+    """1件の打刻を集計行に反映"""
+    punch_time = _to_wall_time(punch_time)
+    is_open = row.last_check_in is not None and (
+        row.last_check_out is None or row.last_check_in > row.last_check_out
+    )
+
+    row.punch_count = (row.punch_count or 0) + 1
+    if record_type == 'check_in':
+        if row.first_check_in is None:
+            row.first_check_in = punch_time
+        elif not is_open and row.last_check_out is not None:
+            # 退勤から再出勤までを休憩として計上
+            row.break_seconds = (row.break_seconds or 0) + int((punch_time - row.last_check_out).total_seconds())
+        row.last_check_in = punch_time
+    else:
+        if is_open:
+            row.worked_seconds = (row.worked_seconds or 0) + int((punch_time - row.last_check_in).total_seconds())
+        row.last_check_out = punch_time
+
+
+def _new_row(employee_id, work_date):
+    return DailyAttendance(
+        employee_id=employee_id,
+        work_date=work_date,
+        worked_seconds=0,
+        break_seconds=0,
+        punch_count=0
+    )
+
+
+def apply_punch(db_session, employee_id, record_type, punch_time, open_check_in=None):
+    """打刻を日次集計に反映（コミットは呼び出し側のトランザクションで行う）
+
+    退勤は対応する出勤（open_check_in）の日付の行に計上する。
+    """
+    punch_time = _to_wall_time(punch_time)
+    if record_type == 'check_out' and open_check_in is not None:
+        work_date = _to_wall_time(open_check_in).date()
+    else:
+        work_date = punch_time.date()
+
+    row = db_session.query(DailyAttendance).filter_by(
+        employee_id=employee_id, work_date=work_date
+    ).first()
+    if row is None:
+        row = _new_row(employee_id, work_date)
+        db_session.add(row)
+
+    _accumulate(row, record_type, punch_time)
+    return row
+
+
+def rebuild_daily_attendance(db_session, start_date=None, end_date=None, employee_id=None):
+    """指定期間の日次集計を打刻記録から作り直す（コミットは呼び出し側で行う）
+
+    日跨ぎ勤務を正しく対にするため、期間の前後1日分の打刻も読み込む。
+    """
+    delete_query = db_session.query(DailyAttendance)
+    record_query = db_session.query(
+        TimeRecord.employee_id, TimeRecord.record_type, TimeRecord.timestamp
+    )
+    if start_date:
+        delete_query = delete_query.filter(DailyAttendance.work_date >= start_date)
+        record_query = record_query.filter(TimeRecord.work_date >= start_date - timedelta(days=1))
+    if end_date:
+        delete_query = delete_query.filter(DailyAttendance.work_date <= end_date)
+        record_query = record_query.filter(TimeRecord.work_date <= end_date + timedelta(days=1))
+    if employee_id:
+        delete_query = delete_query.filter(DailyAttendance.employee_id == employee_id)
+        record_query = record_query.filter(TimeRecord.employee_id == employee_id)
+
+    delete_query.delete(synchronize_session=False)
+
+    rows = {}
+    open_check_ins = {}
+    records = record_query.order_by(TimeRecord.employee_id, TimeRecord.timestamp, TimeRecord.id)
+    for emp_id, record_type, timestamp in records.yield_per(1000):
+        timestamp = _to_wall_time(timestamp)
+        if record_type == 'check_out' and emp_id in open_check_ins:
+            work_date = open_check_ins.pop(emp_id).date()
+        else:
+            work_date = timestamp.date()
+            if record_type == 'check_in':
+                open_check_ins[emp_id] = timestamp
+            else:
+                open_check_ins.pop(emp_id, None)
+
+        if (start_date and work_date < start_date) or (end_date and work_date > end_date):
+            continue
+
+        key = (emp_id, work_date)
+        if key not in rows:
+            rows[key] = _new_row(emp_id, work_date)
+        _accumulate(rows[key], record_type, timestamp)
+
+    db_session.add_all(rows.values())
+    db_session.flush()
+    return len(rows)
+
+
+def main():
+    import argparse
+    from database import get_db_session
+
+    parser = argparse.ArgumentParser(description='日次勤怠集計の管理')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    rebuild_parser = subparsers.add_parser('rebuild', help='打刻記録から日次集計を再構築')
+    rebuild_parser.add_argument('--start', help='開始日 (YYYY-MM-DD)')
+    rebuild_parser.add_argument('--end', help='終了日 (YYYY-MM-DD)')
+    rebuild_parser.add_argument('--employee', help='従業員ID')
+    args = parser.parse_args()
+
+    parse_date = lambda value: datetime.strptime(value, '%Y-%m-%d').date() if value else None
+
+    db_session = get_db_session()
+    try:
+        count = rebuild_daily_attendance(
+            db_session, parse_date(args.start), parse_date(args.end), args.employee
+        )
+        db_session.commit()
+        print(f'日次集計を再構築しました: {count}件')
+    except Exception:
+        db_session.rollback()
+        raise
+    finally:
+        db_session.close()
+
+
+if __name__ == '__main__':
+    main()
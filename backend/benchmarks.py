@@ -0,0 +1,618 @@
+# パフォーマンス計測用ベンチマーク
+#
+# 使い方:
+#   python benchmarks.py sqlite-profile --seconds 5 --writers 4 --readers 8
+#   python benchmarks.py csv-export --rows 5000 20000
+#   python benchmarks.py rate-limit --ips 1000000
+#   python benchmarks.py content-scan --kib 100
+#   python benchmarks.py validate-input --iterations 50000
+#   python benchmarks.py request-metrics --iterations 100000
+#   python benchmarks.py photo-ingest --punches 200 --kib 2048 --concurrency 4 --interval-ms 50
+#   python benchmarks.py photo-derivatives --photos 10 --page-size 50
+#   python benchmarks.py photo-archive --photos 2000 --kib 256
+
+import argparse
+import csv
+import io
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from database import create_db_engine, ENGINE_PROFILES
+from exports import iter_time_records_csv
+from security import SlidingWindowCounter, SecurityManager, CompiledValidator
+import legacy_security
+from metrics import RequestMetrics
+from utils_optimized import init_performance_monitor
+from photos import PhotoStore, PhotoWriter, PhotoPacks, PHOTO_DERIVATIVES, render_derivative, archive_photos
+from models import Base, Employee, TimeRecord, PhotoBlob, PhotoPackEntry
+
+JST = pytz.timezone('Asia/Tokyo')
+
+
+def _seed_employees(session_factory, count):
+    """ベンチマーク用の従業員を作成"""
+    db_session = session_factory()
+    try:
+        db_session.add_all([
+            Employee(employee_id=f'BENCH{i:04d}', name=f'ベンチ{i}')
+            for i in range(count)
+        ])
+        db_session.commit()
+    finally:
+        db_session.close()
+
+
+def bench_sqlite_profile(profile, seconds=5.0, writers=4, readers=8, employees=50):
+    """打刻（書き込み）と履歴参照（読み込み）を並行実行してスループットを計測"""
+    work_dir = tempfile.mkdtemp(prefix='timecard_bench_')
+    db_engine = create_db_engine(f"sqlite:///{os.path.join(work_dir, 'bench.db')}", profile=profile)
+    Base.metadata.create_all(bind=db_engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=db_engine)
+    _seed_employees(session_factory, employees)
+
+    counters = {'writes': 0, 'reads': 0, 'locked': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def count(key):
+        with lock:
+            counters[key] += 1
+
+    def writer(worker_id):
+        n = 0
+        while time.perf_counter() < deadline:
+            db_session = session_factory()
+            try:
+                now = datetime.now(JST)
+                db_session.add(TimeRecord(
+                    employee_id=f'BENCH{(worker_id + n) % employees:04d}',
+                    timestamp=now,
+                    work_date=now.date(),
+                    record_type='check_in' if n % 2 == 0 else 'check_out'
+                ))
+                db_session.commit()
+                count('writes')
+            except OperationalError:
+                db_session.rollback()
+                count('locked')
+            finally:
+                db_session.close()
+            n += 1
+
+    def reader(worker_id):
+        n = 0
+        while time.perf_counter() < deadline:
+            db_session = session_factory()
+            try:
+                db_session.query(TimeRecord).filter(
+                    TimeRecord.employee_id == f'BENCH{(worker_id + n) % employees:04d}'
+                ).order_by(TimeRecord.timestamp.desc()).limit(50).all()
+                count('reads')
+            except OperationalError:
+                count('locked')
+            finally:
+                db_session.close()
+            n += 1
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+    threads += [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    db_engine.dispose()
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'profile': profile,
+        'elapsed': elapsed,
+        'writes_per_sec': counters['writes'] / elapsed,
+        'reads_per_sec': counters['reads'] / elapsed,
+        'locked_errors': counters['locked'],
+    }
+
+
+def _seed_time_records(db_engine, rows, employees=2000):
+    """打刻記録を一括投入（1人1日2打刻）"""
+    base = datetime(2024, 1, 1, 9, 0)
+    batch = []
+    with db_engine.begin() as conn:
+        for i in range(rows):
+            day, slot = divmod(i, employees * 2)
+            employee, is_out = divmod(slot, 2)
+            timestamp = base + timedelta(days=day, hours=9 * is_out)
+            batch.append({
+                'employee_id': f'BENCH{employee:04d}',
+                'timestamp': timestamp,
+                'work_date': timestamp.date(),
+                'record_type': 'check_out' if is_out else 'check_in',
+                'photo_path': None,
+            })
+            if len(batch) == 10000:
+                conn.execute(TimeRecord.__table__.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(TimeRecord.__table__.insert(), batch)
+
+
+def _legacy_export_csv(db_session):
+    """従来の export_csv 相当（全件取得→StringIO→BytesIO）"""
+    records = db_session.query(TimeRecord).join(Employee).order_by(TimeRecord.timestamp).all()
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['従業員ID', '従業員名', '日付', '時刻', '種別', '写真'])
+    for record in records:
+        writer.writerow([
+            record.employee_id,
+            record.employee.name,
+            record.timestamp.strftime('%Y-%m-%d'),
+            record.timestamp.strftime('%H:%M:%S'),
+            '出勤' if record.record_type == 'check_in' else '退勤',
+            '有' if record.photo_path else '無'
+        ])
+    output.seek(0)
+    yield io.BytesIO(output.getvalue().encode('utf-8-sig')).getvalue()
+
+
+def bench_csv_export(rows, employees=2000):
+    """CSVエクスポートのピークメモリと最初のバイトまでの時間を計測"""
+    work_dir = tempfile.mkdtemp(prefix='timecard_bench_')
+    db_engine = create_db_engine(f"sqlite:///{os.path.join(work_dir, 'bench.db')}")
+    Base.metadata.create_all(bind=db_engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=db_engine)
+    _seed_employees(session_factory, employees)
+    _seed_time_records(db_engine, rows, employees)
+
+    results = []
+    for name, export in [('legacy', _legacy_export_csv), ('streaming', iter_time_records_csv)]:
+        db_session = session_factory()
+        try:
+            tracemalloc.start()
+            started = time.perf_counter()
+            first_byte = None
+            total_bytes = 0
+            for chunk in export(db_session):
+                if first_byte is None:
+                    first_byte = time.perf_counter() - started
+                total_bytes += len(chunk)
+            elapsed = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        finally:
+            db_session.close()
+
+        results.append({
+            'export': name,
+            'rows': rows,
+            'first_byte_ms': first_byte * 1000,
+            'total_sec': elapsed,
+            'peak_mib': peak / 1024 / 1024,
+            'bytes': total_bytes,
+        })
+
+    db_engine.dispose()
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+class _LegacyRateLimiter:
+    """従来の check_rate_limit 相当（識別子ごとの datetime リストを毎回再構築）"""
+    
+    def __init__(self):
+        self.rate_limits = {}
+    
+    def hit(self, identifier, limit, window_seconds):
+        now = datetime.now(JST)
+        window_start = now - timedelta(seconds=window_seconds)
+        if identifier not in self.rate_limits:
+            self.rate_limits[identifier] = []
+        self.rate_limits[identifier] = [
+            timestamp for timestamp in self.rate_limits[identifier]
+            if timestamp > window_start
+        ]
+        if len(self.rate_limits[identifier]) >= limit:
+            return False
+        self.rate_limits[identifier].append(now)
+        return True
+    
+    def __len__(self):
+        return len(self.rate_limits)
+
+
+def bench_rate_limit(ips, max_keys=100000, hot_requests=10000):
+    """異なるIPからの大量アクセスと、単一IPへの集中アクセスでのコストと保持メモリを計測"""
+    results = []
+    for name, limiter in [('legacy', _LegacyRateLimiter()), ('sliding_window', SlidingWindowCounter(max_keys=max_keys))]:
+        tracemalloc.start()
+        started = time.perf_counter()
+        for i in range(ips):
+            limiter.hit(f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}', 60, 60)
+        distinct_sec = time.perf_counter() - started
+        retained, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        
+        # 1つのIPがウィンドウ内の上限まで溜めた状態での1回あたりのコスト
+        started = time.perf_counter()
+        for _ in range(hot_requests):
+            limiter.hit('192.168.0.1', hot_requests, 60)
+        hot_sec = time.perf_counter() - started
+        
+        results.append({
+            'limiter': name,
+            'ips': ips,
+            'distinct_us_per_call': distinct_sec / ips * 1e6,
+            'hot_us_per_call': hot_sec / hot_requests * 1e6,
+            'tracked_keys': len(limiter),
+            'retained_mib': retained / 1024 / 1024,
+        })
+    return results
+
+
+def bench_content_scan(size, legacy_max_size=10 * 1024):
+    """悪意のあるコンテンツ検出とサニタイズの1回あたりの時間
+
+    従来の実装は入力長の2乗になる入力があるため、legacy_max_size までに切り詰めて計測する。
+    """
+    manager = SecurityManager()
+    results = []
+    for name, text in legacy_security.content_scan_inputs(size).items():
+        legacy_text = text[:legacy_max_size]
+        timings = {}
+        for label, func, arg in [
+            ('scan_ms', manager.contains_malicious_content, text),
+            ('legacy_scan_ms', legacy_security.contains_malicious_content, legacy_text),
+            ('sanitize_ms', lambda v: manager.sanitize_string(v, max_length=len(v)), text),
+            ('legacy_sanitize_ms', lambda v: legacy_security.sanitize_string(v, max_length=len(v)), text),
+        ]:
+            started = time.perf_counter()
+            func(arg)
+            timings[label] = (time.perf_counter() - started) * 1000
+        results.append(dict({'input': name, 'chars': len(text), 'legacy_chars': len(legacy_text)}, **timings))
+    return results
+
+
+def bench_validate_input(iterations, repeat=5):
+    """入力検証＋サニタイズの1リクエストあたりの時間（repeat 回の最小値）"""
+    manager = SecurityManager()
+    results = []
+    for name, (rules, data) in legacy_security.VALIDATION_CASES.items():
+        validator = CompiledValidator(rules, manager)
+        timings = {}
+        for label, func in [
+            ('legacy_us', lambda: legacy_security.validate_and_sanitize(manager, data, rules)),
+            ('compiled_us', lambda: validator(data)),
+        ]:
+            best = float('inf')
+            for _ in range(repeat):
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    func()
+                best = min(best, time.perf_counter() - started)
+            timings[label] = best / iterations * 1e6
+        results.append(dict({'case': name, 'iterations': iterations}, **timings))
+    return results
+
+
+def _best_per_call_us(func, iterations, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        best = min(best, time.perf_counter() - started)
+    return best / iterations * 1e6
+
+
+def bench_request_metrics(iterations, endpoints=20, repeat=5):
+    """メトリクス記録の1リクエストあたりのコスト（記録のみ / Flaskのフック込み）"""
+    from flask import Flask
+
+    metrics = RequestMetrics()
+    names = [f'endpoint_{i}' for i in range(endpoints)]
+    counter = iter(range(10 ** 12))
+
+    def record():
+        endpoint = names[next(counter) % endpoints]
+        metrics.start(endpoint)
+        metrics.finish(endpoint, 'GET', 200, 0.0042, 1234)
+
+    results = [{'case': 'record', 'iterations': iterations,
+                'per_request_us': _best_per_call_us(record, iterations, repeat)}]
+
+    # Flaskのフック関数（開始・after_request・teardown）をリクエストコンテキスト内で実行
+    app = Flask(__name__)
+    app.add_url_rule('/ping', 'ping', lambda: 'ok')
+    init_performance_monitor(app)
+    before = app.before_request_funcs[None][0]
+    after = app.after_request_funcs[None][0]
+    teardown = app.teardown_request_funcs[None][0]
+    with app.test_request_context('/ping'):
+        response = app.make_response('ok')
+
+        def hooks():
+            before()
+            after(response)
+            teardown()
+
+        results.append({'case': 'flask_hooks', 'iterations': iterations,
+                        'per_request_us': _best_per_call_us(hooks, iterations, repeat)})
+    return results
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def bench_photo_ingest(punches, photo_kib=2048, concurrency=4, interval_ms=50):
+    """打刻スレッドが写真の処理で待つ時間（従来の同期保存 / PhotoWriter への受け渡し）
+
+    各スレッドは interval_ms ごとに打刻する（端末からの打刻の間隔を模擬）。
+    """
+    from werkzeug.datastructures import FileStorage
+
+    data = os.urandom(photo_kib * 1024)
+    results = []
+    for name in ('sync_save', 'async_writer'):
+        work_dir = tempfile.mkdtemp(prefix='timecard_bench_photos_')
+        store = PhotoStore(work_dir)
+        writer = PhotoWriter(queue_size=16, attach=lambda *result: True)
+        latencies = []
+        latencies_lock = threading.Lock()
+        counter = iter(range(punches))
+
+        def punch_loop():
+            while True:
+                with latencies_lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                # 打刻ごとに内容を変える（ストアの重複排除で書き込みが省かれないように）
+                content = i.to_bytes(8, 'big') + data[8:]
+                photo = FileStorage(io.BytesIO(content), filename='camera.jpg')
+                started = time.perf_counter()
+                if name == 'sync_save':
+                    photo.save(os.path.join(work_dir, f'{i}.jpg'))
+                else:
+                    spool_path = store.spool(i, photo.stream, '.jpg')
+                    if not writer.submit(i, store, spool_path):
+                        writer.write(i, store, spool_path)
+                elapsed = time.perf_counter() - started
+                with latencies_lock:
+                    latencies.append(elapsed)
+                time.sleep(interval_ms / 1000)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=punch_loop) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.join()
+        total = time.perf_counter() - started
+
+        results.append({
+            'case': name,
+            'punches': punches,
+            'photo_kib': photo_kib,
+            'p50_ms': _percentile(latencies, 0.5) * 1000,
+            'p99_ms': _percentile(latencies, 0.99) * 1000,
+            'total_sec': total,
+            'sync_fallbacks': writer.rejected,
+        })
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def _camera_jpeg(width, height, seed):
+    """カメラ写真に近いサイズになるよう、グラデーションにノイズを重ねた JPEG"""
+    from PIL import Image
+
+    base = Image.linear_gradient('L').rotate(seed * 37 % 360).resize((width, height))
+    noise = Image.effect_noise((width, height), 8)
+    image = Image.merge('RGB', (base, noise, Image.blend(base, noise, 0.5)))
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=90)
+    return output.getvalue()
+
+
+def bench_photo_derivatives(photos, page_size=50, width=4032, height=3024):
+    """縮小版1枚あたりのCPU時間と、管理画面1ページ（page_size 件）の写真の転送量"""
+    work_dir = tempfile.mkdtemp(prefix='timecard_bench_derivatives_')
+    store = PhotoStore(work_dir)
+    sizes = {'original': []}
+    cpu = {size: [] for size in PHOTO_DERIVATIVES}
+    for i in range(photos):
+        digest, _ = store.put(_camera_jpeg(width, height, i))
+        sizes['original'].append(os.path.getsize(store.path(digest)))
+        for size, max_px in PHOTO_DERIVATIVES.items():
+            started = time.process_time()
+            render_derivative(store.path(digest), store.derivative_path(digest, size), max_px)
+            cpu[size].append(time.process_time() - started)
+            sizes.setdefault(size, []).append(os.path.getsize(store.derivative_path(digest, size)))
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = []
+    for size, values in sizes.items():
+        average = sum(values) / len(values)
+        results.append({
+            'size': size,
+            'photos': photos,
+            'avg_kib': average / 1024,
+            'page_kib': average * page_size / 1024,
+            'cpu_ms_per_photo': sum(cpu[size]) / len(cpu[size]) * 1000 if size in cpu else 0.0,
+        })
+    return results
+
+
+def _walk_and_read(root):
+    """バックアップの模擬（全ファイルを列挙して読み出す）: (ファイル数, 経過秒)"""
+    started = time.perf_counter()
+    files = 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            with open(os.path.join(directory, name), 'rb') as f:
+                while f.read(1024 * 1024):
+                    pass
+            files += 1
+    return files, time.perf_counter() - started
+
+
+def bench_photo_archive(photos, photo_kib=256, reads=1000):
+    """保存期間を過ぎた写真のパック前後のファイル数・全件読み出し時間と、1枚の読み出し時間"""
+    work_dir = tempfile.mkdtemp(prefix='timecard_bench_archive_')
+    upload_folder = os.path.join(work_dir, 'photos')
+    store = PhotoStore(upload_folder)
+    db_engine = create_db_engine(f"sqlite:///{os.path.join(work_dir, 'bench.db')}")
+    Base.metadata.create_all(bind=db_engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=db_engine)
+    old = datetime.now(JST) - timedelta(days=200)
+    data = os.urandom(photo_kib * 1024)
+    digests = []
+    db_session = session_factory()
+    try:
+        for i in range(photos):
+            digest, _ = store.put(i.to_bytes(8, 'big') + data[8:])
+            digests.append(digest)
+            db_session.add(TimeRecord(employee_id=f'EMP{i % 50:04d}', timestamp=old, work_date=old.date(),
+                                      record_type='check_in', photo_path=digest, photo_status='ready'))
+            db_session.add(PhotoBlob(digest=digest, size=len(data), content_type='image/jpeg', refcount=1))
+        db_session.commit()
+    finally:
+        db_session.close()
+    sample = [digests[i % photos] for i in range(reads)]
+    # 乱数の写真は画像として読めず、縮小版の作成で1枚ごとに警告が出るため抑止
+    logging.getLogger('photos').setLevel(logging.ERROR)
+
+    files, backup = _walk_and_read(upload_folder)
+    started = time.perf_counter()
+    for digest in sample:
+        with open(store.path(digest), 'rb') as f:
+            f.read()
+    loose_read = time.perf_counter() - started
+    results = [{'layout': 'loose', 'photos': photos, 'files': files, 'backup_ms': backup * 1000,
+                'read_us_per_photo': loose_read / reads * 1e6, 'archive_ms': 0.0}]
+
+    started = time.perf_counter()
+    archive_photos(db_engine, upload_folder, 90)
+    archive = time.perf_counter() - started
+    files, backup = _walk_and_read(upload_folder)
+    db_session = session_factory()
+    try:
+        entries = {entry.digest: entry for entry in db_session.query(PhotoPackEntry)}
+    finally:
+        db_session.close()
+    packs = PhotoPacks()
+    started = time.perf_counter()
+    for digest in sample:
+        entry = entries[digest]
+        packs.read(store.pack_path(entry.pack), entry.offset, entry.length).tobytes()
+    packed_read = time.perf_counter() - started
+    packs.clear()
+    results.append({'layout': 'packed', 'photos': photos, 'files': files, 'backup_ms': backup * 1000,
+                    'read_us_per_photo': packed_read / reads * 1e6, 'archive_ms': archive * 1000})
+    db_engine.dispose()
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def print_result(result):
+    """計測結果を1行で出力"""
+    print(' | '.join(
+        f'{key}={value:.1f}' if isinstance(value, float) else f'{key}={value}'
+        for key, value in result.items()
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='タイムカードシステムのベンチマーク')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sqlite_parser = subparsers.add_parser('sqlite-profile', help='SQLiteプロファイル別の読み書き混在スループット')
+    sqlite_parser.add_argument('--seconds', type=float, default=5.0)
+    sqlite_parser.add_argument('--writers', type=int, default=4)
+    sqlite_parser.add_argument('--readers', type=int, default=8)
+    sqlite_parser.add_argument('--profiles', nargs='+', default=list(ENGINE_PROFILES))
+
+    csv_parser = subparsers.add_parser('csv-export', help='CSVエクスポートのメモリ使用量と応答開始時間')
+    csv_parser.add_argument('--rows', type=int, nargs='+', default=[5000, 20000])
+
+    rate_parser = subparsers.add_parser('rate-limit', help='レート制限の1回あたりのコストと保持メモリ')
+    rate_parser.add_argument('--ips', type=int, default=1000000)
+    rate_parser.add_argument('--max-keys', type=int, default=100000)
+    rate_parser.add_argument('--hot-requests', type=int, default=10000)
+
+    scan_parser = subparsers.add_parser('content-scan', help='悪意のあるコンテンツ検出とサニタイズの時間')
+    scan_parser.add_argument('--kib', type=int, default=100)
+    scan_parser.add_argument('--legacy-kib', type=int, default=10)
+
+    validate_parser = subparsers.add_parser('validate-input', help='入力検証デコレータの1リクエストあたりの時間')
+    validate_parser.add_argument('--iterations', type=int, default=50000)
+
+    metrics_parser = subparsers.add_parser('request-metrics', help='リクエストメトリクス記録の1リクエストあたりのコスト')
+    metrics_parser.add_argument('--iterations', type=int, default=100000)
+
+    photo_parser = subparsers.add_parser('photo-ingest', help='打刻時の写真保存で打刻スレッドが待つ時間（p50/p99）')
+    photo_parser.add_argument('--punches', type=int, default=200)
+    photo_parser.add_argument('--kib', type=int, default=2048)
+    photo_parser.add_argument('--concurrency', type=int, default=4)
+    photo_parser.add_argument('--interval-ms', type=float, default=50)
+
+    derivative_parser = subparsers.add_parser('photo-derivatives', help='写真の縮小版の作成コストと1ページあたりの転送量')
+    derivative_parser.add_argument('--photos', type=int, default=10)
+    derivative_parser.add_argument('--page-size', type=int, default=50)
+    derivative_parser.add_argument('--width', type=int, default=4032)
+    derivative_parser.add_argument('--height', type=int, default=3024)
+
+    archive_parser = subparsers.add_parser('photo-archive', help='写真のパック前後のファイル数・全件読み出し時間と1枚の読み出し時間')
+    archive_parser.add_argument('--photos', type=int, default=2000)
+    archive_parser.add_argument('--kib', type=int, default=256)
+    archive_parser.add_argument('--reads', type=int, default=1000)
+
+    args = parser.parse_args()
+
+    if args.command == 'sqlite-profile':
+        for profile in args.profiles:
+            print_result(bench_sqlite_profile(profile, args.seconds, args.writers, args.readers))
+    elif args.command == 'csv-export':
+        for rows in args.rows:
+            for result in bench_csv_export(rows):
+                print_result(result)
+    elif args.command == 'rate-limit':
+        for result in bench_rate_limit(args.ips, args.max_keys, args.hot_requests):
+            print_result(result)
+    elif args.command == 'content-scan':
+        for result in bench_content_scan(args.kib * 1024, args.legacy_kib * 1024):
+            print_result(result)
+    elif args.command == 'validate-input':
+        for result in bench_validate_input(args.iterations):
+            print_result(result)
+    elif args.command == 'request-metrics':
+        for result in bench_request_metrics(args.iterations):
+            print_result(result)
+    elif args.command == 'photo-ingest':
+        for result in bench_photo_ingest(args.punches, args.kib, args.concurrency, args.interval_ms):
+            print_result(result)
+    elif args.command == 'photo-derivatives':
+        for result in bench_photo_derivatives(args.photos, args.page_size, args.width, args.height):
+            print_result(result)
+    elif args.command == 'photo-archive':
+        for result in bench_photo_archive(args.photos, args.kib, args.reads):
+            print_result(result)
+
+
+if __name__ == '__main__':
+    main()
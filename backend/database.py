@@ -1,17 +1,87 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import sessionmaker
 from werkzeug.security import generate_password_hash
 from models import Base, Employee, User, WorkStatus, Notification
+from migrations import run_migrations
 import os
 from datetime import datetime
 import pytz
 
-# データベースファイルのパス
+# データベースファイルのパス（DATABASE_URL 環境変数で上書き可能）
 DB_PATH = 'data/timecard.db'
-DATABASE_URL = f'sqlite:///{DB_PATH}'
+DATABASE_URL = os.environ.get('DATABASE_URL', f'sqlite:///{DB_PATH}')
+
+# SQLite エンジンプロファイル（接続ごとに適用する PRAGMA）
+ENGINE_PROFILES = {
+    # 従来どおり PRAGMA を設定しない（ベンチマーク比較用）
+    'legacy': {},
+    # 本番向け：WAL で読み書きを並行させ、ロック待ちはタイムアウトまで待機
+    'production': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,       # ミリ秒
+        'cache_size': -20000,       # 負値は KiB 単位（約20MB）
+        'mmap_size': 268435456,     # 256MB
+        'temp_store': 'MEMORY',
+    },
+}
+DB_PROFILE = os.environ.get('DB_PROFILE', 'production')
+
+
+def get_engine_pragmas(profile=DB_PROFILE):
+    """プロファイルと環境変数（SQLITE_<PRAGMA名>）から PRAGMA 設定を組み立てる"""
+    if profile not in ENGINE_PROFILES:
+        raise ValueError(f'不明なDBプロファイルです: {profile}')
+
+    pragmas = dict(ENGINE_PROFILES[profile])
+    for name in ENGINE_PROFILES['production']:
+        override = os.environ.get(f'SQLITE_{name.upper()}')
+        if override:
+            pragmas[name] = override
+    return pragmas
+
+
+def create_db_engine(url=DATABASE_URL, profile=DB_PROFILE, **kwargs):
+    """プロファイルの PRAGMA を新規接続ごとに適用するエンジンを作成"""
+    db_engine = create_engine(url, echo=False, **kwargs)
+    pragmas = get_engine_pragmas(profile) if db_engine.dialect.name == 'sqlite' else {}
+
+    if pragmas:
+        @event.listens_for(db_engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            try:
+                for name, value in pragmas.items():
+                    cursor.execute(f'PRAGMA {name}={value}')
+            finally:
+                cursor.close()
+
+    return db_engine
+
+
+def get_active_pragmas(db_engine=None):
+    """接続に実際に適用されている PRAGMA 値を取得"""
+    db_engine = db_engine or engine
+    if db_engine.dialect.name != 'sqlite':
+        return {}
+
+    active = {}
+    with db_engine.connect() as conn:
+        for name in ENGINE_PROFILES['production']:
+            active[name] = conn.execute(text(f'PRAGMA {name}')).scalar()
+    return active
+
+
+def explain_query_plan(statement, params=None, db_engine=None):
+    """SQLite の EXPLAIN QUERY PLAN の detail 列を取得"""
+    db_engine = db_engine or engine
+    with db_engine.connect() as conn:
+        rows = conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', params or ())
+        return [row[-1] for row in rows]
+
 
 # エンジンとセッションの作成
-engine = create_engine(DATABASE_URL, echo=False)
+engine = create_db_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 JST = pytz.timezone('Asia/Tokyo')
@@ -19,8 +89,9 @@ JST = pytz.timezone('Asia/Tokyo')
 
 def init_db():
     """データベースの初期化"""
-    # テーブルの作成
+    # テーブルの作成と既存データベースへのマイグレーション適用
     Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
     
     session = SessionLocal()
     try:
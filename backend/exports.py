@@ -0,0 +1,372 @@
+# 勤務記録のエクスポート
+#
+# 打刻記録を必要な列だけ射影して yield_per で少しずつ読み出し、
+# BOM付きUTF-8のCSVをチャンク単位で生成する。期間に関わらずメモリ使用量は一定。
+#
+# 大きな期間はエクスポートジョブとしてワーカースレッドで data/exports/ に書き出し、
+# 締め済みの期間（終了日が今日より前）は同一条件の完成済みファイルを再利用する。
+#
+# ジョブには実行するプロセス（ホスト名:PID）を記録し、起動時に終了したプロセスの
+# pending / running のジョブを failed にする（再起動後に終わらないジョブをポーリングさせない）。
+# 終了から EXPORT_RETENTION_DAYS 日を過ぎたジョブはファイルとともに削除する（起動時とジョブの完了時）。
+
+import csv
+import hashlib
+import io
+import logging
+import os
+import socket
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytz
+
+from database import get_db_session
+from models import TimeRecord, Employee, DailyAttendance, ExportJob
+
+logger = logging.getLogger(__name__)
+JST = pytz.timezone('Asia/Tokyo')
+
+CSV_HEADER = ['従業員ID', '従業員名', '日付', '時刻', '種別', '写真']
+ATTENDANCE_CSV_HEADER = ['従業員ID', '従業員名', '日付', '出勤', '退勤', '勤務時間', '休憩時間', '打刻数']
+CSV_BOM = '\ufeff'.encode('utf-8')
+
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', 2))
+STALE_JOB_SECONDS = 600  # 進捗更新がこの秒数ない実行中ジョブは再利用しない
+EXPORT_RETENTION_DAYS = int(os.environ.get('EXPORT_RETENTION_DAYS', 7))
+
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _iter_csv(header, rows, to_row, batch_size, on_progress=None):
+    """行のイテレータをBOM付きUTF-8のCSVチャンクに変換"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    yield CSV_BOM + buffer.getvalue().encode('utf-8')
+
+    written = 0
+    pending = 0
+    for row in rows:
+        if pending == 0:
+            buffer.seek(0)
+            buffer.truncate()
+        writer.writerow(to_row(row))
+        pending += 1
+        if pending == batch_size:
+            yield buffer.getvalue().encode('utf-8')
+            written += pending
+            pending = 0
+            if on_progress:
+                on_progress(written)
+
+    if pending:
+        yield buffer.getvalue().encode('utf-8')
+        written += pending
+        if on_progress:
+            on_progress(written)
+
+
+def time_record_export_query(db_session, start_date=None, end_date=None):
+    """エクスポート対象の打刻記録（従業員名を結合した列射影）"""
+    query = db_session.query(
+        TimeRecord.employee_id,
+        Employee.name,
+        TimeRecord.timestamp,
+        TimeRecord.record_type,
+        TimeRecord.photo_path
+    ).join(Employee, Employee.employee_id == TimeRecord.employee_id)
+
+    if start_date:
+        query = query.filter(TimeRecord.work_date >= start_date)
+    if end_date:
+        query = query.filter(TimeRecord.work_date <= end_date)
+
+    return query.order_by(TimeRecord.timestamp, TimeRecord.id)
+
+
+def iter_time_records_csv(db_session, start_date=None, end_date=None, batch_size=1000, on_progress=None):
+    """打刻記録のCSVをバイト列のチャンクとして順次生成"""
+    rows = time_record_export_query(db_session, start_date, end_date).yield_per(batch_size)
+    return _iter_csv(CSV_HEADER, rows, lambda row: [
+        row.employee_id,
+        row.name,
+        row.timestamp.strftime('%Y-%m-%d'),
+        row.timestamp.strftime('%H:%M:%S'),
+        '出勤' if row.record_type == 'check_in' else '退勤',
+        '有' if row.photo_path else '無'
+    ], batch_size, on_progress)
+
+
+def attendance_export_query(db_session, start_date=None, end_date=None):
+    """エクスポート対象の日次勤怠集計（従業員名を結合した列射影）"""
+    query = db_session.query(
+        DailyAttendance.employee_id,
+        Employee.name,
+        DailyAttendance.work_date,
+        DailyAttendance.first_check_in,
+        DailyAttendance.last_check_out,
+        DailyAttendance.worked_seconds,
+        DailyAttendance.break_seconds,
+        DailyAttendance.punch_count
+    ).join(Employee, Employee.employee_id == DailyAttendance.employee_id)
+
+    if start_date:
+        query = query.filter(DailyAttendance.work_date >= start_date)
+    if end_date:
+        query = query.filter(DailyAttendance.work_date <= end_date)
+
+    return query.order_by(DailyAttendance.work_date, DailyAttendance.employee_id)
+
+
+def iter_attendance_csv(db_session, start_date=None, end_date=None, batch_size=1000, on_progress=None):
+    """日次勤怠集計のCSVをバイト列のチャンクとして順次生成"""
+    rows = attendance_export_query(db_session, start_date, end_date).yield_per(batch_size)
+    return _iter_csv(ATTENDANCE_CSV_HEADER, rows, lambda row: [
+        row.employee_id,
+        row.name,
+        row.work_date.strftime('%Y-%m-%d'),
+        row.first_check_in.strftime('%H:%M:%S') if row.first_check_in else '',
+        row.last_check_out.strftime('%H:%M:%S') if row.last_check_out else '',
+        str(timedelta(seconds=row.worked_seconds)),
+        str(timedelta(seconds=row.break_seconds)),
+        row.punch_count
+    ], batch_size, on_progress)
+
+
+# 形式 -> (CSV生成関数, 件数取得用クエリ関数, ファイル名の接頭辞)
+EXPORT_FORMATS = {
+    'csv': (iter_time_records_csv, time_record_export_query, 'timecard'),
+    'attendance_csv': (iter_attendance_csv, attendance_export_query, 'attendance'),
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """エクスポート用ワーカープールを遅延生成"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix='export')
+        return _executor
+
+
+def executor_stats():
+    """ワーカープールの待ち件数（未生成なら 0）"""
+    with _executor_lock:
+        executor = _executor
+    return {
+        'workers': EXPORT_WORKERS,
+        'threads': len(executor._threads) if executor else 0,
+        'queued': executor._work_queue.qsize() if executor else 0,
+    }
+
+
+def export_job_key(export_format, start_date, end_date):
+    """形式と期間から同一条件判定用のキーを生成"""
+    raw = f'{export_format}:{start_date or ""}:{end_date or ""}'
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def is_closed_period(end_date):
+    """終了日が今日（JST）より前なら締め済みの期間"""
+    return end_date is not None and end_date < datetime.now(JST).date()
+
+
+def export_job_to_dict(job):
+    """ジョブの状態をレスポンス用に変換"""
+    progress = None
+    if job.status == 'done':
+        progress = 100
+    elif job.total_rows:
+        progress = min(99, job.rows_written * 100 // job.total_rows)
+
+    return {
+        'id': job.id,
+        'format': job.format,
+        'start_date': job.start_date.isoformat() if job.start_date else None,
+        'end_date': job.end_date.isoformat() if job.end_date else None,
+        'status': job.status,
+        'total_rows': job.total_rows,
+        'rows_written': job.rows_written,
+        'progress': progress,
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def _find_reusable_job(db_session, job_key, closed):
+    """完成済み（締め済み期間のみ）または実行中の同一条件ジョブを探す"""
+    candidates = db_session.query(ExportJob).filter(
+        ExportJob.job_key == job_key,
+        ExportJob.status.in_(['done', 'pending', 'running'])
+    ).order_by(ExportJob.created_at.desc()).all()
+
+    stale_before = datetime.now(JST).replace(tzinfo=None) - timedelta(seconds=STALE_JOB_SECONDS)
+    for job in candidates:
+        if job.status == 'done':
+            if closed and job.file_path and os.path.exists(job.file_path):
+                return job
+        elif job.updated_at and job.updated_at.replace(tzinfo=None) >= stale_before:
+            return job
+    return None
+
+
+def create_export_job(db_session, export_format, start_date, end_date, export_dir, requested_by=None):
+    """エクスポートジョブを登録してワーカーに投入（再利用できる場合は既存ジョブを返す）"""
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f'未対応の形式です: {export_format}')
+    if start_date and end_date and start_date > end_date:
+        raise ValueError('開始日付は終了日付より前である必要があります')
+
+    job_key = export_job_key(export_format, start_date, end_date)
+    existing = _find_reusable_job(db_session, job_key, is_closed_period(end_date))
+    if existing:
+        return existing, True
+
+    job = ExportJob(
+        id=uuid.uuid4().hex,
+        job_key=job_key,
+        format=export_format,
+        start_date=start_date,
+        end_date=end_date,
+        status='pending',
+        rows_written=0,
+        requested_by=requested_by,
+        worker=WORKER_ID
+    )
+    db_session.add(job)
+    db_session.commit()
+
+    _get_executor().submit(run_export_job, job.id, export_dir)
+    return job, False
+
+
+def _update_job(job_id, **values):
+    db_session = get_db_session()
+    try:
+        db_session.query(ExportJob).filter_by(id=job_id).update(
+            dict(values, updated_at=datetime.now(JST)), synchronize_session=False
+        )
+        db_session.commit()
+    finally:
+        db_session.close()
+
+
+def run_export_job(job_id, export_dir):
+    """ジョブのファイルを一時ファイルに書き出し、完了後にリネームして公開"""
+    db_session = get_db_session()
+    part_path = None
+    try:
+        job = db_session.query(ExportJob).filter_by(id=job_id).one()
+        iter_csv, export_query, prefix = EXPORT_FORMATS[job.format]
+        total_rows = export_query(db_session, job.start_date, job.end_date).order_by(None).count()
+        _update_job(job_id, status='running', total_rows=total_rows)
+
+        os.makedirs(export_dir, exist_ok=True)
+        period = f"{job.start_date or 'begin'}_{job.end_date or 'end'}"
+        file_path = os.path.join(export_dir, f'{prefix}_{period}_{job.id}.csv')
+        part_path = file_path + '.part'
+
+        with open(part_path, 'wb') as f:
+            progress = lambda written: _update_job(job_id, rows_written=written)
+            for chunk in iter_csv(db_session, job.start_date, job.end_date, on_progress=progress):
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(part_path, file_path)
+
+        _update_job(job_id, status='done', file_path=file_path, finished_at=datetime.now(JST))
+    except Exception as e:
+        if part_path and os.path.exists(part_path):
+            os.remove(part_path)
+        _update_job(job_id, status='failed', error=str(e), finished_at=datetime.now(JST))
+    finally:
+        db_session.close()
+
+    try:
+        cleanup_export_jobs(export_dir)
+    except Exception:
+        logger.exception('Failed to clean up export jobs')
+
+
+def _is_worker_alive(worker):
+    """ジョブを実行するプロセスが動いているか（別ホストのプロセスは判定できないため True）"""
+    if not worker:
+        return False
+    host, _, pid = worker.rpartition(':')
+    if host != socket.gethostname():
+        return True
+    if int(pid) == os.getpid():
+        return True
+    if os.name == 'nt':
+        # Windows の os.kill はプロセスを終了させるため確認できない（開発用の単一プロセスを想定）
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def fail_interrupted_jobs():
+    """終了したプロセスの pending / running のジョブを failed にして件数を返す"""
+    db_session = get_db_session()
+    try:
+        jobs = db_session.query(ExportJob).filter(ExportJob.status.in_(['pending', 'running'])).all()
+        interrupted = [job.id for job in jobs if not _is_worker_alive(job.worker)]
+        if interrupted:
+            now = datetime.now(JST)
+            # 確認後に完了したジョブは上書きしない
+            db_session.query(ExportJob).filter(
+                ExportJob.id.in_(interrupted), ExportJob.status.in_(['pending', 'running'])
+            ).update({'status': 'failed', 'error': 'プロセスの停止により中断されました',
+                      'finished_at': now, 'updated_at': now}, synchronize_session=False)
+            db_session.commit()
+        return len(interrupted)
+    finally:
+        db_session.close()
+
+
+def cleanup_export_jobs(export_dir, retention_days=EXPORT_RETENTION_DAYS):
+    """終了から retention_days 日を過ぎたジョブとファイル、どのジョブにも属さない古いファイルを削除"""
+    expire_before = datetime.now(JST).replace(tzinfo=None) - timedelta(days=retention_days)
+    result = {'jobs': 0, 'files': 0}
+    db_session = get_db_session()
+    try:
+        jobs = db_session.query(ExportJob).filter(ExportJob.status.in_(['done', 'failed'])).all()
+        expired = [job for job in jobs if (job.finished_at or job.created_at).replace(tzinfo=None) < expire_before]
+        for job in expired:
+            if job.file_path and os.path.exists(job.file_path):
+                os.remove(job.file_path)
+                result['files'] += 1
+        if expired:
+            db_session.query(ExportJob).filter(ExportJob.id.in_([job.id for job in expired])).delete(
+                synchronize_session=False)
+            db_session.commit()
+            result['jobs'] = len(expired)
+        kept = {os.path.basename(path) for path, in db_session.query(ExportJob.file_path).filter(
+            ExportJob.file_path.isnot(None))}
+    finally:
+        db_session.close()
+
+    # プロセスの停止で残った .part 等
+    if os.path.isdir(export_dir):
+        for name in os.listdir(export_dir):
+            path = os.path.join(export_dir, name)
+            if name in kept or not os.path.isfile(path):
+                continue
+            try:
+                if datetime.fromtimestamp(os.path.getmtime(path), JST).replace(tzinfo=None) < expire_before:
+                    os.remove(path)
+                    result['files'] += 1
+            except FileNotFoundError:
+                continue
+    return result
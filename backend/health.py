@@ -0,0 +1,214 @@
+# ヘルスチェック（稼働確認と詳細な準備状態）
+#
+# /api/health は DB に触れずプロセスが応答できることだけを返す（liveness）。
+# /api/health/ready は DB の往復時間・WAL ファイルサイズ・接続プールの貸出数、
+# uploads/photos と data/ の空き容量、Notion 同期からの経過時間、
+# バックグラウンドキュー（エクスポート・ログ・写真の保存）の滞留を調べる（readiness）。
+#
+# 詳細チェックの結果は HEALTH_CACHE_SECONDS の間キャッシュし、同時に来た
+# リクエストは1回のチェック結果を共有する。docker の healthcheck や外形監視を
+# 何本並べても DB とディスクへの負荷は一定になる。
+#
+# 各チェックは ok / warn / fail を返し、fail が1つでもあれば 503 を返す。
+
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+
+import pytz
+from sqlalchemy import text
+
+from database import DB_PROFILE, get_active_pragmas
+from exports import executor_stats
+from log_pipeline import log_stats
+from photos import photo_writer
+
+JST = pytz.timezone('Asia/Tokyo')
+
+HEALTH_CACHE_SECONDS = float(os.environ.get('HEALTH_CACHE_SECONDS', 5))
+HEALTH_DISK_MIN_FREE_MB = int(os.environ.get('HEALTH_DISK_MIN_FREE_MB', 500))
+HEALTH_DB_WARN_MS = float(os.environ.get('HEALTH_DB_WARN_MS', 200))
+HEALTH_QUEUE_WARN_RATIO = 0.8  # ログ・写真のキューがこの割合まで埋まったら warn
+
+STATUS_ORDER = {'ok': 0, 'warn': 1, 'fail': 2}
+
+
+def worst_status(statuses):
+    """最も悪い状態（空なら ok）"""
+    return max(statuses, key=STATUS_ORDER.__getitem__, default='ok')
+
+
+class NotionSyncStatus:
+    """このプロセスで最後に Notion 同期を試みた結果"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.last_success = None  # time.time()
+        self.last_attempt = None
+        self.last_error = None
+        self.tag_count = None
+
+    def record(self, tag_count=None, error=None):
+        now = time.time()
+        with self._lock:
+            self.last_attempt = now
+            self.last_error = error
+            if error is None:
+                self.last_success = now
+                self.tag_count = tag_count
+
+    def snapshot(self):
+        with self._lock:
+            return self.last_success, self.last_attempt, self.last_error, self.tag_count
+
+
+notion_sync_status = NotionSyncStatus()
+
+
+def _sqlite_wal_path(db_engine):
+    if db_engine.dialect.name != 'sqlite' or not db_engine.url.database:
+        return None
+    if db_engine.url.database == ':memory:':
+        return None
+    return db_engine.url.database + '-wal'
+
+
+def check_database(db_engine, warn_ms=HEALTH_DB_WARN_MS):
+    """SELECT 1 の往復時間・WAL ファイルサイズ・接続プールの状態"""
+    result = {}
+    started = time.perf_counter()
+    try:
+        with db_engine.connect() as conn:
+            conn.execute(text('SELECT 1')).scalar()
+    except Exception as e:
+        result.update(status='fail', error=f'{type(e).__name__}: {e}')
+    else:
+        latency_ms = (time.perf_counter() - started) * 1000
+        result.update(status='warn' if latency_ms > warn_ms else 'ok', latency_ms=round(latency_ms, 3))
+
+    wal_path = _sqlite_wal_path(db_engine)
+    if wal_path is not None:
+        result['wal_bytes'] = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+
+    pool = db_engine.pool
+    if hasattr(pool, 'checkedout'):
+        result['pool'] = {
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+        }
+    return result
+
+
+def check_disk(paths, min_free_mb=HEALTH_DISK_MIN_FREE_MB):
+    """ディレクトリごとの空き容量（min_free_mb を下回ったら fail）"""
+    result = {'status': 'ok', 'paths': {}}
+    for name, path in paths.items():
+        try:
+            usage = shutil.disk_usage(path)
+        except OSError as e:
+            result['paths'][name] = {'status': 'fail', 'error': str(e)}
+            result['status'] = 'fail'
+            continue
+        status = 'ok' if usage.free >= min_free_mb * 1024 * 1024 else 'fail'
+        result['paths'][name] = {
+            'status': status,
+            'free_bytes': usage.free,
+            'total_bytes': usage.total,
+            'free_ratio': round(usage.free / usage.total, 4) if usage.total else None,
+        }
+        result['status'] = worst_status((result['status'], status))
+    return result
+
+
+def check_notion_sync(sync_status=notion_sync_status, configured=True):
+    """最後の同期からの経過秒数（同期は手動のため、失敗した場合のみ warn）"""
+    if not configured:
+        return {'status': 'ok', 'configured': False}
+    last_success, last_attempt, last_error, tag_count = sync_status.snapshot()
+    now = time.time()
+    return {
+        'status': 'warn' if last_error else 'ok',
+        'configured': True,
+        'last_sync_age_seconds': round(now - last_success, 1) if last_success else None,
+        'last_attempt_age_seconds': round(now - last_attempt, 1) if last_attempt else None,
+        'last_error': last_error,
+        'tags': tag_count,
+    }
+
+
+def check_queues(export_stats, log_stats, photo_stats=None, warn_ratio=HEALTH_QUEUE_WARN_RATIO):
+    """エクスポートのワーカープール・ログキュー・写真の保存キューの滞留"""
+    bounded = list(log_stats.values()) + ([photo_stats] if photo_stats else [])
+    status = 'ok'
+    for stats in bounded:
+        if stats['capacity'] and stats['queued'] >= stats['capacity'] * warn_ratio:
+            status = 'warn'
+    result = {'status': status, 'exports': export_stats, 'logging': log_stats}
+    if photo_stats is not None:
+        result['photos'] = photo_stats
+    return result
+
+
+class HealthCheck:
+    """チェック関数の結果をまとめ、cache_seconds の間キャッシュする"""
+
+    def __init__(self, checks, cache_seconds=HEALTH_CACHE_SECONDS, clock=time.monotonic):
+        self.checks = checks  # 名前 -> 引数なしで結果の dict を返す関数
+        self.cache_seconds = cache_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._report = None
+        self._expires = 0.0
+        self.runs = 0
+
+    def _run(self):
+        results = {}
+        for name, check in self.checks.items():
+            try:
+                results[name] = check()
+            except Exception as e:
+                results[name] = {'status': 'fail', 'error': f'{type(e).__name__}: {e}'}
+        self.runs += 1
+        return {
+            'status': worst_status(result['status'] for result in results.values()),
+            'checked_at': datetime.now(JST).isoformat(),
+            'checks': results,
+        }
+
+    def report(self):
+        """キャッシュが有効ならそれを、切れていればチェックを実行して返す"""
+        # 同時に来たリクエストはロックで待たせ、1回の実行結果を共有する
+        with self._lock:
+            now = self._clock()
+            if self._report is None or now >= self._expires:
+                self._report = self._run()
+                self._expires = self._clock() + self.cache_seconds
+            return self._report
+
+    def clear(self):
+        with self._lock:
+            self._report = None
+
+
+def init_health_check(app, db_engine, notion_configured=False):
+    """アプリの設定からチェックを組み立てて app.extensions['health_check'] に登録"""
+    def database():
+        result = check_database(db_engine)
+        if result['status'] != 'fail':
+            result['profile'] = {'name': DB_PROFILE, 'pragmas': get_active_pragmas(db_engine)}
+        return result
+
+    def disk():
+        return check_disk({'photos': app.config['UPLOAD_FOLDER'], 'data': 'data'})
+
+    health_check = HealthCheck({
+        'database': database,
+        'disk': disk,
+        'notion_sync': lambda: check_notion_sync(configured=notion_configured),
+        'queues': lambda: check_queues(executor_stats(), log_stats(), photo_writer.stats()),
+    })
+    app.extensions['health_check'] = health_check
+    return health_check
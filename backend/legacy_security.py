@@ -0,0 +1,95 @@
+# 最適化前の入力検査の実装（ベンチマークの比較対象・テストの基準）
+#
+# security.py の実装を置き換えた際の挙動の一致を確認するために、従来の実装と
+# その比較に使う入力をそのまま残している。アプリケーションからは使用しない。
+
+import re
+
+
+MALICIOUS_PATTERNS = [
+    r'<script.*?>.*?</script>', r'javascript:', r'on\w+\s*=', r'union\s+select',
+    r'drop\s+table', r'insert\s+into', r'delete\s+from', r'update\s+.*\s+set',
+    r'exec\s*\(', r'eval\s*\(', r'system\s*\(', r'\.\./', r'%2e%2e%2f', r'%252e%252e%252f'
+]
+
+
+def contains_malicious_content(content):
+    """従来の contains_malicious_content 相当（パターンごとに re.search）"""
+    content_lower = content.lower()
+    return any(re.search(pattern, content_lower, re.IGNORECASE) for pattern in MALICIOUS_PATTERNS)
+
+
+def sanitize_string(value, max_length=1000):
+    """従来の sanitize_string 相当（エスケープ後に切り詰め）"""
+    value = (value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+                  .replace('"', '&quot;').replace("'", '&#x27;'))
+    if len(value) > max_length:
+        value = value[:max_length]
+    return re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]', '', value).strip()
+
+
+def content_scan_inputs(size):
+    """日報本文相当の通常入力と、従来のパターンで後戻りが膨らむ入力"""
+    def fill(unit):
+        return (unit * (size // len(unit) + 1))[:size]
+    return {
+        'report_ja': fill('本日は現場で配線作業を行いました。明日も継続します。\n'),
+        'report_en': fill('Worked on the <b>site</b> & "checked" wiring today.\n'),
+        'update_spam': fill('update '),
+        'script_spam': fill('<script '),
+        'on_word': fill('on'),
+    }
+
+
+def validate_and_sanitize(manager, data, validation_rules):
+    """従来の validate_input_data 相当（リクエストごとにルールを解釈し、サニタイズは別ループ）"""
+    errors = []
+    for field, rules in validation_rules.items():
+        value = data.get(field)
+        if rules.get('required', False) and not value:
+            errors.append(f'{field}は必須項目です')
+            continue
+        if value is None:
+            continue
+        expected_type = rules.get('type')
+        if expected_type and not isinstance(value, expected_type):
+            errors.append(f'{field}の型が正しくありません')
+            continue
+        if isinstance(value, str):
+            min_length = rules.get('min_length', 0)
+            max_length = rules.get('max_length', float('inf'))
+            if not (min_length <= len(value) <= max_length):
+                errors.append(f'{field}は{min_length}文字以上{max_length}文字以下で入力してください')
+            pattern = rules.get('pattern')
+            if pattern and not re.match(pattern, value):
+                errors.append(f'{field}の形式が正しくありません')
+            if manager.contains_malicious_content(value):
+                errors.append(f'{field}に不正な文字列が含まれています')
+        if isinstance(value, (int, float)):
+            min_val = rules.get('min_value', float('-inf'))
+            max_val = rules.get('max_value', float('inf'))
+            if not (min_val <= value <= max_val):
+                errors.append(f'{field}は{min_val}以上{max_val}以下で入力してください')
+    if errors:
+        return errors, None
+    return errors, {
+        key: manager.sanitize_string(value) if isinstance(value, str) else value
+        for key, value in data.items()
+    }
+
+
+VALIDATION_CASES = {
+    'login': (
+        {'username': {'required': True, 'type': str, 'max_length': 50},
+         'password': {'required': True, 'type': str, 'max_length': 100}},
+        {'username': 'yamada', 'password': 'yamada123'},
+    ),
+    'daily_report': (
+        {'report_date': {'required': True, 'type': str, 'pattern': r'^\d{4}-\d{2}-\d{2}$'},
+         'work_content': {'required': True, 'type': str, 'max_length': 5000},
+         'achievements': {'type': str, 'max_length': 5000},
+         'hours': {'type': (int, float), 'min_value': 0, 'max_value': 24}},
+        {'report_date': '2024-04-01', 'work_content': '現場で配線作業を行いました。' * 5,
+         'achievements': '予定通り完了', 'hours': 7.5, 'remarks': '特になし'},
+    ),
+}
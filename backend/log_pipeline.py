@@ -0,0 +1,264 @@
+# キュー経由の非同期ログ出力
+#
+# リクエスト処理スレッドはログレコードをメモリ上のキューに積むだけで、
+# JSON整形とファイル書き込み（サイズによるローテーション付き）は
+# ロガーごとのリスナースレッドが行う。
+#
+# セキュリティイベントは (種別, IP, ユーザー, 詳細) が同一のものを
+# LOG_COALESCE_SECONDS の間1件にまとめ、抑止した件数は窓の終了後に
+# 集約レコードとして出力する（次のレコードが来なくても、パイプラインのタイマースレッドが
+# 窓の半分ごとに終了した窓を出力し、停止時には集約中の件数をすべて出力する）。
+# キューが満杯の場合は破棄して件数を数え、
+# 空きができた時点で破棄件数を出力する。
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import pytz
+
+JST = pytz.timezone('Asia/Tokyo')
+
+LOG_DIR = os.environ.get('LOG_DIR', 'logs')
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+LOG_COALESCE_SECONDS = float(os.environ.get('LOG_COALESCE_SECONDS', 10))
+LOG_COALESCE_MAX_KEYS = 10000
+
+# JSONに含めない LogRecord 標準の属性
+_RESERVED_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'coalesce_key'}
+
+
+class JsonFormatter(logging.Formatter):
+    """1レコードを1行のJSONに整形（extra で渡した項目もそのまま出力）"""
+
+    def format(self, record):
+        entry = {
+            'timestamp': datetime.fromtimestamp(record.created, JST).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc_info'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class CoalescingQueueHandler(logging.handlers.QueueHandler):
+    """同一イベントの集約と、キュー満杯時の破棄を行う QueueHandler
+
+    coalesce_key 属性を持つレコードだけを集約の対象にする。
+    emit は Handler のロック内で呼ばれるため、状態の更新は直列化される。
+    """
+
+    def __init__(self, log_queue, window_seconds=LOG_COALESCE_SECONDS,
+                 max_keys=LOG_COALESCE_MAX_KEYS, clock=time.monotonic):
+        super().__init__(log_queue)
+        self.window_seconds = window_seconds
+        self.max_keys = max_keys
+        self._clock = clock
+        self._windows = OrderedDict()  # キー -> [窓の開始時刻, 抑止件数, 代表レコード]
+        self._unreported_drops = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 整形はリスナー側で行うため、ここでは引数の展開と例外の文字列化のみ
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            now = self._clock()
+            self._flush_expired(now)
+
+            key = getattr(record, 'coalesce_key', None)
+            if key is not None and self.window_seconds > 0:
+                window = self._windows.get(key)
+                if window is not None:
+                    window[1] += 1
+                    self.coalesced += 1
+                    return
+                if len(self._windows) >= self.max_keys:
+                    self._report(*self._windows.popitem(last=False)[1][1:])
+                self._windows[key] = [now, 0, record]
+
+            if self._unreported_drops:
+                self._report_drops(record)
+            self._enqueue(record)
+        except Exception:
+            self.handleError(record)
+
+    def _enqueue(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            self._unreported_drops += 1
+            return False
+
+    def _flush_expired(self, now):
+        """窓が終了したキーを取り除き、抑止件数があれば集約レコードを出力"""
+        while self._windows:
+            key, (started, suppressed, record) = next(iter(self._windows.items()))
+            if now - started < self.window_seconds:
+                break
+            del self._windows[key]
+            self._report(suppressed, record)
+
+    def _report(self, suppressed, record):
+        if not suppressed:
+            return
+        summary = logging.makeLogRecord(record.__dict__)
+        summary.msg = f'{suppressed}件の同一イベントを抑止しました: {record.getMessage()}'
+        summary.args = None
+        summary.levelno = logging.WARNING
+        summary.levelname = 'WARNING'
+        summary.created = time.time()
+        summary.suppressed = suppressed
+        summary.coalesce_key = None
+        self._enqueue(summary)
+
+    def _report_drops(self, record):
+        # 空きが無い間は破棄件数の出力自体を見送る（破棄件数には数えない）
+        if self.queue.full():
+            return
+        dropped = self._unreported_drops
+        self._unreported_drops = 0
+        self._enqueue(logging.makeLogRecord({
+            'name': record.name,
+            'levelno': logging.WARNING,
+            'levelname': 'WARNING',
+            'msg': f'ログキューが満杯のため{dropped}件のレコードを破棄しました',
+            'dropped': dropped,
+        }))
+
+    def flush_expired(self):
+        """窓が終了したキーの抑止件数を出力（タイマーから定期的に呼ぶ）"""
+        with self.lock:
+            self._flush_expired(self._clock())
+
+    def flush_all(self):
+        """集約中の抑止件数をすべて出力（終了時用）"""
+        with self.lock:
+            while self._windows:
+                self._report(*self._windows.popitem(last=False)[1][1:])
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'capacity': self.queue.maxsize,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'coalescing_keys': len(self._windows),
+        }
+
+
+class LogPipeline:
+    """ロガー1つ分のキュー・ハンドラー・リスナースレッドの組"""
+
+    def __init__(self, logger, handlers, queue_size=LOG_QUEUE_SIZE, **handler_options):
+        self.logger = logger
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.handler = CoalescingQueueHandler(self.queue, **handler_options)
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self._stopping = threading.Event()
+        self._flusher = None
+
+    def start(self):
+        self.logger.addHandler(self.handler)
+        self.listener.start()
+        if self.handler.window_seconds > 0:
+            self._flusher = threading.Thread(target=self._flush_periodically,
+                                             name=f'log-flush-{self.logger.name}', daemon=True)
+            self._flusher.start()
+
+    def _flush_periodically(self):
+        # 最後のバーストの抑止件数も、窓の終了から窓の半分以内に出力する
+        while not self._stopping.wait(self.handler.window_seconds / 2):
+            self.handler.flush_expired()
+
+    def stop(self):
+        self._stopping.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.handler.flush_all()
+        self.logger.removeHandler(self.handler)
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+
+    def stats(self):
+        return self.handler.stats()
+
+
+_pipelines = {}
+_pipelines_lock = threading.Lock()
+
+
+def _rotating_file_handler(filename):
+    handler = logging.handlers.RotatingFileHandler(
+        os.path.join(LOG_DIR, filename),
+        maxBytes=LOG_MAX_BYTES,
+        backupCount=LOG_BACKUP_COUNT,
+        encoding='utf-8'
+    )
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+def configure_logging():
+    """アプリケーション・セキュリティログのパイプラインを開始（複数回呼んでも1度だけ）"""
+    with _pipelines_lock:
+        if _pipelines:
+            return _pipelines
+
+        os.makedirs(LOG_DIR, exist_ok=True)
+
+        console = logging.StreamHandler()
+        console.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        root = logging.getLogger()
+        root.setLevel(logging.INFO)
+        _pipelines['app'] = LogPipeline(root, [_rotating_file_handler('app.log'), console])
+
+        security = logging.getLogger('security')
+        security.setLevel(logging.INFO)
+        security.propagate = False
+        _pipelines['security'] = LogPipeline(security, [_rotating_file_handler('security.log')])
+
+        for pipeline in _pipelines.values():
+            pipeline.start()
+        atexit.register(shutdown_logging)
+        return _pipelines
+
+
+def shutdown_logging():
+    """キューに残ったレコードを書き出してリスナーを停止"""
+    with _pipelines_lock:
+        for pipeline in _pipelines.values():
+            pipeline.stop()
+        _pipelines.clear()
+
+
+def log_stats():
+    """パイプラインごとのキュー長・集約件数・破棄件数"""
+    return {name: pipeline.stats() for name, pipeline in _pipelines.items()}
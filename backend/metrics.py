@@ -0,0 +1,229 @@
+# エンドポイント単位のリクエストメトリクス
+#
+# レイテンシとレスポンスサイズは固定バケットのヒストグラムに数え、
+# p50/p95/p99 はバケットからの線形補間で推定する（Prometheus の
+# histogram_quantile と同じ方法）。記録はエンドポイントごとのロック内で
+# 整数の加算のみを行い、整形は /api/metrics の取得時に行う。
+#
+# SQL発行数・DB時間（query_stats）もエンドポイント単位でここに集計する。
+#
+# 値はプロセスごと。複数ワーカーの場合は Prometheus 側で合算する。
+
+import threading
+from bisect import bisect_left
+
+# レイテンシのバケット上限（秒）
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# レスポンスサイズのバケット上限（バイト）
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+QUANTILES = (0.5, 0.95, 0.99)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+UNMATCHED_ENDPOINT = 'unmatched'  # ルートに一致しないリクエスト（ラベルの種類を増やさないため1つにまとめる）
+
+
+class _EndpointStats:
+    __slots__ = ('lock', 'in_flight', 'statuses', 'durations', 'duration_sum', 'sizes', 'size_sum',
+                 'db_statements', 'db_seconds', 'db_max_statements', 'n_plus_one')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.statuses = {}  # (メソッド, ステータス) -> 件数
+        self.durations = [0] * (len(DURATION_BUCKETS) + 1)  # 末尾は +Inf
+        self.duration_sum = 0.0
+        self.sizes = [0] * (len(SIZE_BUCKETS) + 1)
+        self.size_sum = 0
+        self.db_statements = 0
+        self.db_seconds = 0.0
+        self.db_max_statements = 0  # 1リクエストあたりの最大発行数
+        self.n_plus_one = 0  # N+1 の疑いがあったリクエスト数
+
+
+def estimate_quantile(q, bounds, counts):
+    """バケットごとの件数から分位点を推定（+Inf に入る場合は最大の上限を返す）"""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    cumulative = 0
+    for i, count in enumerate(counts):
+        if cumulative + count >= rank and count:
+            if i == len(bounds):
+                return bounds[-1]
+            lower = bounds[i - 1] if i else 0.0
+            return lower + (bounds[i] - lower) * (rank - cumulative) / count
+        cumulative += count
+    return bounds[-1]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class RequestMetrics:
+    """エンドポイントごとの件数・レイテンシ・レスポンスサイズ・処理中件数"""
+
+    def __init__(self, prefix='timecard'):
+        self.prefix = prefix
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def _stats(self, endpoint):
+        stats = self._endpoints.get(endpoint)
+        if stats is None:
+            with self._lock:
+                stats = self._endpoints.setdefault(endpoint, _EndpointStats())
+        return stats
+
+    def start(self, endpoint):
+        """リクエスト開始（処理中件数を加算）"""
+        stats = self._stats(endpoint)
+        with stats.lock:
+            stats.in_flight += 1
+
+    def finish(self, endpoint, method, status, duration, size=None, started=True):
+        """リクエスト完了を記録（size が不明なストリーミング応答はサイズを数えない）"""
+        stats = self._stats(endpoint)
+        duration_index = bisect_left(DURATION_BUCKETS, duration)
+        size_index = bisect_left(SIZE_BUCKETS, size) if size is not None else None
+        key = (method, status)
+        with stats.lock:
+            if started:
+                stats.in_flight -= 1
+            stats.statuses[key] = stats.statuses.get(key, 0) + 1
+            stats.durations[duration_index] += 1
+            stats.duration_sum += duration
+            if size_index is not None:
+                stats.sizes[size_index] += 1
+                stats.size_sum += size
+
+    def record_queries(self, endpoint, statements, seconds, n_plus_one=False):
+        """1リクエストで発行したSQL文の数とDB時間を記録"""
+        stats = self._stats(endpoint)
+        with stats.lock:
+            stats.db_statements += statements
+            stats.db_seconds += seconds
+            if statements > stats.db_max_statements:
+                stats.db_max_statements = statements
+            if n_plus_one:
+                stats.n_plus_one += 1
+
+    def clear(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def snapshot(self):
+        """エンドポイントごとの値のコピー"""
+        with self._lock:
+            endpoints = list(self._endpoints.items())
+        result = {}
+        for endpoint, stats in sorted(endpoints):
+            with stats.lock:
+                result[endpoint] = {
+                    'in_flight': stats.in_flight,
+                    'statuses': dict(stats.statuses),
+                    'durations': list(stats.durations),
+                    'duration_sum': stats.duration_sum,
+                    'sizes': list(stats.sizes),
+                    'size_sum': stats.size_sum,
+                    'db_statements': stats.db_statements,
+                    'db_seconds': stats.db_seconds,
+                    'db_max_statements': stats.db_max_statements,
+                    'n_plus_one': stats.n_plus_one,
+                }
+        return result
+
+    def summary(self):
+        """エンドポイントごとの件数と p50/p95/p99（秒）"""
+        result = {}
+        for endpoint, stats in self.snapshot().items():
+            count = sum(stats['durations'])
+            result[endpoint] = {
+                'count': count,
+                'in_flight': stats['in_flight'],
+                'mean': stats['duration_sum'] / count if count else None,
+                'db_statements': stats['db_statements'],
+                'db_max_statements': stats['db_max_statements'],
+                'n_plus_one': stats['n_plus_one'],
+            }
+            for q in QUANTILES:
+                result[endpoint][f'p{int(q * 100)}'] = estimate_quantile(q, DURATION_BUCKETS, stats['durations'])
+        return result
+
+    def render_prometheus(self):
+        """Prometheus のテキスト形式で出力"""
+        snapshot = self.snapshot()
+        requests = f'{self.prefix}_http_requests_total'
+        duration = f'{self.prefix}_http_request_duration_seconds'
+        quantile = f'{self.prefix}_http_request_duration_quantile_seconds'
+        size = f'{self.prefix}_http_response_size_bytes'
+        in_flight = f'{self.prefix}_http_requests_in_flight'
+
+        lines = [f'# HELP {requests} Total HTTP requests by endpoint, method and status.',
+                 f'# TYPE {requests} counter']
+        for endpoint, stats in snapshot.items():
+            for (method, status), count in sorted(stats['statuses'].items()):
+                lines.append(f'{requests}{{endpoint="{_escape(endpoint)}",method="{method}",status="{status}"}} {count}')
+
+        lines += [f'# HELP {duration} HTTP request latency by endpoint.', f'# TYPE {duration} histogram']
+        for endpoint, stats in snapshot.items():
+            lines += self._histogram_lines(duration, endpoint, DURATION_BUCKETS, stats['durations'], stats['duration_sum'])
+
+        lines += [f'# HELP {quantile} Estimated latency quantiles by endpoint.', f'# TYPE {quantile} gauge']
+        for endpoint, stats in snapshot.items():
+            for q in QUANTILES:
+                value = estimate_quantile(q, DURATION_BUCKETS, stats['durations'])
+                if value is not None:
+                    lines.append(f'{quantile}{{endpoint="{_escape(endpoint)}",quantile="{q}"}} {_format_value(value)}')
+
+        lines += [f'# HELP {size} HTTP response body size by endpoint.', f'# TYPE {size} histogram']
+        for endpoint, stats in snapshot.items():
+            lines += self._histogram_lines(size, endpoint, SIZE_BUCKETS, stats['sizes'], stats['size_sum'])
+
+        lines += self._per_endpoint_lines(
+            snapshot, in_flight, 'gauge', 'HTTP requests currently being processed.', 'in_flight')
+
+        lines += self._per_endpoint_lines(
+            snapshot, f'{self.prefix}_db_statements_total', 'counter',
+            'SQL statements issued by endpoint.', 'db_statements')
+        lines += self._per_endpoint_lines(
+            snapshot, f'{self.prefix}_db_seconds_total', 'counter',
+            'Time spent executing SQL statements by endpoint.', 'db_seconds')
+        lines += self._per_endpoint_lines(
+            snapshot, f'{self.prefix}_db_statements_per_request_max', 'gauge',
+            'Most SQL statements issued by a single request.', 'db_max_statements')
+        lines += self._per_endpoint_lines(
+            snapshot, f'{self.prefix}_db_n_plus_one_requests_total', 'counter',
+            'Requests that repeated the same SELECT shape (likely N+1).', 'n_plus_one')
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _per_endpoint_lines(snapshot, name, metric_type, help_text, field):
+        lines = [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}']
+        for endpoint, stats in snapshot.items():
+            lines.append(f'{name}{{endpoint="{_escape(endpoint)}"}} {_format_value(stats[field])}')
+        return lines
+
+    @staticmethod
+    def _histogram_lines(name, endpoint, bounds, counts, total):
+        label = f'endpoint="{_escape(endpoint)}"'
+        lines = []
+        cumulative = 0
+        for bound, count in zip(bounds, counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{name}_bucket{{{label},le="+Inf"}} {cumulative}')
+        lines.append(f'{name}_sum{{{label}}} {_format_value(total)}')
+        lines.append(f'{name}_count{{{label}}} {cumulative}')
+        return lines
+
+
+request_metrics = RequestMetrics()
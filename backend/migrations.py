@@ -0,0 +1,254 @@
+# スキーママイグレーション
+#
+# create_all は既存テーブルに新しいインデックスやカラムを追加しないため、
+# 既存データベースへの変更はここにバージョン付きで登録する。
+# 新規データベースでは create_all 済みの変更を検出してスキップする。
+# 複数のプロセス（アプリと CLI 等）が同時に起動しても二重に適用しないよう、
+# 1件ごとに書き込みロック（SQLite は BEGIN IMMEDIATE）を取ってから適用状況を読み直す。
+#
+# 使い方:
+#   python migrations.py          # 未適用のマイグレーションを実行
+#   python migrations.py --status # 適用状況を表示
+#   python migrations.py --backfill-work-date  # time_records.work_date の未設定行を補完
+#   python migrations.py --migrate-photo-store # 平置きの写真を SHA-256 のストアに移動
+#   python migrations.py --archive-photos      # 保存期間を過ぎた写真を月別のパックに移す
+
+import time
+from datetime import datetime
+
+import pytz
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+JST = pytz.timezone('Asia/Tokyo')
+
+SCHEMA_VERSION_TABLE = 'schema_version'
+MIGRATION_LOCK_SECONDS = 600  # 他のプロセスのマイグレーション完了を待つ上限
+
+
+def _create_index(conn, name, table, columns):
+    """インデックスが無ければ作成"""
+    conn.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({", ".join(columns)})'))
+
+
+def _migration_001_hot_query_indexes(conn):
+    """主要クエリ向けの複合インデックスを追加"""
+    _create_index(conn, 'ix_time_records_employee_timestamp', 'time_records', ['employee_id', 'timestamp'])
+    _create_index(conn, 'ix_time_records_timestamp', 'time_records', ['timestamp'])
+    _create_index(conn, 'ix_daily_reports_user_report_date', 'daily_reports', ['user_id', 'report_date'])
+    _create_index(conn, 'ix_daily_reports_report_date', 'daily_reports', ['report_date'])
+    _create_index(conn, 'ix_tag_work_times_user_tag_date', 'tag_work_times', ['user_id', 'tag_id', 'date'])
+    _create_index(conn, 'ix_tag_work_times_date', 'tag_work_times', ['date'])
+    _create_index(conn, 'ix_notifications_user_read_created', 'notifications', ['user_id', 'is_read', 'created_at'])
+
+
+def _add_column(conn, table, column, ddl_type):
+    """カラムが無ければ追加"""
+    columns = {col['name'] for col in inspect(conn).get_columns(table)}
+    if column not in columns:
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl_type}'))
+
+
+def backfill_work_date(conn, batch_size=5000):
+    """work_date が未設定の打刻記録を timestamp（JSTの壁時計時刻で保存）から補完"""
+    total = 0
+    while True:
+        updated = conn.execute(text(
+            'UPDATE time_records SET work_date = substr(timestamp, 1, 10) '
+            'WHERE id IN (SELECT id FROM time_records WHERE work_date IS NULL LIMIT :batch_size)'
+        ), {'batch_size': batch_size}).rowcount
+        total += updated
+        if updated < batch_size:
+            return total
+
+
+def _migration_002_time_record_work_date(conn):
+    """打刻記録に work_date を追加して既存行を補完"""
+    _add_column(conn, 'time_records', 'work_date', 'DATE')
+    _create_index(conn, 'ix_time_records_employee_work_date', 'time_records', ['employee_id', 'work_date'])
+    _create_index(conn, 'ix_time_records_work_date', 'time_records', ['work_date'])
+    backfill_work_date(conn)
+
+
+def _migration_003_daily_attendance(conn):
+    """日次勤怠集計テーブルを作成して全期間を集計"""
+    from models import DailyAttendance
+    from attendance import rebuild_daily_attendance
+
+    DailyAttendance.__table__.create(conn, checkfirst=True)
+    rebuild_daily_attendance(Session(bind=conn))
+
+
+def _migration_004_export_jobs(conn):
+    """エクスポートジョブテーブルを作成"""
+    from models import ExportJob
+
+    ExportJob.__table__.create(conn, checkfirst=True)
+
+
+def _migration_005_time_record_photo_status(conn):
+    """打刻記録に写真の保存状態を追加（保存済みの写真は ready）"""
+    _add_column(conn, 'time_records', 'photo_status', 'VARCHAR(20)')
+    conn.execute(text(
+        "UPDATE time_records SET photo_status = 'ready' "
+        "WHERE photo_path IS NOT NULL AND photo_status IS NULL"
+    ))
+
+
+def _migration_006_photo_blobs(conn):
+    """写真ストアの参照数テーブルを作成（既存ファイルの移動は --migrate-photo-store）"""
+    from models import PhotoBlob
+
+    PhotoBlob.__table__.create(conn, checkfirst=True)
+
+
+def _migration_007_photo_pack_entries(conn):
+    """写真パックの索引テーブルを作成"""
+    from models import PhotoPackEntry
+
+    PhotoPackEntry.__table__.create(conn, checkfirst=True)
+
+
+def _migration_008_export_job_worker(conn):
+    """エクスポートジョブに実行プロセスを追加"""
+    _add_column(conn, 'export_jobs', 'worker', 'VARCHAR(255)')
+
+
+# (バージョン, 説明, 適用関数) の昇順リスト。適用済みの項目は変更しないこと
+MIGRATIONS = [
+    (1, '主要クエリ向け複合インデックスの追加', _migration_001_hot_query_indexes),
+    (2, '打刻記録への work_date カラム追加と補完', _migration_002_time_record_work_date),
+    (3, '日次勤怠集計テーブルの作成と集計', _migration_003_daily_attendance),
+    (4, 'エクスポートジョブテーブルの作成', _migration_004_export_jobs),
+    (5, '打刻記録への photo_status カラム追加', _migration_005_time_record_photo_status),
+    (6, '写真ストアの参照数テーブルの作成', _migration_006_photo_blobs),
+    (7, '写真パックの索引テーブルの作成', _migration_007_photo_pack_entries),
+    (8, 'エクスポートジョブへの worker カラム追加', _migration_008_export_job_worker),
+]
+
+
+def _ensure_version_table(conn):
+    conn.execute(text(
+        f'CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} ('
+        'version INTEGER PRIMARY KEY, '
+        'description VARCHAR(255) NOT NULL, '
+        'applied_at VARCHAR(40) NOT NULL)'
+    ))
+
+
+def _lock_schema(conn, timeout=MIGRATION_LOCK_SECONDS):
+    """トランザクションの開始時に書き込みロックを取る（他のプロセスの適用中は完了まで待つ）"""
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text(f'LOCK TABLE {SCHEMA_VERSION_TABLE} IN EXCLUSIVE MODE'))
+        return
+    if conn.dialect.name != 'sqlite':
+        return
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            # busy_timeout を超える長いマイグレーション（集計の再構築等）の完了も待つ
+            conn.exec_driver_sql('BEGIN IMMEDIATE')
+            return
+        except OperationalError as e:
+            if 'locked' not in str(e) or time.monotonic() >= deadline:
+                raise
+            time.sleep(0.5)
+
+
+def _applied_version(conn):
+    return conn.execute(text(f'SELECT MAX(version) FROM {SCHEMA_VERSION_TABLE}')).scalar() or 0
+
+
+def get_schema_version(db_engine):
+    """適用済みの最新スキーマバージョンを取得（未初期化なら0）"""
+    if not inspect(db_engine).has_table(SCHEMA_VERSION_TABLE):
+        return 0
+    with db_engine.connect() as conn:
+        return _applied_version(conn)
+
+
+def run_migrations(db_engine):
+    """未適用のマイグレーションを1件ずつトランザクション内で適用"""
+    with db_engine.begin() as conn:
+        _ensure_version_table(conn)
+
+    if get_schema_version(db_engine) >= MIGRATIONS[-1][0]:
+        return []
+    applied = []
+    for version, description, upgrade in MIGRATIONS:
+        with db_engine.begin() as conn:
+            _lock_schema(conn)
+            # ロック待ちの間に他のプロセスが適用した場合はスキップ
+            if version <= _applied_version(conn):
+                continue
+            upgrade(conn)
+            conn.execute(
+                text(f'INSERT INTO {SCHEMA_VERSION_TABLE} (version, description, applied_at) '
+                     'VALUES (:version, :description, :applied_at)'),
+                {'version': version, 'description': description,
+                 'applied_at': datetime.now(JST).isoformat()}
+            )
+        applied.append(version)
+    return applied
+
+
+def main():
+    import argparse
+    from database import engine
+
+    parser = argparse.ArgumentParser(description='スキーママイグレーション')
+    parser.add_argument('--status', action='store_true', help='適用状況のみ表示')
+    parser.add_argument('--backfill-work-date', action='store_true', help='work_date の未設定行を補完')
+    parser.add_argument('--migrate-photo-store', action='store_true', help='平置きの写真を SHA-256 のストアに移動')
+    parser.add_argument('--archive-photos', action='store_true', help='保存期間を過ぎた写真を月別のパックに移す')
+    parser.add_argument('--recover-photos', action='store_true',
+                        help='保存が止まった（pending のままの）写真を保存待ちのファイルから保存')
+    parser.add_argument('--retention-days', type=int, default=None,
+                        help='最後の打刻からこの日数を過ぎた写真をパックに移す（既定: PHOTO_RETENTION_DAYS）')
+    parser.add_argument('--upload-folder', default='uploads/photos',
+                        help='写真の保存先（--migrate-photo-store / --archive-photos / --recover-photos 用）')
+    args = parser.parse_args()
+
+    if args.backfill_work_date:
+        with engine.begin() as conn:
+            print(f'work_date を補完した件数: {backfill_work_date(conn)}')
+        return
+
+    if args.migrate_photo_store:
+        from photos import migrate_flat_photos
+
+        run_migrations(engine)
+        result = migrate_flat_photos(engine, args.upload_folder)
+        print('写真ストアへの移行: ' + ', '.join(f'{key}={value}' for key, value in result.items()))
+        return
+
+    if args.recover_photos:
+        from photos import recover_pending_photos
+
+        run_migrations(engine)
+        result = recover_pending_photos(args.upload_folder)
+        print('写真の回復: ' + ', '.join(f'{key}={value}' for key, value in result.items()))
+        return
+
+    if args.archive_photos:
+        from photos import archive_photos, PHOTO_RETENTION_DAYS
+
+        run_migrations(engine)
+        days = PHOTO_RETENTION_DAYS if args.retention_days is None else args.retention_days
+        result = archive_photos(engine, args.upload_folder, days)
+        print('写真のパック: ' + ', '.join(f'{key}={value}' for key, value in result.items()))
+        return
+
+    if not args.status:
+        applied = run_migrations(engine)
+        print(f'適用したマイグレーション: {applied or "なし"}')
+
+    current = get_schema_version(engine)
+    for version, description, _ in MIGRATIONS:
+        mark = '済' if version <= current else '未'
+        print(f'[{mark}] {version:03d} {description}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean, Text, Date, Time, Float
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean, Text, Date, Time, Float, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -59,12 +59,45 @@ class TimeRecord(Base):
     id = Column(Integer, primary_key=True)
     employee_id = Column(String(50), ForeignKey('employees.employee_id'), nullable=False)
     timestamp = Column(DateTime(timezone=True), nullable=False)
+    work_date = Column(Date)  # 打刻時点のJST日付（日単位の集計・検索用）
     record_type = Column(String(20), nullable=False)  # 'check_in' or 'check_out'
-    photo_path = Column(String(255))
+    photo_path = Column(String(255))  # 写真ストアの SHA-256（移行前の記録はファイルパス）
+    photo_status = Column(String(20))  # 'pending' / 'recovering' / 'ready' / 'failed'（写真なしは NULL、photos.py 参照）
     created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(JST))
     
     # リレーション
     employee = relationship('Employee', back_populates='time_records')
+    
+    __table_args__ = (
+        Index('ix_time_records_employee_timestamp', 'employee_id', 'timestamp'),
+        Index('ix_time_records_timestamp', 'timestamp'),
+        Index('ix_time_records_employee_work_date', 'employee_id', 'work_date'),
+        Index('ix_time_records_work_date', 'work_date'),
+    )
+
+
+class DailyAttendance(Base):
+    """日次勤怠集計（打刻ごとに逐次更新、attendance.py で再構築可能）"""
+    __tablename__ = 'daily_attendance'
+    
+    id = Column(Integer, primary_key=True)
+    employee_id = Column(String(50), ForeignKey('employees.employee_id'), nullable=False)
+    work_date = Column(Date, nullable=False)  # 出勤日（日跨ぎの退勤も出勤日に計上）
+    first_check_in = Column(DateTime)
+    last_check_in = Column(DateTime)
+    last_check_out = Column(DateTime)
+    worked_seconds = Column(Integer, nullable=False, default=0)
+    break_seconds = Column(Integer, nullable=False, default=0)
+    punch_count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), default=lambda: datetime.now(JST), onupdate=lambda: datetime.now(JST))
+    
+    # リレーション
+    employee = relationship('Employee')
+    
+    __table_args__ = (
+        UniqueConstraint('employee_id', 'work_date', name='uq_daily_attendance_employee_date'),
+        Index('ix_daily_attendance_work_date', 'work_date'),
+    )
 
 
 class DailyReport(Base):
@@ -86,6 +119,11 @@ class DailyReport(Base):
     # リレーション
     user = relationship('User', back_populates='daily_reports')
     employee = relationship('Employee', back_populates='daily_reports')
+    
+    __table_args__ = (
+        Index('ix_daily_reports_user_report_date', 'user_id', 'report_date'),
+        Index('ix_daily_reports_report_date', 'report_date'),
+    )
 
 
 class WorkStatus(Base):
@@ -115,6 +153,57 @@ class Notification(Base):
     
     # リレーション
     user = relationship('User')
+    
+    __table_args__ = (
+        Index('ix_notifications_user_read_created', 'user_id', 'is_read', 'created_at'),
+    )
+
+
+class PhotoBlob(Base):
+    """写真ストアの実体（SHA-256 ごとに1ファイル、参照する打刻記録の数を保持）"""
+    __tablename__ = 'photo_blobs'
+    
+    digest = Column(String(64), primary_key=True)  # TimeRecord.photo_path に保存する値
+    size = Column(Integer, nullable=False)
+    content_type = Column(String(100))
+    refcount = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(JST))
+
+
+class PhotoPackEntry(Base):
+    """保存期間を過ぎた写真のパック内の位置（元の写真・縮小版ごと）"""
+    __tablename__ = 'photo_pack_entries'
+    
+    digest = Column(String(64), primary_key=True)
+    variant = Column(String(20), primary_key=True)  # original / thumb / display
+    pack = Column(String(7), nullable=False)  # YYYY-MM（uploads/photos/packs/YYYY-MM.pack）
+    offset = Column(Integer, nullable=False)
+    length = Column(Integer, nullable=False)
+
+
+class ExportJob(Base):
+    """バックグラウンドのエクスポートジョブ"""
+    __tablename__ = 'export_jobs'
+    
+    id = Column(String(32), primary_key=True)
+    job_key = Column(String(64), nullable=False)  # 形式と期間のハッシュ（同一条件の成果物の再利用用）
+    format = Column(String(20), nullable=False)
+    start_date = Column(Date)
+    end_date = Column(Date)
+    status = Column(String(20), nullable=False, default='pending')  # pending / running / done / failed
+    total_rows = Column(Integer)
+    rows_written = Column(Integer, nullable=False, default=0)
+    file_path = Column(String(255))
+    error = Column(Text)
+    requested_by = Column(Integer, ForeignKey('users.id'))
+    worker = Column(String(255))  # 実行するプロセス（ホスト名:PID）
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(JST))
+    updated_at = Column(DateTime(timezone=True), default=lambda: datetime.now(JST), onupdate=lambda: datetime.now(JST))
+    finished_at = Column(DateTime(timezone=True))
+    
+    __table_args__ = (
+        Index('ix_export_jobs_job_key', 'job_key', 'status'),
+    )
 
 
 class Tag(Base):
@@ -142,3 +231,8 @@ class TagWorkTime(Base):
 
     user = relationship('User')
     tag = relationship('Tag', back_populates='work_times')
+
+    __table_args__ = (
+        Index('ix_tag_work_times_user_tag_date', 'user_id', 'tag_id', 'date'),
+        Index('ix_tag_work_times_date', 'date'),
+    )
@@ -0,0 +1,832 @@
+# 打刻写真の保存
+#
+# 写真は内容の SHA-256 をキーにしたストア（uploads/photos/ab/cd/<digest>）に保存し、
+# TimeRecord.photo_path には digest を記録する。同じ内容の再送信（端末の再試行等）は
+# 既存のファイルを参照するだけで、photo_blobs の参照数を加算する。
+# 打刻記録や写真を削除する処理は無いため参照数は減らさない（削除を追加する際に、
+# 参照数の減算と 0 件になった写真の削除をその処理と同じトランザクションで行う）。
+# 2階層のシャード（各256）で1ディレクトリあたりのファイル数を抑える。
+#
+# record_time は打刻を先にコミットし、アップロードを保存待ちのファイル
+# （uploads/photos/.spool/<打刻記録ID>.<拡張子>）に書き出してパスを PhotoWriter のキューに渡す。
+# ワーカースレッドが fsync してストアに取り込み（同じファイルシステムのためハードリンク）、
+# TimeRecord.photo_path と photo_status を更新してから保存待ちのファイルを削除する。
+# 写真の fsync が打刻の応答時間と書き込みトランザクションに含まれず、キューは写真を
+# メモリに保持しない。
+#
+# photo_status: pending（保存待ち）/ ready（保存済み）/ failed（保存失敗）。写真なしは NULL。
+#
+# キューは PHOTO_QUEUE_SIZE 件で上限とし、満杯の場合は submit が False を返すので
+# 呼び出し元がコミット後に同期で保存する。終了時はキューに残った写真を書き出してから停止する。
+# プロセスの停止等で PHOTO_STALE_SECONDS 秒を過ぎても pending の記録は、起動時と
+# python migrations.py --recover-photos で recover_pending_photos が保存待ちのファイルから保存し、
+# 無ければ failed にする。回復は記録を pending -> recovering に更新できた場合だけ行い、
+# ワーカーの反映は pending の記録に限るため、同じ記録を両方が反映することはない。
+#
+# 一覧表示用に縮小版（thumb: 一覧のサムネイル / display: 画面表示用）を WebP で
+# 元の写真と同じディレクトリ（<digest>.thumb.webp 等）に作る。保存時にワーカーが作成し、
+# 無い場合（移行した写真・同期保存した写真）は初回の要求時に作成する。
+# 画像として読めない写真は縮小版を作らず、元の写真を返す。
+#
+# 配信: ストアの写真は内容が変わらないため、digest（縮小版は digest.サイズ）を強い ETag とし、
+# Cache-Control: private, immutable で1年キャッシュさせる。If-None-Match が一致すれば
+# ファイルに触れずに 304 を返し、Range には send_file が 206 で応える。
+# 保存済みの打刻記録 -> digest は PhotoIndex に保持し、再表示では DB を参照しない。
+# PHOTO_SEND_MODE=x-accel（nginx）/ x-sendfile（Apache 等）ではファイルのパスだけを
+# ヘッダーで返し、本体の送信はフロントのWebサーバーが行う。
+#
+# 保存期間: 最後の打刻から PHOTO_RETENTION_DAYS 日を過ぎた写真（縮小版を含む）は
+# python migrations.py --archive-photos で打刻月ごとのパック（uploads/photos/packs/YYYY-MM.pack）に
+# 追記し、ばらのファイルを削除する（ファイル数とバックアップ時間の削減）。パック内の位置は
+# photo_pack_entries に記録し、配信時はパックを mmap して該当範囲だけを読み出す。
+#
+# 従来の平置き（{従業員ID}_{時刻}_{ファイル名}）の写真は
+# python migrations.py --migrate-photo-store でストアに移動する。
+
+import atexit
+import hashlib
+import io
+import logging
+import mimetypes
+import mmap
+import os
+import queue
+import re
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import pytz
+from flask import Response, request, send_file
+from PIL import Image, ImageOps
+from sqlalchemy import and_, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from werkzeug.wsgi import wrap_file
+
+from database import get_db_session
+from models import TimeRecord, PhotoBlob, PhotoPackEntry
+
+logger = logging.getLogger(__name__)
+JST = pytz.timezone('Asia/Tokyo')
+
+PHOTO_QUEUE_SIZE = int(os.environ.get('PHOTO_QUEUE_SIZE', 16))
+PHOTO_WRITERS = int(os.environ.get('PHOTO_WRITERS', 1))
+PHOTO_STALE_SECONDS = int(os.environ.get('PHOTO_STALE_SECONDS', 300))
+SPOOL_FOLDER = '.spool'
+
+PHOTO_PENDING = 'pending'
+PHOTO_RECOVERING = 'recovering'  # recover_pending_photos が保存中
+PHOTO_READY = 'ready'
+PHOTO_FAILED = 'failed'
+
+PHOTO_DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+# 縮小版の名前 -> 長辺の最大ピクセル数
+PHOTO_DERIVATIVES = {
+    'thumb': int(os.environ.get('PHOTO_THUMB_PX', 240)),
+    'display': int(os.environ.get('PHOTO_DISPLAY_PX', 1280)),
+}
+PHOTO_WEBP_QUALITY = int(os.environ.get('PHOTO_WEBP_QUALITY', 75))
+DERIVATIVE_CONTENT_TYPE = 'image/webp'
+
+PHOTO_SEND_MODES = ('direct', 'x-accel', 'x-sendfile')
+PHOTO_SEND_MODE = os.environ.get('PHOTO_SEND_MODE', 'direct')
+PHOTO_ACCEL_PREFIX = os.environ.get('PHOTO_ACCEL_PREFIX', '/protected-photos/')
+PHOTO_CACHE_MAX_AGE = 365 * 24 * 3600
+PHOTO_INDEX_SIZE = int(os.environ.get('PHOTO_INDEX_SIZE', 10000))
+PHOTO_RETENTION_DAYS = int(os.environ.get('PHOTO_RETENTION_DAYS', 90))
+PACK_FOLDER = 'packs'
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def is_photo_digest(value):
+    """photo_path がストアの digest か（移行前の記録はファイルパス）"""
+    return bool(value) and PHOTO_DIGEST.match(value) is not None
+
+
+def guess_content_type(filename):
+    return mimetypes.guess_type(filename)[0] if filename else None
+
+
+def _fsync_directory(directory):
+    # rename をディスクに反映させる（ディレクトリを開けない環境では省略）
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _write_atomic(path, write):
+    """同じディレクトリの一時ファイルに write(f) で書き込んで fsync し、path に rename"""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _fsync_directory(directory)
+
+
+def write_file_atomic(path, data):
+    """バイト列を path に原子的に保存"""
+    def write(f):
+        view = memoryview(data)
+        for offset in range(0, len(view), _CHUNK_SIZE):
+            f.write(view[offset:offset + _CHUNK_SIZE])
+    _write_atomic(path, write)
+
+
+def _fsync_file(path):
+    with open(path, 'r+b') as f:
+        os.fsync(f.fileno())
+
+
+def _discard(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def file_digest(path):
+    """ファイルの SHA-256（チャンク単位で読み出し）"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def render_derivative(source, path, max_px, quality=PHOTO_WEBP_QUALITY):
+    """長辺 max_px に縮小した WebP を path に保存（画像として読めなければ False）"""
+    try:
+        with Image.open(source) as image:
+            # JPEG は縮小率に応じて間引いてデコードする（フル解像度に展開しない）
+            image.draft('RGB', (max_px, max_px))
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGB')
+            image.thumbnail((max_px, max_px), Image.Resampling.LANCZOS)
+            _write_atomic(path, lambda f: image.save(f, 'WEBP', quality=quality, method=4))
+        return True
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.warning('Could not render %s derivative of %s: %s', os.path.basename(path), source, e)
+        return False
+
+
+class PhotoStore:
+    """SHA-256 をキーにした写真ファイルの置き場（root/ab/cd/<digest>）"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def resolve(self, photo_path):
+        """photo_path（digest または移行前のファイルパス）から実ファイルのパス"""
+        return self.path(photo_path) if is_photo_digest(photo_path) else photo_path
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def derivative_path(self, digest, size):
+        return f'{self.path(digest)}.{size}.webp'
+
+    def derivative(self, digest, size):
+        """縮小版のパス（無ければ作成、作れない写真は None）"""
+        path = self.derivative_path(digest, size)
+        if os.path.exists(path):
+            return path
+        if not self.exists(digest):
+            return None  # パック済み
+        return path if render_derivative(self.path(digest), path, PHOTO_DERIVATIVES[size]) else None
+
+    def create_derivatives(self, digest):
+        """すべての縮小版を作成（画像として読めなければ何もしない）"""
+        for size in PHOTO_DERIVATIVES:
+            if self.derivative(digest, size) is None:
+                return False
+        return True
+
+    def spool_path(self, record_id, extension=''):
+        return os.path.join(self.root, SPOOL_FOLDER, f'{record_id}{extension}')
+
+    def spool(self, record_id, stream, extension=''):
+        """アップロードを保存待ちのファイルに書き出す（fsync はストアへの取り込み時に行う）"""
+        path = self.spool_path(record_id, extension)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(stream, f, _CHUNK_SIZE)
+            os.replace(tmp_path, path)
+        except BaseException:
+            _discard(tmp_path)
+            raise
+        return path
+
+    def put(self, data):
+        """保存して (digest, 新規に書き込んだか) を返す（同じ内容が既にあれば書き込まない）"""
+        digest = hashlib.sha256(data).hexdigest()
+        if self.exists(digest):
+            return digest, False
+        write_file_atomic(self.path(digest), data)
+        return digest, True
+
+    def put_file(self, source):
+        """既存ファイルを取り込んで (digest, 新規に取り込んだか) を返す（元のファイルは残す）"""
+        digest = file_digest(source)
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            # 同じファイルシステムならハードリンクで複製せずに取り込む
+            os.link(source, path)
+            _fsync_directory(os.path.dirname(path))
+        except FileExistsError:
+            return digest, False
+        except OSError:
+            with open(source, 'rb') as src:
+                _write_atomic(path, lambda f: shutil.copyfileobj(src, f, _CHUNK_SIZE))
+        return digest, True
+
+    def files(self, digest):
+        """(variant, パス) の一覧（元の写真と作成済みの縮小版）"""
+        files = [('original', self.path(digest))]
+        files += [(size, self.derivative_path(digest, size)) for size in PHOTO_DERIVATIVES]
+        return [(variant, path) for variant, path in files if os.path.exists(path)]
+
+    def remove(self, digest):
+        removed = 0
+        for _, path in self.files(digest):
+            os.remove(path)
+            removed += 1
+        return removed
+
+    def pack_path(self, pack):
+        return os.path.join(self.root, PACK_FOLDER, f'{pack}.pack')
+
+
+class _MappedFile(io.RawIOBase):
+    """mmap の一部を読み出し専用のファイルとして扱う（Range はシークして必要な範囲だけ読む）"""
+
+    def __init__(self, view):
+        super().__init__()
+        self._view = view
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        chunk = self._view[self._position:self._position + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        self._view.release()
+        super().close()
+
+
+class PhotoPacks:
+    """パックファイルの mmap を保持し、写真1件分の範囲を複製せずに参照する"""
+
+    def __init__(self):
+        self._maps = {}  # パックのパス -> mmap
+        self._lock = threading.Lock()
+
+    def _map(self, path, end):
+        with self._lock:
+            mapped = self._maps.get(path)
+            if mapped is None or end > len(mapped):
+                # 初回、またはマップ後にパックへ追記された範囲。古い mmap は
+                # 配信中の memoryview が参照している可能性があるため閉じない（解放は GC）
+                try:
+                    with open(path, 'rb') as f:
+                        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    # 空のパック（作成直後に止まった追記）
+                    raise FileNotFoundError(f'{path} is empty')
+                self._maps[path] = mapped
+            if end > len(mapped):
+                raise FileNotFoundError(f'{path} is shorter than {end} bytes')
+            return mapped
+
+    def read(self, path, offset, length):
+        """パックの offset から length バイトの memoryview（パックが無い・短い場合は FileNotFoundError）"""
+        return memoryview(self._map(path, offset + length))[offset:offset + length]
+
+    def open(self, path, offset, length):
+        """read の範囲を読み出し専用のファイルとして開く"""
+        return _MappedFile(self.read(path, offset, length))
+
+    def clear(self):
+        with self._lock:
+            self._maps.clear()
+
+
+photo_packs = PhotoPacks()
+
+
+class PhotoIndex:
+    """保存済みの打刻記録 ID -> (digest, content_type) の LRU（digest の記録は変わらないため無効化しない）"""
+
+    def __init__(self, max_entries=PHOTO_INDEX_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, record_id):
+        with self._lock:
+            entry = self._entries.get(record_id)
+            if entry is not None:
+                self._entries.move_to_end(record_id)
+            return entry
+
+    def put(self, record_id, digest, content_type):
+        with self._lock:
+            self._entries[record_id] = (digest, content_type)
+            self._entries.move_to_end(record_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+photo_index = PhotoIndex()
+
+
+def photo_etag(digest, size='original'):
+    """写真の強い ETag（縮小版はサイズ名を付ける）"""
+    return digest if size == 'original' else f'{digest}.{size}'
+
+
+def _set_cache_headers(response, etag):
+    response.set_etag(etag)
+    response.cache_control.no_cache = None
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = PHOTO_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+def not_modified(etag):
+    """If-None-Match が一致した場合の 304"""
+    return _set_cache_headers(Response(status=304), etag)
+
+
+def send_photo(path, root, mimetype=None, etag=None, mode=PHOTO_SEND_MODE, accel_prefix=PHOTO_ACCEL_PREFIX):
+    """写真を返す（direct は send_file、x-accel / x-sendfile はパスのヘッダーのみ）
+
+    etag が無い（移行前の平置きの写真）場合は send_file 既定の ETag でキャッシュ期間は付けない。
+    ファイルが無い（パック済みを含む）場合は FileNotFoundError。
+    """
+    relative = os.path.relpath(path, root)
+    if mode in ('x-accel', 'x-sendfile') and not relative.startswith('..'):
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        response = Response(mimetype=mimetype or guess_content_type(path) or 'application/octet-stream')
+        if mode == 'x-accel':
+            response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + relative.replace(os.sep, '/')
+        else:
+            response.headers['X-Sendfile'] = os.path.abspath(path)
+    else:
+        response = send_file(os.path.abspath(path), mimetype=mimetype, etag=etag or True, conditional=True)
+    if etag:
+        _set_cache_headers(response, etag)
+    return response
+
+
+def find_packed_photo(db_session, digest, size='original'):
+    """パック済みの写真の位置（縮小版がパックに無ければ元の写真、無ければ None）"""
+    variants = [size, 'original'] if size != 'original' else ['original']
+    entries = {entry.variant: entry for entry in db_session.query(PhotoPackEntry).filter(
+        PhotoPackEntry.digest == digest, PhotoPackEntry.variant.in_(variants))}
+    return next((entries[variant] for variant in variants if variant in entries), None)
+
+
+def send_packed_photo(store, entry, content_type=None, packs=photo_packs):
+    """パックから読み出して返す（Range・条件付きリクエストはストアの写真と同じ扱い）"""
+    photo = packs.open(store.pack_path(entry.pack), entry.offset, entry.length)
+    mimetype = content_type if entry.variant == 'original' else DERIVATIVE_CONTENT_TYPE
+    etag = photo_etag(entry.digest, entry.variant)
+    # send_file はファイルオブジェクトの長さを扱えないため、同じ処理を長さを指定して行う
+    response = Response(wrap_file(request.environ, photo), mimetype=mimetype or 'application/octet-stream',
+                        direct_passthrough=True)
+    response.content_length = entry.length
+    _set_cache_headers(response, etag)
+    return response.make_conditional(request, accept_ranges=True, complete_length=entry.length)
+
+
+def add_reference(db_session, digest, size, content_type=None):
+    """photo_blobs の参照数を加算（無ければ作成）。コミットは呼び出し元"""
+    updated = db_session.query(PhotoBlob).filter_by(digest=digest).update(
+        {'refcount': PhotoBlob.refcount + 1}, synchronize_session=False)
+    if not updated:
+        db_session.add(PhotoBlob(digest=digest, size=size, content_type=content_type, refcount=1))
+        db_session.flush()
+
+
+def attach_photo(record_id, digest, status, size=0, content_type=None, claimed=PHOTO_PENDING):
+    """打刻記録に保存結果を反映し、保存できた場合は写真の参照数を加算
+
+    photo_status が claimed の記録だけを更新し、他の処理が反映・回復中の記録なら False を返す。
+    """
+    for attempt in range(2):
+        db_session = get_db_session()
+        try:
+            updated = db_session.query(TimeRecord).filter_by(id=record_id, photo_status=claimed).update(
+                {'photo_path': digest, 'photo_status': status}, synchronize_session=False)
+            if not updated:
+                db_session.rollback()
+                return False
+            if digest is not None:
+                add_reference(db_session, digest, size, content_type)
+            db_session.commit()
+            return True
+        except IntegrityError:
+            # 同じ内容の写真を別のスレッドが同時に登録した場合は加算でやり直す
+            db_session.rollback()
+            if attempt:
+                raise
+        finally:
+            db_session.close()
+
+
+class PhotoWriter:
+    """上限付きキューとワーカースレッドによる写真の保存"""
+
+    def __init__(self, queue_size=PHOTO_QUEUE_SIZE, workers=PHOTO_WRITERS, attach=attach_photo):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.workers = workers
+        self.attach = attach
+        self._threads = []
+        self._lock = threading.Lock()
+        self._owned = set()  # キュー内・保存中の打刻記録ID
+        self.written = 0
+        self.deduplicated = 0
+        self.failed = 0
+        self.rejected = 0  # キュー満杯で呼び出し元に戻した件数
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'photo-writer-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, record_id, store, spool_path, content_type=None):
+        """保存待ちのファイルの保存を予約（キューが満杯なら False）"""
+        self._start()
+        with self._lock:
+            self._owned.add(record_id)
+        try:
+            self.queue.put_nowait((record_id, store, spool_path, content_type))
+            return True
+        except queue.Full:
+            with self._lock:
+                self._owned.discard(record_id)
+            self.rejected += 1
+            return False
+
+    def owned_ids(self):
+        """このプロセスのワーカーが保存する予定・保存中の打刻記録ID"""
+        with self._lock:
+            return set(self._owned)
+
+    def write(self, record_id, store, spool_path, content_type=None, derivatives=True, claimed=PHOTO_PENDING):
+        """保存待ちのファイルをストアに取り込んで打刻記録に反映（ワーカー・同期保存・回復の共通処理）
+
+        derivatives=False（リクエストスレッドでの同期保存）の場合、縮小版は初回の要求時に作る。
+        打刻記録への反映が失敗した場合は保存待ちのファイルを残し、recover_pending_photos で再度取り込む。
+        記録が claimed の状態でなくなっていた（回復処理が引き継いだ）場合は何も反映せず、
+        保存待ちのファイルも引き継いだ側に残す。
+        """
+        try:
+            size = os.path.getsize(spool_path)
+            _fsync_file(spool_path)
+            digest, created = store.put_file(spool_path)
+        except OSError:
+            logger.exception('Failed to save photo for time record %s', record_id)
+            self.failed += 1
+            if self.attach(record_id, None, PHOTO_FAILED, 0, None, claimed):
+                _discard(spool_path)
+            return False
+        if derivatives:
+            store.create_derivatives(digest)
+        if not self.attach(record_id, digest, PHOTO_READY, size, content_type, claimed):
+            return False
+        _discard(spool_path)
+        if created:
+            self.written += 1
+        else:
+            self.deduplicated += 1
+        return True
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                self.write(*job)
+            except Exception:
+                logger.exception('Photo writer error for time record %s', job[0])
+            finally:
+                with self._lock:
+                    self._owned.discard(job[0])
+                self.queue.task_done()
+
+    def join(self):
+        """キューに積まれた写真がすべて保存されるまで待つ"""
+        if self._threads:
+            self.queue.join()
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'capacity': self.queue.maxsize,
+            'written': self.written,
+            'deduplicated': self.deduplicated,
+            'failed': self.failed,
+            'rejected': self.rejected,
+        }
+
+
+photo_writer = PhotoWriter()
+atexit.register(photo_writer.join)
+
+
+def _is_stale(timestamp, seconds=PHOTO_STALE_SECONDS):
+    stale_before = datetime.now(JST).replace(tzinfo=None) - timedelta(seconds=seconds)
+    return timestamp.replace(tzinfo=None) < stale_before
+
+
+def is_stale_pending(timestamp, seconds=PHOTO_STALE_SECONDS):
+    """pending のまま seconds 秒を過ぎた打刻か（保存が止まった写真）"""
+    return timestamp is not None and _is_stale(timestamp, seconds)
+
+
+def _claim_pending(record_id):
+    """pending の記録を recovering に更新（他の処理が先に反映・回復していれば False）"""
+    db_session = get_db_session()
+    try:
+        claimed = db_session.query(TimeRecord).filter_by(id=record_id, photo_status=PHOTO_PENDING).update(
+            {'photo_status': PHOTO_RECOVERING}, synchronize_session=False)
+        db_session.commit()
+        return bool(claimed)
+    finally:
+        db_session.close()
+
+
+def recover_pending_photos(upload_folder, stale_seconds=PHOTO_STALE_SECONDS, record_ids=None, writer=None):
+    """pending のまま stale_seconds 秒を過ぎた打刻の写真を保存待ちのファイルから保存（無ければ failed）
+
+    record_ids を指定した場合はその打刻のみ。writer のキュー内・保存中の打刻は対象外とし、
+    記録を recovering に更新できた打刻だけを保存する（他のプロセスのワーカー・回復処理と重複しない）。
+    古い保存待ちのファイルで対応する pending の打刻が無いもの（書き出し途中で止まった一時ファイル、
+    反映後に削除できなかったファイル）は削除する。
+    """
+    writer = writer or photo_writer
+    store = PhotoStore(upload_folder)
+    spool_folder = os.path.join(upload_folder, SPOOL_FOLDER)
+    result = {'recovered': 0, 'failed': 0, 'removed_spools': 0}
+
+    db_session = get_db_session()
+    try:
+        query = db_session.query(TimeRecord.id, TimeRecord.timestamp, TimeRecord.photo_status).filter(
+            TimeRecord.photo_status.in_([PHOTO_PENDING, PHOTO_RECOVERING]))
+        if record_ids is not None:
+            query = query.filter(TimeRecord.id.in_(record_ids))
+        rows = query.all()
+    finally:
+        db_session.close()
+    owned = writer.owned_ids()
+    unfinished = {str(record_id) for record_id, _, _ in rows}
+    stale = [record_id for record_id, timestamp, status in rows
+             if status == PHOTO_PENDING and record_id not in owned and is_stale_pending(timestamp, stale_seconds)]
+
+    spools = {}
+    if os.path.isdir(spool_folder):
+        for name in os.listdir(spool_folder):
+            spools.setdefault(name.split('.', 1)[0], []).append(name)
+
+    for record_id in stale:
+        if not _claim_pending(record_id):
+            continue
+        names = spools.get(str(record_id), [])
+        if names and writer.write(record_id, store, os.path.join(spool_folder, names[0]),
+                                  guess_content_type(names[0]), derivatives=False, claimed=PHOTO_RECOVERING):
+            result['recovered'] += 1
+            continue
+        if not names:
+            writer.attach(record_id, None, PHOTO_FAILED, 0, None, PHOTO_RECOVERING)
+        result['failed'] += 1
+
+    if record_ids is None:
+        for key, names in spools.items():
+            if key in unfinished:
+                continue
+            for name in names:
+                path = os.path.join(spool_folder, name)
+                try:
+                    modified = datetime.fromtimestamp(os.path.getmtime(path), JST)
+                except FileNotFoundError:
+                    continue
+                if _is_stale(modified, stale_seconds):
+                    _discard(path)
+                    result['removed_spools'] += 1
+    if result['recovered'] or result['failed']:
+        logger.warning('Recovered stale pending photos: %s', result)
+    return result
+
+
+def migrate_flat_photos(db_engine, upload_folder, batch_size=500):
+    """平置きの写真をストアに取り込み、photo_path を digest に書き換えて元ファイルを削除
+
+    記録の書き換えをコミットしてから元ファイルを削除するため、途中で止まっても
+    再実行で続きから移行できる。どの記録からも参照されていない平置きファイルは、
+    内容がストアにある場合のみ削除する。
+    """
+    store = PhotoStore(upload_folder)
+    result = {'migrated': 0, 'deduplicated': 0, 'missing': 0, 'removed_leftovers': 0}
+    migrated_paths = {}  # 元のパス -> digest（複数の記録が同じファイルを指す場合）
+    last_id = 0
+
+    while True:
+        with Session(bind=db_engine) as db_session:
+            records = db_session.query(TimeRecord.id, TimeRecord.photo_path).filter(
+                TimeRecord.id > last_id, TimeRecord.photo_path.isnot(None)
+            ).order_by(TimeRecord.id).limit(batch_size).all()
+            if not records:
+                break
+            last_id = records[-1].id
+
+            sources = []
+            for record_id, photo_path in records:
+                if is_photo_digest(photo_path):
+                    continue
+                digest = migrated_paths.get(photo_path)
+                if digest is None:
+                    if not os.path.isfile(photo_path):
+                        result['missing'] += 1
+                        continue
+                    digest, created = store.put_file(photo_path)
+                    migrated_paths[photo_path] = digest
+                    sources.append(photo_path)
+                    result['migrated' if created else 'deduplicated'] += 1
+                else:
+                    result['deduplicated'] += 1
+                db_session.query(TimeRecord).filter_by(id=record_id).update(
+                    {'photo_path': digest}, synchronize_session=False)
+                add_reference(db_session, digest, os.path.getsize(store.path(digest)),
+                              guess_content_type(photo_path))
+            db_session.commit()
+
+        for source in sources:
+            os.remove(source)
+
+    # 記録のコミット後・削除前に止まった場合の残りファイル
+    if os.path.isdir(upload_folder):
+        with Session(bind=db_engine) as db_session:
+            referenced = {os.path.realpath(path) for (path,) in db_session.query(TimeRecord.photo_path).filter(
+                TimeRecord.photo_path.isnot(None)) if not is_photo_digest(path)}
+        for name in os.listdir(upload_folder):
+            path = os.path.join(upload_folder, name)
+            if name.startswith('.') or not os.path.isfile(path) or os.path.realpath(path) in referenced:
+                continue
+            if store.exists(file_digest(path)):
+                os.remove(path)
+                result['removed_leftovers'] += 1
+    return result
+
+
+def _append_to_pack(handles, store, pack, source):
+    """パックの末尾にファイルを追記して (offset, length) を返す"""
+    f = handles.get(pack)
+    if f is None:
+        f = handles[pack] = open(store.pack_path(pack), 'ab')
+    offset = f.tell()
+    with open(source, 'rb') as src:
+        shutil.copyfileobj(src, f, _CHUNK_SIZE)
+    return offset, f.tell() - offset
+
+
+def _lock_packs(pack_folder):
+    """パックへの追記の排他ロック（packs/.lock）を取得してファイル記述子を返す。close で解放"""
+    fd = os.open(os.path.join(pack_folder, '.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            import fcntl
+        except ImportError:
+            # Windows（開発環境）: 先頭1バイトのロック
+            import msvcrt
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def archive_photos(db_engine, upload_folder, older_than_days=PHOTO_RETENTION_DAYS, batch_size=200, today=None):
+    """最後の打刻から older_than_days 日を過ぎた写真を打刻月のパックに移し、ばらのファイルを削除
+
+    縮小版を作成してから元の写真とともにパックへ追記し、fsync して索引をコミットしてから
+    ファイルを削除する。途中で止まってもパックの末尾に未使用の領域が残るだけで、
+    再実行で続きから移す（パック済みで残ったファイルは削除のみ行う）。
+    同時に実行された場合は先の実行が終わるまで待つ。
+    """
+    store = PhotoStore(upload_folder)
+    cutoff = (today or datetime.now(JST).date()) - timedelta(days=older_than_days)
+    result = {'archived': 0, 'missing': 0, 'files_removed': 0, 'bytes': 0}
+    pack_folder = os.path.join(upload_folder, PACK_FOLDER)
+    os.makedirs(pack_folder, exist_ok=True)
+    lock_fd = _lock_packs(pack_folder)
+    try:
+        last_digest = ''
+        while True:
+            with Session(bind=db_engine) as db_session:
+                last_used = func.max(TimeRecord.work_date)
+                candidates = db_session.query(TimeRecord.photo_path, last_used, PhotoPackEntry.pack).join(
+                    PhotoBlob, PhotoBlob.digest == TimeRecord.photo_path
+                ).outerjoin(PhotoPackEntry, and_(
+                    PhotoPackEntry.digest == TimeRecord.photo_path, PhotoPackEntry.variant == 'original')
+                ).filter(
+                    TimeRecord.photo_path > last_digest
+                ).group_by(TimeRecord.photo_path, PhotoPackEntry.pack).having(last_used < cutoff).order_by(
+                    TimeRecord.photo_path).limit(batch_size).all()
+                if not candidates:
+                    break
+                last_digest = candidates[-1][0]
+
+                handles = {}  # パック名 -> 追記用のファイル
+                archived, packed = [], []
+                try:
+                    for digest, work_date, packed_into in candidates:
+                        if packed_into:
+                            packed.append(digest)
+                            continue
+                        if not store.exists(digest):
+                            result['missing'] += 1
+                            continue
+                        store.create_derivatives(digest)
+                        pack = work_date.strftime('%Y-%m')
+                        for variant, path in store.files(digest):
+                            offset, length = _append_to_pack(handles, store, pack, path)
+                            db_session.add(PhotoPackEntry(digest=digest, variant=variant, pack=pack,
+                                                          offset=offset, length=length))
+                            result['bytes'] += length
+                        archived.append(digest)
+                    for f in handles.values():
+                        f.flush()
+                        os.fsync(f.fileno())
+                finally:
+                    for f in handles.values():
+                        f.close()
+                if handles:
+                    _fsync_directory(pack_folder)
+                db_session.commit()
+
+            for digest in archived + packed:
+                result['files_removed'] += store.remove(digest)
+            result['archived'] += len(archived)
+    finally:
+        os.close(lock_fd)
+    return result
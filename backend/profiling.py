@@ -0,0 +1,200 @@
+# 稼働中リクエストのプロファイリング（管理者向け）
+#
+# 管理者のセッションで X-Profile: 1 ヘッダーを付けたリクエスト、または
+# PROFILE_SAMPLE_RATE の割合で抽出したリクエストを cProfile で計測し、
+# logs/profiles/ に pstats のダンプ（.prof）と flamegraph 用の
+# collapsed stack（.collapsed、flamegraph.pl / speedscope で表示）を保存する。
+# ストリーミング応答（CSVエクスポート等）はボディの送信完了まで計測する。
+#
+# Python 3.12 以降の cProfile はプロセス全体の sys.monitoring を使い、同時に1つしか
+# 有効にできないため、計測は1リクエストずつとし、計測中に来たリクエストは計測しない
+# （ヘッダー指定の場合は X-Profile-Skipped: busy を返す）。
+#
+# cProfile は呼び出し元→呼び出し先の辺しか持たないため、collapsed stack は
+# 辺の累積時間の比率で各経路に時間を按分した近似になる。
+
+import cProfile
+import os
+import pstats
+import random
+import re
+import threading
+import uuid
+from datetime import datetime
+
+import pytz
+from flask import g, request, session
+
+JST = pytz.timezone('Asia/Tokyo')
+
+PROFILE_DIR = os.path.join(os.environ.get('LOG_DIR', 'logs'), 'profiles')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 50))
+PROFILE_HEADER = 'X-Profile'
+
+PROFILE_NAME = re.compile(r'^[0-9]{8}T[0-9]{6}_[A-Za-z0-9_.-]+_[0-9a-f]{8}$')
+_MAX_STACK_DEPTH = 64
+
+_write_lock = threading.Lock()
+_profile_lock = threading.Lock()  # 計測中のリクエスト（1件のみ）
+
+
+def _frame_name(func):
+    filename, line, name = func
+    if filename == '~':
+        return name  # 組み込み関数
+    return f'{name} ({os.path.basename(filename)}:{line})'
+
+
+def collapsed_stacks(stats):
+    """pstats の呼び出しグラフから collapsed stack（'a;b;c 自身の時間[µs]'）の行を生成"""
+    children = {}
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            children.setdefault(caller, []).append((func, edge[3]))
+
+    totals = {}
+    roots = [func for func, entry in stats.stats.items() if not entry[4]]
+
+    def walk(func, path, fraction):
+        _, _, self_time, cumulative, _ = stats.stats[func]
+        path = path + (func,)
+        weight = self_time * fraction
+        if weight > 0:
+            key = ';'.join(_frame_name(f) for f in path)
+            totals[key] = totals.get(key, 0.0) + weight
+        if len(path) >= _MAX_STACK_DEPTH:
+            return
+        for child, edge_cumulative in children.get(func, ()):
+            child_cumulative = stats.stats[child][3]
+            if child in path or not child_cumulative:
+                continue
+            walk(child, path, fraction * min(1.0, edge_cumulative / child_cumulative))
+
+    for root in roots:
+        walk(root, (), 1.0)
+
+    return [f'{stack} {round(seconds * 1e6)}' for stack, seconds in totals.items() if round(seconds * 1e6) > 0]
+
+
+def _prune(profile_dir, max_files):
+    """古いプロファイルを削除して max_files 件に保つ"""
+    names = sorted({os.path.splitext(name)[0] for name in os.listdir(profile_dir)
+                    if PROFILE_NAME.match(os.path.splitext(name)[0])})
+    for name in names[:max(0, len(names) - max_files)]:
+        for ext in ('.prof', '.collapsed'):
+            path = os.path.join(profile_dir, name + ext)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def profile_name(endpoint):
+    """保存ファイル名の基部（時刻_エンドポイント_ID）"""
+    return '{}_{}_{}'.format(
+        datetime.now(JST).strftime('%Y%m%dT%H%M%S'),
+        re.sub(r'[^A-Za-z0-9_.-]', '_', endpoint or 'unmatched'),
+        uuid.uuid4().hex[:8]
+    )
+
+
+def save_profile(profiler, profile_dir, name, max_files=PROFILE_MAX_FILES):
+    """pstats ダンプと collapsed stack を保存"""
+    stats = pstats.Stats(profiler)
+    with _write_lock:
+        os.makedirs(profile_dir, exist_ok=True)
+        stats.dump_stats(os.path.join(profile_dir, name + '.prof'))
+        with open(os.path.join(profile_dir, name + '.collapsed'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(collapsed_stacks(stats)) + '\n')
+        _prune(profile_dir, max_files)
+
+
+def list_profiles(profile_dir):
+    """保存済みのプロファイル（新しい順）"""
+    if not os.path.isdir(profile_dir):
+        return []
+    profiles = []
+    for filename in os.listdir(profile_dir):
+        name, ext = os.path.splitext(filename)
+        if ext != '.prof' or not PROFILE_NAME.match(name):
+            continue
+        stat = os.stat(os.path.join(profile_dir, filename))
+        created, endpoint, _ = name[:15], name[16:-9], name[-8:]
+        profiles.append({
+            'name': name,
+            'endpoint': endpoint,
+            'created_at': datetime.strptime(created, '%Y%m%dT%H%M%S').isoformat(),
+            'size': stat.st_size,
+            'files': [name + '.prof', name + '.collapsed'],
+        })
+    profiles.sort(key=lambda profile: profile['name'], reverse=True)
+    return profiles
+
+
+def profile_path(profile_dir, filename):
+    """ダウンロード対象のファイルパス（名前が不正・存在しない場合は None）"""
+    name, ext = os.path.splitext(filename)
+    if ext not in ('.prof', '.collapsed') or not PROFILE_NAME.match(name):
+        return None
+    path = os.path.join(profile_dir, filename)
+    return path if os.path.exists(path) else None
+
+
+def init_profiling(app):
+    """ヘッダー指定（管理者のみ）またはサンプリングでリクエストをプロファイル"""
+    app.config.setdefault('PROFILE_DIR', PROFILE_DIR)
+    app.config.setdefault('PROFILE_SAMPLE_RATE', PROFILE_SAMPLE_RATE)
+
+    @app.before_request
+    def start_profiling():
+        requested = request.headers.get(PROFILE_HEADER) == '1' and session.get('is_admin', False)
+        sample_rate = app.config['PROFILE_SAMPLE_RATE']
+        if not (requested or (sample_rate and random.random() < sample_rate)):
+            return
+        if not _profile_lock.acquire(blocking=False):
+            g._profile_skipped = requested
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # 他のツール（デバッガ・カバレッジ等）が sys.monitoring を使用中
+            _profile_lock.release()
+            g._profile_skipped = requested
+            return
+        g._profiler = (profiler, requested)
+
+    @app.after_request
+    def finish_profiling(response):
+        started = g.pop('_profiler', None)
+        if started is None:
+            if g.pop('_profile_skipped', False):
+                response.headers['X-Profile-Skipped'] = 'busy'
+            return response
+        profiler, requested = started
+
+        profile_dir = app.config['PROFILE_DIR']
+        name = profile_name(request.endpoint)
+
+        def stop():
+            profiler.disable()
+            _profile_lock.release()
+            try:
+                save_profile(profiler, profile_dir, name)
+            except OSError:
+                app.logger.exception('Failed to save profile %s', name)
+
+        if response.is_streamed:
+            # ボディの送信が終わるまで計測を続ける
+            response.call_on_close(stop)
+        else:
+            stop()
+        if requested:
+            response.headers['X-Profile-Id'] = name
+        return response
+
+    @app.teardown_request
+    def discard_profiling(error=None):
+        started = g.pop('_profiler', None)
+        if started is not None:
+            started[0].disable()
+            _profile_lock.release()
@@ -0,0 +1,332 @@
+# SQL発行の計測
+#
+# エンジンの before/after_cursor_execute イベントで文ごとの所要時間を測り、
+# 有効な集計先（リクエスト単位・テストの capture_queries）に記録する。
+# 集計先はコンテキスト変数で持つため、リクエスト外（エクスポートのワーカー等）
+# ではイベントは何もせずに戻る。
+#
+# 同一リクエスト内で同じ形（IN の要素数を除いて同じ文）の SELECT が
+# N_PLUS_ONE_THRESHOLD 回以上発行された場合は N+1 の疑いとして記録する。
+# 結果はメトリクス（/api/metrics）に記録し、デバッグ時は X-Query-Stats ヘッダーにも出す。
+#
+# SLOW_QUERY_MS 以上かかった文は SLOW_QUERY_SAMPLE_RATE の割合で遅いクエリとして
+# ログに出し（パラメータ・呼び出し元エンドポイント・件数・EXPLAIN QUERY PLAN 付き）、
+# 文の形ごとに集計する（/api/slow-queries）。実行計画は形ごとに初回と最大時間を
+# 更新したときだけ取得する（文は再実行しない）。件数は更新系は rowcount、SELECT は
+# 結果から取得した行数で、SELECT の記録はカーソルを閉じた（結果を読み終えた）時点で行う。
+# パラメータはパスワードハッシュ等を含むため、既定では型と長さのみを記録する
+# （値は SLOW_QUERY_LOG_PARAMETERS=1 の場合のみ）。
+
+import contextvars
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+
+from metrics import UNMATCHED_ENDPOINT
+
+logger = logging.getLogger(__name__)
+
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+SLOW_QUERY_SAMPLE_RATE = float(os.environ.get('SLOW_QUERY_SAMPLE_RATE', 1.0))
+SLOW_QUERY_LOG_PARAMETERS = os.environ.get('SLOW_QUERY_LOG_PARAMETERS', '0') == '1'
+SLOW_QUERY_MAX_SHAPES = 500
+_MAX_PARAM_LENGTH = 200
+
+_collectors = contextvars.ContextVar('query_collectors', default=())
+
+_PLACEHOLDER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    """パラメータ数の違いを除いた文の形（IN (?, ?, ?) は IN (?) にまとめる）"""
+    return _PLACEHOLDER_LIST.sub('?', _WHITESPACE.sub(' ', statement).strip())
+
+
+class QueryStats:
+    """発行されたSQL文の件数・合計時間・最も遅い文・文の形ごとの件数"""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement = None
+        self.shapes = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.total_time += duration
+        if duration >= self.slowest_time:
+            self.slowest_time = duration
+            self.slowest_statement = statement
+        self.shapes[statement] += 1
+
+    def repeated_statements(self, threshold=None):
+        """閾値以上繰り返された SELECT の (形, 回数)。N+1 の疑い"""
+        threshold = threshold or N_PLUS_ONE_THRESHOLD
+        repeated = Counter()
+        for statement, count in self.shapes.items():
+            if statement.lstrip()[:6].upper() == 'SELECT':
+                repeated[statement_shape(statement)] += count
+        return [(shape, count) for shape, count in repeated.most_common() if count >= threshold]
+
+
+def _describe_value(value):
+    if isinstance(value, (str, bytes)):
+        return f'{type(value).__name__}[{len(value)}]'
+    return type(value).__name__
+
+
+def _format_parameters(parameters, include_values=False):
+    """ログ用にパラメータを短く整形（include_values=False では型と長さのみ）"""
+    if not include_values:
+        if isinstance(parameters, dict):
+            parameters = {key: _describe_value(value) for key, value in parameters.items()}
+        elif isinstance(parameters, (list, tuple)):
+            parameters = [_format_parameters(value) if isinstance(value, (list, tuple, dict))
+                          else _describe_value(value) for value in parameters]
+        else:
+            parameters = _describe_value(parameters)
+    text = repr(parameters)
+    return text if len(text) <= _MAX_PARAM_LENGTH else text[:_MAX_PARAM_LENGTH] + '...'
+
+
+def _is_select(statement):
+    return statement.lstrip()[:6].upper() == 'SELECT'
+
+
+def _affected_rows(cursor, statement):
+    """更新系の文の件数（SELECT は _CountingCursor で数える）"""
+    if _is_select(statement) or cursor.rowcount < 0:
+        return None
+    return cursor.rowcount
+
+
+def _inspect_statement(cursor, statement, parameters, executemany):
+    """SQLite の実行計画（文自体は実行しない）"""
+    if executemany:
+        return None
+    raw = cursor.connection.cursor()
+    try:
+        return [row[-1] for row in raw.execute(f'EXPLAIN QUERY PLAN {statement}', parameters)]
+    except Exception:
+        logger.debug('Could not inspect slow query: %s', statement, exc_info=True)
+        return None
+    finally:
+        raw.close()
+
+
+class _CountingCursor:
+    """DBAPI カーソルの代理。取得した行数を数え、閉じたときに on_close(行数) を呼ぶ"""
+
+    def __init__(self, cursor, on_close):
+        self._cursor = cursor
+        self._on_close = on_close
+        self.rows = 0
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self.rows += len(rows)
+        return rows
+
+    def close(self):
+        on_close, self._on_close = self._on_close, None
+        try:
+            if on_close is not None:
+                on_close(self.rows)
+        finally:
+            self._cursor.close()
+
+
+class SlowQueryLog:
+    """閾値を超えた文のサンプリング記録と、文の形ごとの集計"""
+
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, sample_rate=SLOW_QUERY_SAMPLE_RATE,
+                 max_shapes=SLOW_QUERY_MAX_SHAPES, log_parameters=SLOW_QUERY_LOG_PARAMETERS):
+        self.threshold = threshold_ms / 1000
+        self.sample_rate = sample_rate
+        self.log_parameters = log_parameters
+        self.max_shapes = max_shapes
+        self._shapes = {}
+        self._lock = threading.Lock()
+        self.dropped_shapes = 0  # 上限に達して集計できなかった件数
+
+    def observe(self, cursor, statement, parameters, executemany, duration, explain=True, rows=None):
+        """遅い文を記録（rows は SELECT の取得行数、省略時は更新系の rowcount）"""
+        if duration < self.threshold or random.random() >= self.sample_rate:
+            return
+
+        if rows is None:
+            rows = _affected_rows(cursor, statement)
+
+        shape = statement_shape(statement)
+        endpoint = request.endpoint if has_request_context() else None
+        with self._lock:
+            entry = self._shapes.get(shape)
+            if entry is None:
+                if len(self._shapes) >= self.max_shapes:
+                    self.dropped_shapes += 1
+                    return
+                entry = self._shapes[shape] = {
+                    'statement': shape, 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                    'rows': None, 'plan': None, 'parameters': None, 'endpoints': set(),
+                }
+            entry['count'] += 1
+            entry['total_ms'] += duration * 1000
+            entry['endpoints'].add(endpoint)
+            inspect = duration * 1000 > entry['max_ms']
+            if inspect:
+                entry['max_ms'] = duration * 1000
+            plan = entry['plan']
+
+        if inspect:
+            if explain:
+                plan = _inspect_statement(cursor, statement, parameters, executemany)
+            with self._lock:
+                entry.update(plan=plan, rows=rows,
+                             parameters=_format_parameters(parameters, self.log_parameters))
+
+        logger.warning(
+            'Slow query (%.1fms) in %s: %s', duration * 1000, endpoint, shape,
+            extra={
+                'duration_ms': round(duration * 1000, 3),
+                'endpoint': endpoint,
+                'statement': shape,
+                'parameters': _format_parameters(parameters, self.log_parameters),
+                'rows': rows,
+                'plan': plan,
+            }
+        )
+
+    def top(self, limit=10):
+        """合計時間の大きい順に文の形ごとの集計を返す"""
+        with self._lock:
+            entries = [dict(entry, endpoints=sorted(e for e in entry['endpoints'] if e))
+                       for entry in self._shapes.values()]
+        entries.sort(key=lambda entry: entry['total_ms'], reverse=True)
+        entries = entries[:limit]
+        for entry in entries:
+            entry['mean_ms'] = round(entry['total_ms'] / entry['count'], 3)
+            entry['total_ms'] = round(entry['total_ms'], 3)
+            entry['max_ms'] = round(entry['max_ms'], 3)
+        return entries
+
+    def clear(self):
+        with self._lock:
+            self._shapes.clear()
+            self.dropped_shapes = 0
+
+
+slow_query_log = SlowQueryLog()
+
+
+def _push_collector(stats):
+    return _collectors.set(_collectors.get() + (stats,))
+
+
+@contextmanager
+def capture_queries():
+    """ブロック内（同じスレッド）で発行されたSQL文を集計（テストのクエリ数の上限確認用）"""
+    stats = QueryStats()
+    token = _push_collector(stats)
+    try:
+        yield stats
+    finally:
+        _collectors.reset(token)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_query_started', None)
+    if started is None:
+        return
+    duration = time.perf_counter() - started
+    for stats in _collectors.get():
+        stats.record(statement, duration)
+    if duration < slow_query_log.threshold:
+        return
+    explain = conn.dialect.name == 'sqlite'
+    if _is_select(statement) and not executemany and cursor.description is not None:
+        # 行数は結果を読み終えるまで分からないため、結果が使うカーソルを差し替えて閉じたときに記録する
+        context.cursor = _CountingCursor(cursor, lambda rows: slow_query_log.observe(
+            cursor, statement, parameters, executemany, duration, explain, rows))
+    else:
+        slow_query_log.observe(cursor, statement, parameters, executemany, duration, explain)
+
+
+def instrument_engine(db_engine):
+    """エンジンにSQL計測のイベントを登録（複数回呼んでも1度だけ）"""
+    if not event.contains(db_engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(db_engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(db_engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def current_query_stats():
+    """実行中のリクエストの集計（リクエスト外や計測していない場合は None）"""
+    started = g.get('_query_stats') if has_request_context() else None
+    return started[0] if started else None
+
+
+def init_query_stats(app, db_engine, metrics=None):
+    """リクエストごとのSQL発行数・DB時間・N+1 の疑いを記録"""
+    instrument_engine(db_engine)
+
+    @app.before_request
+    def start_query_stats():
+        stats = QueryStats()
+        g._query_stats = (stats, _push_collector(stats))
+
+    @app.after_request
+    def finish_query_stats(response):
+        started = g.pop('_query_stats', None)
+        if started is None:
+            return response
+        stats, token = started
+        _collectors.reset(token)
+
+        endpoint = request.endpoint or UNMATCHED_ENDPOINT
+        repeated = stats.repeated_statements()
+        for shape, count in repeated:
+            logger.warning('Possible N+1 in %s: %d x %s', endpoint, count, shape)
+        if metrics is not None:
+            metrics.record_queries(endpoint, stats.count, stats.total_time, bool(repeated))
+        if app.debug:
+            response.headers['X-Query-Stats'] = (
+                f'count={stats.count}; total_ms={stats.total_time * 1000:.2f}; '
+                f'slowest_ms={stats.slowest_time * 1000:.2f}; n_plus_one={len(repeated)}'
+            )
+        return response
+
+    @app.teardown_request
+    def discard_query_stats(error=None):
+        # after_request に到達しなかった場合も集計先を外す
+        started = g.pop('_query_stats', None)
+        if started is not None:
+            _collectors.reset(started[1])
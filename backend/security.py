@@ -1,113 +1,215 @@
 # セキュリティ強化とエラーハンドリング
 
-import os
 import re
 import hashlib
 import secrets
 import logging
 from datetime import datetime, timedelta
 from functools import wraps
-from flask import request, jsonify, session, g
+from flask import request, jsonify, session, g, has_request_context
 import pytz
 
-# ログディレクトリの作成
-os.makedirs('logs', exist_ok=True)
+from log_pipeline import configure_logging
+from security_state import SlidingWindowCounter, create_state_backend
+from server_timing import phase_timer
 
-# セキュリティログの設定
+# セキュリティログ（logs/security.log へJSON形式でキュー経由出力）
+configure_logging()
 security_logger = logging.getLogger('security')
-security_handler = logging.FileHandler('logs/security.log')
-security_handler.setFormatter(logging.Formatter(
-    '%(asctime)s - %(levelname)s - %(message)s'
-))
-security_logger.addHandler(security_handler)
-security_logger.setLevel(logging.INFO)
 
 JST = pytz.timezone('Asia/Tokyo')
 
-class SecurityManager:
-    def __init__(self):
-        self.failed_attempts = {}
-        self.blocked_ips = set()
-        self.rate_limits = {}
+# 悪意のあるコンテンツのパターン（小文字化した入力に適用）
+#
+# 以前は14個のパターンを1つずつ re.search していたが、<script.*?>.*?</script> や
+# update\s+.*\s+set、on\w+\s*= は長い日報本文で後戻りが入力長の2乗に膨らむ。
+# 単純なパターンは1つの正規表現にまとめて1回で走査し、残りは同じ一致条件のまま
+# 後戻りしない形（単語先頭からの照合・行単位の判定）に置き換えている。
+# どのパターンも最悪で入力長に比例する時間で終わる。
+_MALICIOUS_TOKENS = re.compile(
+    r'javascript:'
+    r'|union\s+select'
+    r'|drop\s+table'
+    r'|insert\s+into'
+    r'|delete\s+from'
+    r'|exec\s*\('
+    r'|eval\s*\('
+    r'|system\s*\('
+    r'|\.\./'  # Path traversal
+    r'|%2e%2e%2f'
+    r'|%252e%252e%252f'
+)
+# on\w+\s*= と同じ条件を単語の先頭からだけ試す（語中の各 "on" から走査し直さない）
+_EVENT_HANDLER = re.compile(r'\b(?>\w*?on)\w++\s*+=')
+_UPDATE_WS = re.compile(r'update\s')
+_WS_SET = re.compile(r'\sset')
+_LEADING_SET = re.compile(r'\s*+set')
+_CONTROL_CHARS = re.compile(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]')
+
+
+def _has_script_block(text):
+    """<script.*?>.*?</script>（同一行内）の判定"""
+    for line in text.split('\n'):
+        start = line.find('<script')
+        if start < 0:
+            continue
+        # 最も手前の開始タグと '>' を選べば、後続の閉じタグを探す範囲が最大になる
+        close = line.find('>', start + 7)
+        if close >= 0 and line.find('</script>', close + 1) >= 0:
+            return True
+    return False
+
+
+def _has_update_set(text):
+    """update\\s+.*\\s+set の判定（行をまたぐ空白も含めて元のパターンと同じ条件）
+
+    .* は改行を含まないが前後の \\s+ は改行を含むため、行ごとに
+    「update 直後の空白が続いている（w1_open）」「update の後の本文が終わり
+    set 前の空白が続いている（w2_open）」の状態を持ち越して判定する。
+    """
+    lines = text.split('\n')
+    w1_open = w1_long = w2_open = False
+    for i, line in enumerate(lines):
+        blank = not line.strip()
+        update = _UPDATE_WS.search(line)
+        if update and _WS_SET.search(line, update.end()):
+            return True
+        if w1_open and (_WS_SET.search(line) or (w1_long and line.startswith('set'))):
+            return True
+        if w2_open and _LEADING_SET.match(line):
+            return True
+        if i == len(lines) - 1:
+            break
         
-    def validate_input(self, data, validation_rules):
-        """入力データの検証"""
+        stripped = line.rstrip()
+        ends_with_update = stripped.endswith('update')
+        w1_open, w1_long, w2_open = (
+            ends_with_update or (w1_open and blank),
+            (ends_with_update and len(stripped) < len(line)) or (w1_open and blank),
+            bool(update) or w1_open or (w2_open and blank),
+        )
+    return False
+
+
+def scan_malicious_content(content):
+    """悪意のあるコンテンツが含まれるか（入力長に対して線形時間）"""
+    text = content.lower()
+    if _MALICIOUS_TOKENS.search(text):
+        return True
+    if '=' in text and _EVENT_HANDLER.search(text):
+        return True
+    if '</script>' in text and _has_script_block(text):
+        return True
+    if 'update' in text and 'set' in text and _has_update_set(text):
+        return True
+    return False
+
+
+class CompiledValidator:
+    """validation_rules を前処理した検証器
+
+    validate_input_data のデコレート時に1回だけ生成し、パターンのコンパイル・
+    既定値の解決・適用しないチェックの除外を済ませておく。リクエストごとには
+    決まったフィールド列を1回たどり、検証と文字列のサニタイズを同時に行う。
+    """
+    
+    __slots__ = ('_fields', '_contains_malicious_content', '_sanitize_string')
+    
+    def __init__(self, validation_rules, manager):
+        self._contains_malicious_content = manager.contains_malicious_content
+        self._sanitize_string = manager.sanitize_string
+        self._fields = tuple(
+            self._compile_field(field, rules) for field, rules in validation_rules.items()
+        )
+    
+    @staticmethod
+    def _compile_field(field, rules):
+        min_length = rules.get('min_length', 0)
+        max_length = rules.get('max_length', float('inf'))
+        min_val = rules.get('min_value', float('-inf'))
+        max_val = rules.get('max_value', float('inf'))
+        pattern = rules.get('pattern')
+        return (
+            field,
+            rules.get('required', False),
+            rules.get('type'),
+            (min_length, max_length) if 'min_length' in rules or 'max_length' in rules else None,
+            f'{field}は{min_length}文字以上{max_length}文字以下で入力してください',
+            re.compile(pattern) if pattern else None,
+            (min_val, max_val) if 'min_value' in rules or 'max_value' in rules else None,
+            f'{field}は{min_val}以上{max_val}以下で入力してください',
+        )
+    
+    def __call__(self, data, sanitize=True):
+        """(エラーのリスト, サニタイズ済みデータ) を返す（sanitize=False なら後者は None）"""
         errors = []
+        sanitized = {} if sanitize else None
+        contains_malicious_content = self._contains_malicious_content
+        sanitize_string = self._sanitize_string
         
-        for field, rules in validation_rules.items():
+        for field, required, expected_type, length, length_error, pattern, value_range, range_error in self._fields:
             value = data.get(field)
             
             # 必須チェック
-            if rules.get('required', False) and not value:
+            if required and not value:
                 errors.append(f'{field}は必須項目です')
                 continue
             
             if value is None:
                 continue
-                
+            
             # 型チェック
-            expected_type = rules.get('type')
             if expected_type and not isinstance(value, expected_type):
                 errors.append(f'{field}の型が正しくありません')
                 continue
             
-            # 文字列の場合の追加検証
             if isinstance(value, str):
-                # 長さチェック
-                min_length = rules.get('min_length', 0)
-                max_length = rules.get('max_length', float('inf'))
-                if not (min_length <= len(value) <= max_length):
-                    errors.append(f'{field}は{min_length}文字以上{max_length}文字以下で入力してください')
-                
-                # パターンチェック
-                pattern = rules.get('pattern')
-                if pattern and not re.match(pattern, value):
+                if length and not (length[0] <= len(value) <= length[1]):
+                    errors.append(length_error)
+                if pattern and not pattern.match(value):
                     errors.append(f'{field}の形式が正しくありません')
-                
-                # 危険な文字列のチェック
-                if self.contains_malicious_content(value):
+                if contains_malicious_content(value):
                     errors.append(f'{field}に不正な文字列が含まれています')
-            
-            # 数値の場合の追加検証
-            if isinstance(value, (int, float)):
-                min_val = rules.get('min_value', float('-inf'))
-                max_val = rules.get('max_value', float('inf'))
-                if not (min_val <= value <= max_val):
-                    errors.append(f'{field}は{min_val}以上{max_val}以下で入力してください')
+                if sanitize:
+                    sanitized[field] = sanitize_string(value)
+            elif isinstance(value, (int, float)):
+                if value_range and not (value_range[0] <= value <= value_range[1]):
+                    errors.append(range_error)
         
+        # ルールに無いフィールドもそのまま（文字列はサニタイズして）引き継ぐ
+        if sanitize and not errors and len(sanitized) < len(data):
+            for key, value in data.items():
+                if key not in sanitized:
+                    sanitized[key] = sanitize_string(value) if isinstance(value, str) else value
+        
+        return errors, sanitized
+
+
+class SecurityManager:
+    def __init__(self, state_backend=None):
+        # レート制限・ログイン失敗・ブロックIPの保持先（既定はプロセス内）
+        self.state_backend = state_backend or create_state_backend()
+        self.failed_attempts = self.state_backend.event_log('failed_attempts')  # ロックの判定は正確な件数で行う
+        self.blocked_ips = self.state_backend.key_set('blocked_ips')
+        self.rate_limits = self.state_backend.counter('rate_limits')
+        
+    def validate_input(self, data, validation_rules):
+        """入力データの検証"""
+        errors, _ = CompiledValidator(validation_rules, self)(data, sanitize=False)
         return errors
     
     def contains_malicious_content(self, content):
         """悪意のあるコンテンツの検出"""
-        malicious_patterns = [
-            r'<script.*?>.*?</script>',  # XSS
-            r'javascript:',
-            r'on\w+\s*=',  # イベントハンドラ
-            r'union\s+select',  # SQL Injection
-            r'drop\s+table',
-            r'insert\s+into',
-            r'delete\s+from',
-            r'update\s+.*\s+set',
-            r'exec\s*\(',
-            r'eval\s*\(',
-            r'system\s*\(',
-            r'\.\./',  # Path traversal
-            r'%2e%2e%2f',
-            r'%252e%252e%252f'
-        ]
-        
-        content_lower = content.lower()
-        for pattern in malicious_patterns:
-            if re.search(pattern, content_lower, re.IGNORECASE):
-                return True
-        
-        return False
+        return scan_malicious_content(content)
     
     def sanitize_string(self, value, max_length=1000):
         """文字列のサニタイズ"""
         if not isinstance(value, str):
             return value
         
+        # エスケープ後の先頭 max_length 文字は元の先頭 max_length 文字だけで決まる
+        value = value[:max_length]
+        
         # HTMLエスケープ
         value = (value.replace('&', '&amp;')
                      .replace('<', '&lt;')
@@ -120,37 +222,22 @@ class SecurityManager:
             value = value[:max_length]
         
         # 制御文字の除去
-        value = re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]', '', value)
+        value = _CONTROL_CHARS.sub('', value)
         
         return value.strip()
     
     def check_rate_limit(self, identifier, max_requests=60, window_minutes=1):
-        """レート制限のチェック"""
-        now = datetime.now(JST)
-        window_start = now - timedelta(minutes=window_minutes)
-        
-        if identifier not in self.rate_limits:
-            self.rate_limits[identifier] = []
-        
-        # 古いリクエストを削除
-        self.rate_limits[identifier] = [
-            timestamp for timestamp in self.rate_limits[identifier]
-            if timestamp > window_start
-        ]
-        
-        # 制限チェック
-        if len(self.rate_limits[identifier]) >= max_requests:
-            return False
-        
-        # 現在のリクエストを記録
-        self.rate_limits[identifier].append(now)
-        return True
+        """レート制限のチェック（許可した場合はリクエストを記録）"""
+        return self.rate_limits.hit(identifier, max_requests, window_minutes * 60)
     
     def log_security_event(self, event_type, details, severity='INFO'):
-        """セキュリティイベントのログ記録"""
-        client_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
-        user_agent = request.headers.get('User-Agent', 'Unknown')
-        user_id = session.get('user_id', 'Anonymous')
+        """セキュリティイベントのログ記録（整形と書き込みはログスレッドで行う）"""
+        if has_request_context():
+            client_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
+            user_agent = request.environ.get('HTTP_USER_AGENT', 'Unknown')
+            user_id = session.get('user_id', 'Anonymous')
+        else:
+            client_ip, user_agent, user_id = None, None, 'Anonymous'
         
         log_entry = {
             'timestamp': datetime.now(JST).isoformat(),
@@ -162,37 +249,29 @@ class SecurityManager:
             'details': details
         }
         
+        # 同一のイベントは一定時間1件にまとめる（抑止件数は後で集約して出力）
         security_logger.log(
             getattr(logging, severity),
-            f"Security Event: {event_type} | IP: {client_ip} | User: {user_id} | Details: {details}"
+            'Security Event: %s', event_type,
+            extra={
+                'event_type': event_type,
+                'client_ip': client_ip,
+                'user_agent': user_agent,
+                'user_id': user_id,
+                'details': details,
+                'coalesce_key': (event_type, severity, client_ip, user_id, details),
+            }
         )
         
         return log_entry
     
     def check_failed_login_attempts(self, identifier, max_attempts=5, lockout_minutes=15):
         """ログイン失敗回数のチェック"""
-        now = datetime.now(JST)
-        
-        if identifier not in self.failed_attempts:
-            self.failed_attempts[identifier] = []
-        
-        # 古い試行を削除
-        cutoff_time = now - timedelta(minutes=lockout_minutes)
-        self.failed_attempts[identifier] = [
-            timestamp for timestamp in self.failed_attempts[identifier]
-            if timestamp > cutoff_time
-        ]
-        
-        return len(self.failed_attempts[identifier]) < max_attempts
+        return self.failed_attempts.count(identifier, lockout_minutes * 60) < max_attempts
     
-    def record_failed_login(self, identifier):
+    def record_failed_login(self, identifier, lockout_minutes=15):
         """ログイン失敗の記録"""
-        now = datetime.now(JST)
-        
-        if identifier not in self.failed_attempts:
-            self.failed_attempts[identifier] = []
-        
-        self.failed_attempts[identifier].append(now)
+        self.failed_attempts.add(identifier, lockout_minutes * 60)
         
         self.log_security_event(
             'FAILED_LOGIN_ATTEMPT',
@@ -245,60 +324,57 @@ def secure_endpoint(max_requests=60, window_minutes=1):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            client_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
-            
-            # IPブロックチェック
-            if client_ip in security_manager.blocked_ips:
-                security_manager.log_security_event(
-                    'BLOCKED_IP_ACCESS',
-                    f'Blocked IP attempted access: {client_ip}',
-                    'ERROR'
-                )
-                return jsonify({'error': 'アクセスが拒否されました'}), 403
-            
-            # レート制限チェック
-            if not security_manager.check_rate_limit(client_ip, max_requests, window_minutes):
-                security_manager.log_security_event(
-                    'RATE_LIMIT_EXCEEDED',
-                    f'Rate limit exceeded for IP: {client_ip}',
-                    'WARNING'
-                )
-                return jsonify({'error': 'リクエストが多すぎます。しばらく待ってから再試行してください'}), 429
+            with phase_timer('ratelimit'):
+                client_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
+                
+                # IPブロックチェック
+                if client_ip in security_manager.blocked_ips:
+                    security_manager.log_security_event(
+                        'BLOCKED_IP_ACCESS',
+                        f'Blocked IP attempted access: {client_ip}',
+                        'ERROR'
+                    )
+                    return jsonify({'error': 'アクセスが拒否されました'}), 403
+                
+                # レート制限チェック
+                if not security_manager.check_rate_limit(client_ip, max_requests, window_minutes):
+                    security_manager.log_security_event(
+                        'RATE_LIMIT_EXCEEDED',
+                        f'Rate limit exceeded for IP: {client_ip}',
+                        'WARNING'
+                    )
+                    return jsonify({'error': 'リクエストが多すぎます。しばらく待ってから再試行してください'}), 429
             
             return f(*args, **kwargs)
         return decorated_function
     return decorator
 
 def validate_input_data(validation_rules):
-    """入力データ検証デコレータ"""
+    """入力データ検証デコレータ（ルールはデコレート時に1回だけコンパイル）"""
+    validator = CompiledValidator(validation_rules, security_manager)
+    
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            # JSONデータの検証
-            if request.is_json:
-                data = request.get_json() or {}
-            else:
-                data = request.form.to_dict()
-            
-            errors = security_manager.validate_input(data, validation_rules)
-            
-            if errors:
-                security_manager.log_security_event(
-                    'INPUT_VALIDATION_FAILED',
-                    f'Validation errors: {errors}',
-                    'WARNING'
-                )
-                return jsonify({'error': 'Validation failed', 'details': errors}), 400
-            
-            # サニタイズされたデータをリクエストに追加
-            sanitized_data = {}
-            for key, value in data.items():
-                if isinstance(value, str):
-                    sanitized_data[key] = security_manager.sanitize_string(value)
+            with phase_timer('validate'):
+                # JSONデータの検証
+                if request.is_json:
+                    data = request.get_json() or {}
                 else:
-                    sanitized_data[key] = value
-            
-            g.validated_data = sanitized_data
+                    data = request.form.to_dict()
+                
+                errors, sanitized_data = validator(data)
+                
+                if errors:
+                    security_manager.log_security_event(
+                        'INPUT_VALIDATION_FAILED',
+                        f'Validation errors: {errors}',
+                        'WARNING'
+                    )
+                    return jsonify({'error': 'Validation failed', 'details': errors}), 400
+                
+                # サニタイズされたデータをリクエストに追加
+                g.validated_data = sanitized_data
             return f(*args, **kwargs)
         return decorated_function
     return decorator
@@ -0,0 +1,463 @@
+# セキュリティ状態（レート制限・ログイン失敗回数・ブロックIP）の保持先
+#
+# 既定（memory）はプロセス内に保持する。複数のワーカープロセスで動かす場合は
+# SECURITY_STATE_BACKEND=sqlite を指定し、全プロセスで共有する SQLite ファイル上で
+# 件数を原子的に更新する（プロセス数を増やしても上限が N 倍にならない）。
+#
+# レート制限は近似（スライディングウィンドウ）で足りるが、ログインロックは
+# スロットの切り替わりで件数が按分されると早く解除されるため、直近の失敗時刻を
+# 識別子ごとに EVENT_LOG_KEEP 件まで保持して正確に数える（EventLog）。
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+# 追跡する識別子（IP等）の上限
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 100000))
+# EventLog が識別子ごとに保持する直近の時刻の件数（判定に使う上限回数以上にする）
+EVENT_LOG_KEEP = 32
+
+
+class SlidingWindowCounter:
+    """固定スロットのスライディングウィンドウ・カウンタ
+
+    識別子ごとに「現在のスロットの件数」と「直前のスロットの件数」だけを持ち、
+    直前の件数を経過割合で按分して足した値をウィンドウ内の件数とみなす。
+    1回の呼び出しは件数に依存せずO(1)。識別子は最終アクセス順に保持し、
+    2ウィンドウ以上アクセスの無いものと上限（max_keys）を超えた分を古い順に破棄する。
+    """
+    
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        self._entries = OrderedDict()  # (識別子, ウィンドウ秒) -> [スロット番号, 現在件数, 直前件数, 最終アクセス]
+        self._lock = threading.Lock()
+        self.evictions = 0
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    @staticmethod
+    def _roll(entry, slot):
+        """スロットが進んでいれば件数を繰り越す"""
+        if slot != entry[0]:
+            entry[2] = entry[1] if slot == entry[0] + 1 else 0
+            entry[1] = 0
+            entry[0] = slot
+    
+    @staticmethod
+    def _estimate(entry, now, window):
+        elapsed = now / window - entry[0]
+        return entry[2] * (1 - elapsed) + entry[1]
+    
+    def _touch(self, key, now, window):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [int(now // window), 0, 0, now]
+        else:
+            self._entries.move_to_end(key)
+            self._roll(entry, int(now // window))
+            entry[3] = now
+        return entry
+    
+    def _evict(self, now):
+        """アクセスの途絶えた識別子と上限超過分を古い順に破棄"""
+        entries = self._entries
+        while entries:
+            key, entry = next(iter(entries.items()))
+            if len(entries) <= self.max_keys and now - entry[3] < 2 * key[1]:
+                break
+            del entries[key]
+            self.evictions += 1
+    
+    def hit(self, identifier, limit, window_seconds):
+        """ウィンドウ内の件数が上限未満なら1件記録して True を返す"""
+        with self._lock:
+            now = self.clock()
+            entry = self._touch((identifier, window_seconds), now, window_seconds)
+            allowed = self._estimate(entry, now, window_seconds) < limit
+            if allowed:
+                entry[1] += 1
+            self._evict(now)
+            return allowed
+    
+    def add(self, identifier, window_seconds):
+        """上限に関係なく1件記録"""
+        with self._lock:
+            now = self.clock()
+            self._touch((identifier, window_seconds), now, window_seconds)[1] += 1
+            self._evict(now)
+    
+    def count(self, identifier, window_seconds):
+        """ウィンドウ内の件数（記録はしない）"""
+        with self._lock:
+            now = self.clock()
+            entry = self._entries.get((identifier, window_seconds))
+            if entry is None:
+                return 0
+            self._roll(entry, int(now // window_seconds))
+            return self._estimate(entry, now, window_seconds)
+
+
+class SqliteWindowCounter:
+    """SlidingWindowCounter と同じ計算を SQLite 上で行うプロセス間共有版
+
+    読み取りと更新を BEGIN IMMEDIATE のトランザクション内で行うため、
+    複数プロセスから同時に呼ばれても件数の取りこぼしが起きない。
+    プロセス間で比較できるよう時刻は壁時計（time.time）を使う。
+    """
+    
+    SWEEP_INTERVAL = 1000  # この回数の書き込みごとに古い識別子を破棄
+    
+    def __init__(self, backend, namespace, max_keys=RATE_LIMIT_MAX_KEYS, clock=time.time):
+        self.backend = backend
+        self.namespace = namespace
+        self.max_keys = max_keys
+        self.clock = clock
+        self.evictions = 0
+        self._writes = 0
+    
+    def __len__(self):
+        return self.backend.connection().execute(
+            'SELECT COUNT(*) FROM window_counters WHERE namespace = ?', (self.namespace,)
+        ).fetchone()[0]
+    
+    def clear(self):
+        with self.backend.transaction() as conn:
+            conn.execute('DELETE FROM window_counters WHERE namespace = ?', (self.namespace,))
+    
+    def _update(self, identifier, window_seconds, increment, limit=None):
+        now = self.clock()
+        slot = int(now // window_seconds)
+        with self.backend.transaction() as conn:
+            row = conn.execute(
+                'SELECT slot, curr, prev FROM window_counters '
+                'WHERE namespace = ? AND identifier = ? AND window = ?',
+                (self.namespace, identifier, window_seconds)
+            ).fetchone()
+            entry = list(row) if row else [slot, 0, 0]
+            SlidingWindowCounter._roll(entry, slot)
+            allowed = limit is None or SlidingWindowCounter._estimate(entry, now, window_seconds) < limit
+            if allowed and increment:
+                entry[1] += 1
+            conn.execute(
+                'INSERT INTO window_counters (namespace, identifier, window, slot, curr, prev, last_seen) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (namespace, identifier, window) DO UPDATE SET '
+                'slot = excluded.slot, curr = excluded.curr, prev = excluded.prev, last_seen = excluded.last_seen',
+                (self.namespace, identifier, window_seconds, entry[0], entry[1], entry[2], now)
+            )
+        
+        self._writes += 1
+        if self._writes % self.SWEEP_INTERVAL == 0:
+            self.sweep(now)
+        return allowed
+    
+    def sweep(self, now=None):
+        """アクセスの途絶えた識別子と上限超過分を古い順に破棄"""
+        now = self.clock() if now is None else now
+        with self.backend.transaction() as conn:
+            deleted = conn.execute(
+                'DELETE FROM window_counters WHERE namespace = ? AND last_seen <= ? - 2 * window',
+                (self.namespace, now)
+            ).rowcount
+            excess = conn.execute(
+                'SELECT COUNT(*) FROM window_counters WHERE namespace = ?', (self.namespace,)
+            ).fetchone()[0] - self.max_keys
+            if excess > 0:
+                deleted += conn.execute(
+                    'DELETE FROM window_counters WHERE rowid IN ('
+                    'SELECT rowid FROM window_counters WHERE namespace = ? ORDER BY last_seen LIMIT ?)',
+                    (self.namespace, excess)
+                ).rowcount
+        self.evictions += deleted
+        return deleted
+    
+    def hit(self, identifier, limit, window_seconds):
+        """ウィンドウ内の件数が上限未満なら1件記録して True を返す"""
+        return self._update(identifier, window_seconds, True, limit)
+    
+    def add(self, identifier, window_seconds):
+        """上限に関係なく1件記録"""
+        self._update(identifier, window_seconds, True)
+    
+    def count(self, identifier, window_seconds):
+        """ウィンドウ内の件数（記録はしない）"""
+        now = self.clock()
+        row = self.backend.connection().execute(
+            'SELECT slot, curr, prev FROM window_counters '
+            'WHERE namespace = ? AND identifier = ? AND window = ?',
+            (self.namespace, identifier, window_seconds)
+        ).fetchone()
+        if row is None:
+            return 0
+        entry = list(row)
+        SlidingWindowCounter._roll(entry, int(now // window_seconds))
+        return SlidingWindowCounter._estimate(entry, now, window_seconds)
+
+
+class EventLog:
+    """識別子ごとに直近の発生時刻を保持し、ウィンドウ内の件数を正確に数える（ログイン失敗用）
+
+    保持する時刻は識別子ごとに keep 件までのため、数えられる件数も keep 件まで。
+    識別子は最終発生順に保持し、ウィンドウを過ぎたものと上限（max_keys）を超えた分を古い順に破棄する。
+    """
+    
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS, keep=EVENT_LOG_KEEP, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.keep = keep
+        self.clock = clock
+        self._entries = OrderedDict()  # (識別子, ウィンドウ秒) -> deque(発生時刻)
+        self._lock = threading.Lock()
+        self.evictions = 0
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def _evict(self, now):
+        entries = self._entries
+        while entries:
+            key, times = next(iter(entries.items()))
+            if len(entries) <= self.max_keys and now - times[-1] < key[1]:
+                break
+            del entries[key]
+            self.evictions += 1
+    
+    def add(self, identifier, window_seconds):
+        """発生を1件記録"""
+        with self._lock:
+            now = self.clock()
+            key = (identifier, window_seconds)
+            times = self._entries.pop(key, None) or deque(maxlen=self.keep)
+            times.append(now)
+            self._entries[key] = times
+            self._evict(now)
+    
+    def count(self, identifier, window_seconds):
+        """ウィンドウ内の件数（記録はしない）"""
+        with self._lock:
+            now = self.clock()
+            times = self._entries.get((identifier, window_seconds))
+            if times is None:
+                return 0
+            return sum(1 for at in times if now - at < window_seconds)
+
+
+class SqliteEventLog:
+    """EventLog の SQLite 版（プロセス間共有、時刻は壁時計）"""
+    
+    SWEEP_INTERVAL = 1000  # この回数の書き込みごとに古い時刻を破棄
+    
+    def __init__(self, backend, namespace, max_keys=RATE_LIMIT_MAX_KEYS, keep=EVENT_LOG_KEEP, clock=time.time):
+        self.backend = backend
+        self.namespace = namespace
+        self.max_keys = max_keys
+        self.keep = keep
+        self.clock = clock
+        self.evictions = 0
+        self._writes = 0
+    
+    def __len__(self):
+        return self.backend.connection().execute(
+            'SELECT COUNT(DISTINCT identifier) FROM event_logs WHERE namespace = ?', (self.namespace,)
+        ).fetchone()[0]
+    
+    def clear(self):
+        with self.backend.transaction() as conn:
+            conn.execute('DELETE FROM event_logs WHERE namespace = ?', (self.namespace,))
+    
+    def add(self, identifier, window_seconds):
+        """発生を1件記録（識別子ごとに直近 keep 件を残す）"""
+        now = self.clock()
+        with self.backend.transaction() as conn:
+            conn.execute(
+                'INSERT INTO event_logs (namespace, identifier, window, at) VALUES (?, ?, ?, ?)',
+                (self.namespace, identifier, window_seconds, now)
+            )
+            conn.execute(
+                'DELETE FROM event_logs WHERE rowid IN ('
+                'SELECT rowid FROM event_logs WHERE namespace = ? AND identifier = ? AND window = ? '
+                'ORDER BY at DESC LIMIT -1 OFFSET ?)',
+                (self.namespace, identifier, window_seconds, self.keep)
+            )
+        
+        self._writes += 1
+        if self._writes % self.SWEEP_INTERVAL == 0:
+            self.sweep(now)
+    
+    def sweep(self, now=None):
+        """ウィンドウを過ぎた時刻と、上限を超えた識別子を古い順に破棄"""
+        now = self.clock() if now is None else now
+        with self.backend.transaction() as conn:
+            deleted = conn.execute(
+                'DELETE FROM event_logs WHERE namespace = ? AND at <= ? - window', (self.namespace, now)
+            ).rowcount
+            excess = conn.execute(
+                'SELECT COUNT(DISTINCT identifier) FROM event_logs WHERE namespace = ?', (self.namespace,)
+            ).fetchone()[0] - self.max_keys
+            if excess > 0:
+                deleted += conn.execute(
+                    'DELETE FROM event_logs WHERE namespace = ? AND identifier IN ('
+                    'SELECT identifier FROM event_logs WHERE namespace = ? '
+                    'GROUP BY identifier ORDER BY MAX(at) LIMIT ?)',
+                    (self.namespace, self.namespace, excess)
+                ).rowcount
+        self.evictions += deleted
+        return deleted
+    
+    def count(self, identifier, window_seconds):
+        """ウィンドウ内の件数（記録はしない）"""
+        return self.backend.connection().execute(
+            'SELECT COUNT(*) FROM event_logs WHERE namespace = ? AND identifier = ? AND window = ? AND at > ?',
+            (self.namespace, identifier, window_seconds, self.clock() - window_seconds)
+        ).fetchone()[0]
+
+
+class SqliteKeySet:
+    """set と同じ使い方ができるプロセス間共有のキー集合（ブロックIP用）"""
+    
+    def __init__(self, backend, namespace):
+        self.backend = backend
+        self.namespace = namespace
+    
+    def __contains__(self, key):
+        return self.backend.connection().execute(
+            'SELECT 1 FROM key_sets WHERE namespace = ? AND key = ?', (self.namespace, key)
+        ).fetchone() is not None
+    
+    def __iter__(self):
+        rows = self.backend.connection().execute(
+            'SELECT key FROM key_sets WHERE namespace = ? ORDER BY key', (self.namespace,)
+        ).fetchall()
+        return iter([row[0] for row in rows])
+    
+    def __len__(self):
+        return self.backend.connection().execute(
+            'SELECT COUNT(*) FROM key_sets WHERE namespace = ?', (self.namespace,)
+        ).fetchone()[0]
+    
+    def add(self, key):
+        with self.backend.transaction() as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO key_sets (namespace, key, added_at) VALUES (?, ?, ?)',
+                (self.namespace, key, time.time())
+            )
+    
+    def discard(self, key):
+        with self.backend.transaction() as conn:
+            conn.execute('DELETE FROM key_sets WHERE namespace = ? AND key = ?', (self.namespace, key))
+    
+    def clear(self):
+        with self.backend.transaction() as conn:
+            conn.execute('DELETE FROM key_sets WHERE namespace = ?', (self.namespace,))
+
+
+class MemoryStateBackend:
+    """プロセス内に保持する（既定）"""
+    
+    name = 'memory'
+    
+    def counter(self, namespace):
+        return SlidingWindowCounter()
+    
+    def event_log(self, namespace):
+        return EventLog()
+    
+    def key_set(self, namespace):
+        return set()
+
+
+class SqliteStateBackend:
+    """全ワーカープロセスで共有する SQLite ファイルに保持する"""
+    
+    name = 'sqlite'
+    
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.transaction() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS window_counters ('
+                'namespace TEXT NOT NULL, identifier TEXT NOT NULL, window REAL NOT NULL, '
+                'slot INTEGER NOT NULL, curr INTEGER NOT NULL, prev INTEGER NOT NULL, '
+                'last_seen REAL NOT NULL, PRIMARY KEY (namespace, identifier, window))'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS ix_window_counters_last_seen '
+                'ON window_counters (namespace, last_seen)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS event_logs ('
+                'namespace TEXT NOT NULL, identifier TEXT NOT NULL, window REAL NOT NULL, at REAL NOT NULL)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS ix_event_logs_identifier '
+                'ON event_logs (namespace, identifier, window, at)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS key_sets ('
+                'namespace TEXT NOT NULL, key TEXT NOT NULL, added_at REAL NOT NULL, '
+                'PRIMARY KEY (namespace, key))'
+            )
+    
+    def connection(self):
+        """スレッド・プロセスごとの接続（fork 後は作り直す）"""
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            local.conn.execute('PRAGMA journal_mode=WAL')
+            local.conn.execute('PRAGMA synchronous=NORMAL')
+            local.pid = os.getpid()
+        return local.conn
+    
+    def transaction(self):
+        return _ImmediateTransaction(self.connection())
+    
+    def counter(self, namespace):
+        return SqliteWindowCounter(self, namespace)
+    
+    def event_log(self, namespace):
+        return SqliteEventLog(self, namespace)
+    
+    def key_set(self, namespace):
+        return SqliteKeySet(self, namespace)
+
+
+class _ImmediateTransaction:
+    """書き込みロックを先に取る（BEGIN IMMEDIATE）トランザクション"""
+    
+    def __init__(self, conn):
+        self.conn = conn
+    
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        return False
+
+
+def create_state_backend(name=None, path=None):
+    """環境変数 SECURITY_STATE_BACKEND（memory / sqlite）に応じた保持先を生成"""
+    name = name or os.environ.get('SECURITY_STATE_BACKEND', 'memory')
+    if name == 'memory':
+        return MemoryStateBackend()
+    if name == 'sqlite':
+        return SqliteStateBackend(path or os.environ.get(
+            'SECURITY_STATE_PATH', os.path.join('data', 'security_state.db')
+        ))
+    raise ValueError(f'未対応のセキュリティ状態の保持先です: {name}')
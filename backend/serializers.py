@@ -0,0 +1,123 @@
+# 一覧API向けの列射影とシリアライザ
+#
+# 一覧系のエンドポイントはORMオブジェクトを生成せず、レスポンスに出す列だけを
+# 結合済みの1クエリで取得する（行は軽量なタプル行）。関連の遅延読み込みによる
+# 1行ごとのSELECT（N+1）が発生しないため、クエリ数は件数に依存しない。
+#
+# *_rows はフィルタやページネーションを追加できる Query を返し、
+# serialize_* はその1行をレスポンス用の dict に変換する。
+
+from models import TimeRecord, Employee, User, DailyReport
+
+
+def _isoformat(value):
+    return value.isoformat() if value else None
+
+
+def time_record_rows(db_session):
+    """打刻記録一覧の列射影（従業員名を結合）"""
+    return db_session.query(
+        TimeRecord.id,
+        TimeRecord.employee_id,
+        Employee.name.label('employee_name'),
+        TimeRecord.timestamp,
+        TimeRecord.record_type,
+        TimeRecord.photo_path,
+        TimeRecord.photo_status
+    ).join(Employee, Employee.employee_id == TimeRecord.employee_id)
+
+
+def serialize_time_record(row):
+    return {
+        'id': row.id,
+        'employee_id': row.employee_id,
+        'employee_name': row.employee_name,
+        'timestamp': row.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+        'type': row.record_type,
+        'has_photo': bool(row.photo_path),
+        'photo_status': row.photo_status
+    }
+
+
+def daily_report_rows(db_session):
+    """日報一覧の列射影（従業員名を結合）"""
+    return db_session.query(
+        DailyReport.id,
+        DailyReport.report_date,
+        Employee.name.label('employee_name'),
+        DailyReport.work_content,
+        DailyReport.achievements,
+        DailyReport.issues,
+        DailyReport.tomorrow_plan,
+        DailyReport.remarks,
+        DailyReport.created_at,
+        DailyReport.updated_at
+    ).join(Employee, Employee.employee_id == DailyReport.employee_id)
+
+
+def serialize_daily_report(row):
+    return {
+        'id': row.id,
+        'report_date': row.report_date.strftime('%Y-%m-%d'),
+        'employee_name': row.employee_name,
+        'work_content': row.work_content,
+        'achievements': row.achievements,
+        'issues': row.issues,
+        'tomorrow_plan': row.tomorrow_plan,
+        'remarks': row.remarks,
+        'created_at': row.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'updated_at': row.updated_at.strftime('%Y-%m-%d %H:%M:%S')
+    }
+
+
+def employee_rows(db_session):
+    """従業員一覧の列射影（アカウントの無い従業員も含めるため外部結合）"""
+    return db_session.query(
+        Employee.id,
+        Employee.employee_id,
+        Employee.name,
+        Employee.email,
+        Employee.department,
+        Employee.position,
+        Employee.created_at,
+        User.username,
+        User.is_admin,
+        User.last_login
+    ).outerjoin(User, User.employee_id == Employee.employee_id)
+
+
+def serialize_employee(row):
+    return {
+        'id': row.id,
+        'employee_id': row.employee_id,
+        'name': row.name,
+        'email': row.email,
+        'department': row.department,
+        'position': row.position,
+        'created_at': _isoformat(row.created_at),
+        'username': row.username,
+        'is_admin': bool(row.is_admin),
+        'last_login': _isoformat(row.last_login),
+    }
+
+
+def user_rows(db_session):
+    """ユーザーアカウント一覧の列射影（従業員名を結合）"""
+    return db_session.query(
+        User.id,
+        User.username,
+        User.employee_id,
+        Employee.name.label('employee_name'),
+        User.is_admin,
+        User.last_login
+    ).join(Employee, User.employee_id == Employee.employee_id)
+
+
+def serialize_user(row):
+    return {
+        'username': row.username,
+        'employee_id': row.employee_id,
+        'employee_name': row.employee_name,
+        'is_admin': row.is_admin,
+        'last_login': _isoformat(row.last_login),
+    }
@@ -0,0 +1,80 @@
+# Server-Timing ヘッダーによる処理段階ごとの所要時間
+#
+# ハンドラーやデコレータは phase_timer('auth') のように段階を計測し、
+# 同じ名前の段階は合算して Server-Timing ヘッダーで返す。SQL の実行時間（db）と
+# リクエスト全体（total）は自動で付ける。ブラウザの開発者ツールや外形監視から
+# サーバーにログインせずに遅い段階を確認できる。
+#
+# 段階ごとの時間は内部構成を外部に見せるため、既定では無効。
+# SERVER_TIMING 設定（環境変数 SERVER_TIMING=1）で有効にする。
+
+import os
+import time
+from functools import wraps
+
+from flask import g, has_request_context
+
+from query_stats import current_query_stats
+
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '').lower() in ('1', 'true', 'yes')
+
+
+class phase_timer:
+    """段階の所要時間を計測するコンテキストマネージャー（無効時・リクエスト外では何もしない）"""
+
+    __slots__ = ('name', 'phases', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.phases = g.get('_server_timing') if has_request_context() else None
+        if self.phases is not None:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.phases is not None:
+            elapsed = time.perf_counter() - self.started
+            self.phases[self.name] = self.phases.get(self.name, 0.0) + elapsed
+        return False
+
+
+def timed_phase(name):
+    """関数全体を1つの段階として計測するデコレータ"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            with phase_timer(name):
+                return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+def format_server_timing(phases, db_stats=None, total=None):
+    """Server-Timing ヘッダーの値（dur はミリ秒）"""
+    entries = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in phases.items()]
+    if db_stats is not None:
+        entries.append(f'db;dur={db_stats.total_time * 1000:.2f};desc="{db_stats.count} queries"')
+    if total is not None:
+        entries.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(entries)
+
+
+def init_server_timing(app):
+    """SERVER_TIMING が有効なとき全レスポンスに Server-Timing ヘッダーを付ける"""
+    app.config.setdefault('SERVER_TIMING', SERVER_TIMING)
+
+    @app.before_request
+    def start_server_timing():
+        if app.config['SERVER_TIMING']:
+            g._server_timing = {}
+            g._server_timing_started = time.perf_counter()
+
+    @app.after_request
+    def add_server_timing_header(response):
+        phases = g.pop('_server_timing', None)
+        if phases is not None:
+            total = time.perf_counter() - g.pop('_server_timing_started')
+            response.headers['Server-Timing'] = format_server_timing(phases, current_query_stats(), total)
+        return response
@@ -4,16 +4,56 @@ import unittest
 import json
 import tempfile
 import os
-from datetime import datetime, timedelta
+import time
+import socket
+import threading
+from datetime import datetime, timedelta, date
 import pytz
 from flask import Flask
+
+# テスト用データベース（本番の data/timecard.db には触れない）
+_test_db_dir = tempfile.mkdtemp(prefix='timecard_test_')
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(_test_db_dir, 'test.db')}")
+
 from app import app, init_db
-from models import User, Employee, TimeRecord, WorkStatus
-from database import get_db_session
-from security import security_manager, validate_password_strength, validate_file_upload
+from models import Base, User, Employee, TimeRecord, WorkStatus, DailyAttendance, DailyReport, Tag, PhotoBlob, PhotoPackEntry, ExportJob
+from attendance import rebuild_daily_attendance
+import exports
+from exports import fail_interrupted_jobs, cleanup_export_jobs
+from database import get_db_session, engine, create_db_engine, get_active_pragmas, explain_query_plan
+from migrations import run_migrations, get_schema_version, backfill_work_date, MIGRATIONS, SCHEMA_VERSION_TABLE
+from sqlalchemy import create_engine, event, inspect, text
+from security import (
+    SecurityManager, CompiledValidator, security_manager, validate_password_strength,
+    validate_file_upload, SlidingWindowCounter
+)
+from security_state import MemoryStateBackend, SqliteStateBackend, create_state_backend
+import legacy_security
+from utils_optimized import ResponseCache, response_cache, invalidate_cache
+from log_pipeline import CoalescingQueueHandler, JsonFormatter, LogPipeline
+from metrics import RequestMetrics, request_metrics, estimate_quantile, DURATION_BUCKETS
+from query_stats import capture_queries, statement_shape, slow_query_log
+from server_timing import phase_timer
+import profiling
+from profiling import collapsed_stacks
+from photos import (
+    PhotoStore, PhotoWriter, photo_writer, photo_index, photo_packs,
+    migrate_flat_photos, archive_photos, recover_pending_photos
+)
+from health import HealthCheck, NotionSyncStatus, check_database, check_disk, check_notion_sync
 from werkzeug.security import generate_password_hash
 from werkzeug.datastructures import FileStorage
+from PIL import Image
+import cProfile
+import hashlib
 import io
+import logging
+import pstats
+import shutil
+import multiprocessing
+import queue
+import random
+import re
 
 JST = pytz.timezone('Asia/Tokyo')
 
@@ -32,6 +72,14 @@ class TimeCardTestCase(unittest.TestCase):
         
         self.client = self.app.test_client()
         
+        # テストごとにデータベースとセキュリティ状態を初期化
+        Base.metadata.drop_all(bind=engine)
+        security_manager.rate_limits.clear()
+        security_manager.failed_attempts.clear()
+        security_manager.blocked_ips.clear()
+        response_cache.clear()
+        photo_index.clear()
+        
         with self.app.app_context():
             init_db()
             self.create_test_data()
@@ -64,23 +112,29 @@ class TimeCardTestCase(unittest.TestCase):
             )
             db_session.add(user)
             
-            # 管理者ユーザーの作成
-            admin_employee = Employee(
-                employee_id='ADMIN001',
-                name='管理者',
-                email='admin@example.com',
-                department='管理部',
-                position='管理者'
-            )
-            db_session.add(admin_employee)
+            # 管理者ユーザーの作成（init_db の初期データがあればパスワードのみ差し替え）
+            admin_employee = db_session.query(Employee).filter_by(employee_id='ADMIN001').first()
+            if not admin_employee:
+                admin_employee = Employee(
+                    employee_id='ADMIN001',
+                    name='管理者',
+                    email='admin@example.com',
+                    department='管理部',
+                    position='管理者'
+                )
+                db_session.add(admin_employee)
             
-            admin_user = User(
-                username='admin',
-                password_hash=generate_password_hash('AdminPassword123!'),
-                employee_id='ADMIN001',
-                is_admin=True
-            )
-            db_session.add(admin_user)
+            admin_user = db_session.query(User).filter_by(username='admin').first()
+            if admin_user:
+                admin_user.password_hash = generate_password_hash('AdminPassword123!')
+            else:
+                admin_user = User(
+                    username='admin',
+                    password_hash=generate_password_hash('AdminPassword123!'),
+                    employee_id='ADMIN001',
+                    is_admin=True
+                )
+                db_session.add(admin_user)
             
             db_session.commit()
         finally:
@@ -243,6 +297,38 @@ class SecurityTests(TimeCardTestCase):
         for malicious_input in malicious_inputs:
             self.assertTrue(security_manager.contains_malicious_content(malicious_input))
     
+    def test_compiled_validator_matches_legacy(self):
+        """コンパイル済み検証器が従来の検証・サニタイズと同じ結果を返すことのテスト"""
+        rules, valid = legacy_security.VALIDATION_CASES['daily_report']
+        payloads = [
+            valid,
+            {},
+            dict(valid, report_date='2024/04/01'),
+            dict(valid, work_content=''),
+            dict(valid, work_content='x' * 5001),
+            dict(valid, achievements=123),
+            dict(valid, hours=25),
+            dict(valid, hours=None, remarks='<b>"注意"</b> & \x00'),
+            dict(valid, work_content='<script>alert(1)</script>'),
+        ]
+        validator = CompiledValidator(rules, security_manager)
+        for data in payloads:
+            errors, sanitized = validator(data)
+            legacy_errors, legacy_sanitized = legacy_security.validate_and_sanitize(security_manager, data, rules)
+            self.assertEqual(errors, legacy_errors, data)
+            self.assertEqual(security_manager.validate_input(data, rules), legacy_errors, data)
+            if not errors:
+                self.assertEqual(sanitized, legacy_sanitized, data)
+    
+    def test_login_validation_errors(self):
+        """デコレータの検証エラーのテスト"""
+        response = self.client.post('/api/login',
+                                  data=json.dumps({'username': 'x' * 51, 'password': 'pw'}),
+                                  content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.data)['details'],
+                         ['usernameは0文字以上50文字以下で入力してください'])
+    
     def test_rate_limiting(self):
         """レート制限のテスト"""
         # 正常なリクエスト
@@ -255,6 +341,66 @@ class SecurityTests(TimeCardTestCase):
         # 6回目は制限される
         self.assertFalse(security_manager.check_rate_limit('test_ip', 5, 1))
     
+    def test_sliding_window_rolls_over(self):
+        """スロットが進むと直前の件数が按分されることのテスト"""
+        now = [0.0]
+        counter = SlidingWindowCounter(clock=lambda: now[0])
+        for _ in range(10):
+            self.assertTrue(counter.hit('ip', 10, 60))
+        self.assertFalse(counter.hit('ip', 10, 60))
+        
+        # 次のスロットの半分経過時点では直前の10件の半分が残る
+        now[0] = 90.0
+        self.assertAlmostEqual(counter.count('ip', 60), 5.0)
+        for _ in range(5):
+            self.assertTrue(counter.hit('ip', 10, 60))
+        self.assertFalse(counter.hit('ip', 10, 60))
+        
+        # 2スロット以上経過すればリセット
+        now[0] = 200.0
+        self.assertEqual(counter.count('ip', 60), 0)
+    
+    def test_sliding_window_bounded_keys(self):
+        """識別子数の上限とアクセスの途絶えた識別子の破棄のテスト"""
+        now = [0.0]
+        counter = SlidingWindowCounter(max_keys=100, clock=lambda: now[0])
+        for i in range(1000):
+            counter.hit(f'10.0.{i // 256}.{i % 256}', 5, 60)
+        self.assertEqual(len(counter), 100)
+        self.assertEqual(counter.evictions, 900)
+        
+        now[0] = 120.0
+        counter.hit('192.168.0.1', 5, 60)
+        self.assertEqual(len(counter), 1)
+    
+    def test_failed_login_lockout(self):
+        """ログイン失敗回数によるロックのテスト"""
+        for _ in range(5):
+            response = self.login('testuser', 'WrongPassword1!')
+            self.assertEqual(response.status_code, 401)
+        
+        response = self.login()
+        self.assertEqual(response.status_code, 429)
+    
+    def test_lockout_holds_across_slot_boundary(self):
+        """スロットの切り替わり直後もロックが解除されず、失敗から15分後に解除されることのテスト"""
+        state_path = os.path.join(tempfile.mkdtemp(prefix='timecard_security_'), 'state.db')
+        for backend in (MemoryStateBackend(), SqliteStateBackend(state_path)):
+            manager = SecurityManager(backend)
+            now = [899.0]
+            manager.failed_attempts.clock = lambda: now[0]
+            for _ in range(5):
+                manager.failed_attempts.add('testuser:203.0.113.7', 15 * 60)
+            self.assertFalse(manager.check_failed_login_attempts('testuser:203.0.113.7'))
+            
+            # 900秒のスロットが切り替わった直後
+            now[0] = 902.0
+            self.assertFalse(manager.check_failed_login_attempts('testuser:203.0.113.7'))
+            now[0] = 899.0 + 15 * 60 - 1
+            self.assertFalse(manager.check_failed_login_attempts('testuser:203.0.113.7'))
+            now[0] = 899.0 + 15 * 60
+            self.assertTrue(manager.check_failed_login_attempts('testuser:203.0.113.7'))
+    
     def test_file_upload_validation(self):
         """ファイルアップロード検証のテスト"""
         # 正常なファイル
@@ -316,6 +462,201 @@ class APITests(TimeCardTestCase):
         response = self.client.get('/api/users')
         self.assertEqual(response.status_code, 200)
 
+class PaginationTests(TimeCardTestCase):
+    """キーセット方式ページネーションのテスト"""
+    
+    def add_records(self, count):
+        base = datetime(2024, 4, 1, 9, 0)
+        db_session = get_db_session()
+        try:
+            for i in range(count):
+                # 同一時刻の記録を含めてキーの一意性（timestamp, id）を確認する
+                timestamp = base + timedelta(minutes=i // 2)
+                db_session.add(TimeRecord(
+                    employee_id='TEST001',
+                    timestamp=timestamp,
+                    work_date=timestamp.date(),
+                    record_type='check_in'
+                ))
+            db_session.commit()
+        finally:
+            db_session.close()
+    
+    def test_time_records_cursor_walk(self):
+        """カーソルで全件を重複なく降順に取得できることのテスト"""
+        self.add_records(25)
+        self.login()
+        
+        seen = []
+        url = '/api/time-records?employee_id=TEST001&limit=10'
+        cursor = None
+        while True:
+            response = self.client.get(url + (f'&cursor={cursor}' if cursor else ''))
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.data)
+            seen.extend((r['timestamp'], r['id']) for r in data['records'])
+            cursor = data['next_cursor']
+            self.assertEqual(data['has_more'], cursor is not None)
+            if not cursor:
+                break
+        
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(len(set(seen)), 25)
+        self.assertEqual(seen, sorted(seen, reverse=True))
+    
+    def test_invalid_cursor(self):
+        """不正なカーソルのテスト"""
+        self.login()
+        response = self.client.get('/api/time-records?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 400)
+    
+    def test_list_endpoints_return_cursor_header(self):
+        """配列を返す一覧APIのカーソルヘッダーのテスト"""
+        self.admin_login()
+        response = self.client.get('/api/employees?limit=2')
+        first_page = json.loads(response.data)
+        self.assertEqual(len(first_page), 2)
+        
+        response = self.client.get(f"/api/employees?limit=2&cursor={response.headers['X-Next-Cursor']}")
+        second_page = json.loads(response.data)
+        self.assertGreater(second_page[0]['id'], first_page[-1]['id'])
+        
+        response = self.client.get('/api/users?limit=100')
+        self.assertNotIn('X-Next-Cursor', response.headers)
+
+class ExportTests(TimeCardTestCase):
+    """CSVエクスポートのテスト"""
+    
+    def test_export_csv_streams(self):
+        """BOM付きCSVがストリーミングで返ることのテスト"""
+        self.login()
+        self.client.post('/api/time-record', data={'employee_id': 'TEST001', 'type': 'check_in'})
+        self.client.post('/api/time-record', data={'employee_id': 'TEST001', 'type': 'check_out'})
+        
+        self.admin_login()
+        today = datetime.now(JST).strftime('%Y-%m-%d')
+        response = self.client.get(f'/api/export-csv?start_date={today}&end_date={today}')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        self.assertIn('attachment', response.headers['Content-Disposition'])
+        
+        body = response.get_data()
+        self.assertTrue(body.startswith(b'\xef\xbb\xbf'))
+        lines = body.decode('utf-8-sig').splitlines()
+        self.assertEqual(lines[0], '従業員ID,従業員名,日付,時刻,種別,写真')
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].startswith('TEST001,テストユーザー,'))
+    
+    def test_export_csv_invalid_date(self):
+        """不正な日付のテスト"""
+        self.admin_login()
+        response = self.client.get('/api/export-csv?start_date=2024/01/01')
+        self.assertEqual(response.status_code, 400)
+
+class ExportJobTests(TimeCardTestCase):
+    """エクスポートジョブのテスト"""
+    
+    def setUp(self):
+        super().setUp()
+        self.app.config['EXPORT_FOLDER'] = tempfile.mkdtemp(prefix='timecard_export_')
+    
+    def wait_for_job(self, job_id, timeout=10):
+        """ジョブが終了するまでポーリング"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            data = json.loads(self.client.get(f'/api/export-jobs/{job_id}').data)
+            if data['status'] in ('done', 'failed'):
+                return data
+            time.sleep(0.05)
+        self.fail('エクスポートジョブが終了しませんでした')
+    
+    def test_export_job_completes(self):
+        """ジョブが完了しダウンロードできることのテスト"""
+        self.login()
+        self.client.post('/api/time-record', data={'employee_id': 'TEST001', 'type': 'check_in'})
+        self.client.post('/api/time-record', data={'employee_id': 'TEST001', 'type': 'check_out'})
+        
+        self.admin_login()
+        today = datetime.now(JST).strftime('%Y-%m-%d')
+        response = self.client.post('/api/export-jobs',
+                                  data=json.dumps({'start_date': today, 'end_date': today}),
+                                  content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        
+        data = self.wait_for_job(json.loads(response.data)['id'])
+        self.assertEqual(data['status'], 'done')
+        self.assertEqual(data['total_rows'], 2)
+        self.assertEqual(data['rows_written'], 2)
+        self.assertEqual(data['progress'], 100)
+        
+        response = self.client.get(data['download_url'])
+        self.assertEqual(response.status_code, 200)
+        lines = response.get_data().decode('utf-8-sig').splitlines()
+        response.close()
+        self.assertEqual(lines[0], '従業員ID,従業員名,日付,時刻,種別,写真')
+        self.assertEqual(len(lines), 3)
+    
+    def test_closed_period_reuses_artifact(self):
+        """締め済み期間は完成済みファイルを再利用することのテスト"""
+        self.admin_login()
+        payload = json.dumps({'format': 'attendance_csv', 'start_date': '2024-04-01', 'end_date': '2024-04-30'})
+        
+        response = self.client.post('/api/export-jobs', data=payload, content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        first = self.wait_for_job(json.loads(response.data)['id'])
+        self.assertEqual(first['status'], 'done')
+        
+        response = self.client.post('/api/export-jobs', data=payload, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        second = json.loads(response.data)
+        self.assertTrue(second['reused'])
+        self.assertEqual(second['id'], first['id'])
+    
+    def test_interrupted_and_expired_jobs(self):
+        """停止したプロセスのジョブは failed とし、保存期間を過ぎたジョブはファイルとともに削除することのテスト"""
+        export_dir = self.app.config['EXPORT_FOLDER']
+        old = datetime.now(JST) - timedelta(days=30)
+        expired_path = os.path.join(export_dir, 'timecard_expired.csv')
+        recent_path = os.path.join(export_dir, 'timecard_recent.csv')
+        orphan_path = os.path.join(export_dir, 'timecard_orphan.csv.part')
+        for path in (expired_path, recent_path, orphan_path):
+            open(path, 'wb').close()
+        os.utime(orphan_path, (old.timestamp(), old.timestamp()))
+        
+        # 存在しない PID（pid_max より大きい）のプロセスが実行していたジョブ
+        dead_worker = f'{socket.gethostname()}:{2 ** 31 - 1}'
+        db_session = get_db_session()
+        try:
+            db_session.add_all([
+                ExportJob(id='interrupted', job_key='k1', format='csv', status='running', worker=dead_worker),
+                ExportJob(id='alive', job_key='k2', format='csv', status='pending', worker=exports.WORKER_ID),
+                ExportJob(id='expired', job_key='k3', format='csv', status='done', file_path=expired_path,
+                          created_at=old, finished_at=old),
+                ExportJob(id='recent', job_key='k4', format='csv', status='done', file_path=recent_path,
+                          finished_at=datetime.now(JST)),
+            ])
+            db_session.commit()
+        finally:
+            db_session.close()
+        
+        self.assertEqual(fail_interrupted_jobs(), 1)
+        self.assertEqual(cleanup_export_jobs(export_dir), {'jobs': 1, 'files': 2})
+        self.assertEqual(os.listdir(export_dir), ['timecard_recent.csv'])
+        
+        self.admin_login()
+        interrupted = json.loads(self.client.get('/api/export-jobs/interrupted').data)
+        self.assertEqual(interrupted['status'], 'failed')
+        self.assertEqual(json.loads(self.client.get('/api/export-jobs/alive').data)['status'], 'pending')
+        self.assertEqual(self.client.get('/api/export-jobs/expired').status_code, 404)
+    
+    def test_export_job_rejects_unknown_format(self):
+        """未対応形式のテスト"""
+        self.admin_login()
+        response = self.client.post('/api/export-jobs',
+                                  data=json.dumps({'format': 'xlsx'}),
+                                  content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
 class DataValidationTests(TimeCardTestCase):
     """データ検証のテスト"""
     
@@ -347,11 +688,16 @@ class DataValidationTests(TimeCardTestCase):
         """ユーザー作成時の検証テスト"""
         self.admin_login()
         
+        # アカウント未登録の従業員を用意
+        self.client.post('/api/employees',
+                         data=json.dumps({'employee_id': 'TEST002', 'name': '新しいユーザー'}),
+                         content_type='application/json')
+        
         # 正常なデータ
         valid_data = {
             'username': 'newuser',
             'password': 'NewPassword123!',
-            'employee_id': 'TEST001',  # 既存の従業員ID
+            'employee_id': 'TEST002',  # 既存の従業員ID
             'is_admin': False
         }
         
@@ -360,6 +706,1386 @@ class DataValidationTests(TimeCardTestCase):
                                   content_type='application/json')
         self.assertEqual(response.status_code, 201)
 
+class DatabaseProfileTests(TimeCardTestCase):
+    """SQLiteエンジンプロファイルのテスト"""
+    
+    def test_pragmas_applied(self):
+        """接続ごとにPRAGMAが適用されることのテスト"""
+        pragmas = get_active_pragmas()
+        self.assertEqual(pragmas['journal_mode'], 'wal')
+        self.assertEqual(pragmas['busy_timeout'], 5000)
+        self.assertEqual(pragmas['temp_store'], 2)  # MEMORY
+    
+    def test_health_exposes_pragmas(self):
+        """ヘルスチェックでPRAGMAが確認できることのテスト"""
+        self.admin_login()
+        self.app.extensions['health_check'].clear()
+        response = self.client.get('/api/health/ready')
+        data = json.loads(response.data)
+        profile = data['checks']['database']['profile']
+        self.assertEqual(profile['name'], 'production')
+        self.assertEqual(profile['pragmas']['journal_mode'], 'wal')
+
+class MigrationTests(TimeCardTestCase):
+    """スキーママイグレーションのテスト"""
+    
+    def test_fresh_database_is_current(self):
+        """新規データベースが最新バージョンになることのテスト"""
+        self.assertEqual(get_schema_version(engine), MIGRATIONS[-1][0])
+        self.assertEqual(run_migrations(engine), [])
+    
+    def test_indexes_added_to_existing_database(self):
+        """既存データベースにインデックスが追加されることのテスト"""
+        with engine.begin() as conn:
+            conn.execute(text('DROP INDEX ix_time_records_employee_timestamp'))
+            conn.execute(text(f'DELETE FROM {SCHEMA_VERSION_TABLE}'))
+        
+        self.assertEqual(run_migrations(engine), [version for version, _, _ in MIGRATIONS])
+        index_names = {index['name'] for index in inspect(engine).get_indexes('time_records')}
+        self.assertIn('ix_time_records_employee_timestamp', index_names)
+    
+    def test_concurrent_runs_apply_each_migration_once(self):
+        """同時に起動したプロセスが同じマイグレーションを二重に適用しないことのテスト"""
+        with engine.begin() as conn:
+            conn.execute(text(f'DELETE FROM {SCHEMA_VERSION_TABLE}'))
+        
+        results, errors = [], []
+        def run():
+            db_engine = create_db_engine(str(engine.url))
+            try:
+                results.append(run_migrations(db_engine))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                db_engine.dispose()
+        threads = [threading.Thread(target=run) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(version for applied in results for version in applied),
+                         [version for version, _, _ in MIGRATIONS])
+        with engine.connect() as conn:
+            self.assertEqual(conn.execute(text(f'SELECT COUNT(*) FROM {SCHEMA_VERSION_TABLE}')).scalar(), len(MIGRATIONS))
+
+class WorkDateTests(TimeCardTestCase):
+    """打刻記録の work_date のテスト"""
+    
+    def test_work_date_set_on_punch(self):
+        """打刻時にJST日付が記録されることのテスト"""
+        self.login()
+        self.client.post('/api/time-record', data={'employee_id': 'TEST001', 'type': 'check_in'})
+        
+        db_session = get_db_session()
+        try:
+            record = db_session.query(TimeRecord).filter_by(employee_id='TEST001').one()
+            self.assertEqual(record.work_date, datetime.now(JST).date())
+        finally:
+            db_session.close()
+        
+        data = json.loads(self.client.get('/api/my-stats').data)
+        self.assertEqual(data['work_days_this_month'], 1)
+    
+    def test_backfill_work_date(self):
+        """既存の打刻記録が補完されることのテスト"""
+        late_night = JST.localize(datetime(2024, 4, 1, 23, 30))
+        db_session = get_db_session()
+        try:
+            db_session.add(TimeRecord(employee_id='TEST001', timestamp=late_night, record_type='check_out'))
+            db_session.commit()
+        finally:
+            db_session.close()
+        
+        with engine.begin() as conn:
+            self.assertEqual(backfill_work_date(conn, batch_size=1), 1)
+        
+        db_session = get_db_session()
+        try:
+            record = db_session.query(TimeRecord).filter_by(employee_id='TEST001').one()
+            self.assertEqual(record.work_date, late_night.date())
+        finally:
+            db_session.close()
+
+class DailyAttendanceTests(TimeCardTestCase):
+    """日次勤怠集計のテスト"""
+    
+    def add_punches(self, punches):
+        db_session = get_db_session()
+        try:
+            for record_type, timestamp in punches:
+                db_session.add(TimeRecord(
+                    employee_id='TEST001',
+                    timestamp=timestamp,
+                    work_date=timestamp.date(),
+                    record_type=record_type
+                ))
+            db_session.commit()
+        finally:
+            db_session.close()
+    
+    def get_rows(self):
+        db_session = get_db_session()
+        try:
+            return {
+                row.work_date: row
+                for row in db_session.query(DailyAttendance).filter_by(employee_id='TEST001')
+            }
+        finally:
+            db_session.close()
+    
+    def test_rebuild_pairs_punches(self):
+        """再構築で出退勤・休憩・日跨ぎが集計されることのテスト"""
+        self.add_punches([
+            ('check_in', datetime(2024, 4, 1, 9, 0)),
+            ('check_out', datetime(2024, 4, 1, 12, 0)),
+            ('check_in', datetime(2024, 4, 1, 13, 0)),
+            ('check_out', datetime(2024, 4, 1, 18, 0)),
+            ('check_in', datetime(2024, 4, 2, 22, 0)),
+            ('check_out', datetime(2024, 4, 3, 6, 0)),
+        ])
+        
+        db_session = get_db_session()
+        try:
+            self.assertEqual(rebuild_daily_attendance(db_session, date(2024, 4, 1), date(2024, 4, 30)), 2)
+            db_session.commit()
+        finally:
+            db_session.close()
+        
+        rows = self.get_rows()
+        day1 = rows[date(2024, 4, 1)]
+        self.assertEqual(day1.first_check_in, datetime(2024, 4, 1, 9, 0))
+        self.assertEqual(day1.last_check_out, datetime(2024, 4, 1, 18, 0))
+        self.assertEqual(day1.worked_seconds, 8 * 3600)
+        self.assertEqual(day1.break_seconds, 3600)
+        self.assertEqual(day1.punch_count, 4)
+        
+        # 日跨ぎの退勤は出勤日に計上
+        self.assertNotIn(date(2024, 4, 3), rows)
+        self.assertEqual(rows[date(2024, 4, 2)].worked_seconds, 8 * 3600)
+    
+    def test_punch_updates_rollup(self):
+        """打刻で集計が更新され、再構築結果と一致することのテスト"""
+        self.login()
+        for record_type in ['check_in', 'check_out', 'check_in', 'check_out']:
+            self.client.post('/api/time-record', data={'employee_id': 'TEST001', 'type': record_type})
+        
+        today = datetime.now(JST).date()
+        incremental = self.get_rows()[today]
+        self.assertEqual(incremental.punch_count, 4)
+        self.assertIsNotNone(incremental.first_check_in)
+        
+        db_session = get_db_session()
+        try:
+            rebuild_daily_attendance(db_session, today, today, 'TEST001')
+            db_session.commit()
+        finally:
+            db_session.close()
+        
+        rebuilt = self.get_rows()[today]
+        for column in ['first_check_in', 'last_check_out', 'worked_seconds', 'break_seconds', 'punch_count']:
+            self.assertEqual(getattr(rebuilt, column), getattr(incremental, column))
+        
+        stats = json.loads(self.client.get('/api/my-stats').data)
+        self.assertEqual(stats['work_days_this_month'], 1)
+        self.assertIsNotNone(stats['work_time_today'])
+    
+    def test_admin_summary_reads_rollup(self):
+        """管理者サマリーが集計を返すことのテスト"""
+        self.login()
+        self.client.post('/api/time-record', data={'employee_id': 'TEST001', 'type': 'check_in'})
+        
+        self.admin_login()
+        response = self.client.get('/api/admin/attendance/summary')
+        self.assertEqual(response.status_code, 200)
+        
+        summary = {row['employeeId']: row for row in json.loads(response.data)['summary']}
+        self.assertTrue(summary['TEST001']['isPresent'])
+        self.assertEqual(summary['TEST001']['currentStatus'], 'working')
+        self.assertFalse(summary['EMP001']['isPresent'])
+
+class QueryPlanTests(TimeCardTestCase):
+    """一覧系エンドポイントのクエリプラン回帰テスト"""
+    
+    # 件数の少ないマスタ表は全件走査を許容する
+    MASTER_TABLES = {'employees', 'users', 'tags'}
+    
+    def capture_plans(self, url):
+        """エンドポイント実行中のSELECT文のクエリプランを取得"""
+        statements = []
+        
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append((statement, parameters))
+        
+        event.listen(engine, 'before_cursor_execute', capture)
+        try:
+            self.client.get(url)
+        finally:
+            event.remove(engine, 'before_cursor_execute', capture)
+        
+        return [
+            (statement, detail)
+            for statement, parameters in statements
+            for detail in explain_query_plan(statement, parameters)
+        ]
+    
+    def assert_no_table_scan(self, url):
+        for statement, detail in self.capture_plans(url):
+            if detail.startswith('SCAN ') and 'USING' not in detail:
+                table = detail.split()[1]
+                self.assertIn(table, self.MASTER_TABLES, f'{url}: {detail}\n{statement}')
+    
+    def test_user_list_endpoints_use_indexes(self):
+        """一般ユーザー向け一覧のテスト"""
+        self.login()
+        self.client.post('/api/time-record', data={'employee_id': 'TEST001', 'type': 'check_in'})
+        for url in [
+            '/api/time-records?employee_id=TEST001&start_date=2024-01-01&end_date=2024-12-31',
+            '/api/daily-reports',
+            '/api/daily-reports?start_date=2024-01-01&end_date=2024-12-31',
+            '/api/notifications',
+            '/api/my-stats',
+        ]:
+            self.assert_no_table_scan(url)
+    
+    def test_admin_list_endpoints_use_indexes(self):
+        """管理者向け一覧のテスト"""
+        self.admin_login()
+        for url in [
+            '/api/time-records',
+            '/api/time-records?start_date=2024-01-01&end_date=2024-12-31',
+            '/api/daily-reports',
+            '/api/export-csv?start_date=2024-01-01&end_date=2024-12-31',
+            '/api/tag-work-summary?start_date=2024-01-01&end_date=2024-12-31',
+            '/api/admin/attendance/summary',
+            '/api/employees',
+            '/api/users',
+        ]:
+            self.assert_no_table_scan(url)
+
+class StatementCountTests(TimeCardTestCase):
+    """一覧系エンドポイントのSQL発行数のテスト（件数に依存しないこと）"""
+    
+    def seed_rows(self, count, offset=0):
+        """従業員・アカウント・打刻・日報をまとめて作成"""
+        db_session = get_db_session()
+        try:
+            now = datetime.now(JST)
+            for i in range(offset, offset + count):
+                employee_id = f'BULK{i:03d}'
+                db_session.add(Employee(employee_id=employee_id, name=f'一括{i}'))
+                db_session.flush()
+                user = User(username=f'bulk{i}', password_hash='x', employee_id=employee_id,
+                            last_login=now)
+                db_session.add(user)
+                db_session.flush()
+                db_session.add(TimeRecord(employee_id=employee_id, timestamp=now,
+                                          work_date=now.date(), record_type='check_in'))
+                db_session.add(DailyReport(user_id=user.id, employee_id=employee_id,
+                                           report_date=now.date(), work_content='作業'))
+            db_session.commit()
+            invalidate_cache('employees', 'reports')
+        finally:
+            db_session.close()
+    
+    # エンドポイントごとのSQL発行数の上限（件数に依存しないこと）
+    QUERY_BUDGETS = {
+        '/api/time-records': 1,
+        '/api/daily-reports': 1,
+        '/api/employees': 1,
+        '/api/users': 1,
+        '/api/tags': 1,
+        '/api/notifications': 1,
+        '/api/admin/attendance/summary': 1,
+        '/api/status': 3,
+    }
+    
+    def count_statements(self, url):
+        """エンドポイント実行中に発行されたSQL文の数"""
+        with capture_queries() as stats:
+            response = self.client.get(url)
+        
+        self.assertEqual(response.status_code, 200, url)
+        self.assertEqual(stats.repeated_statements(), [], url)
+        data = json.loads(response.data)
+        rows = data['records'] if isinstance(data, dict) else data
+        return stats.count, len(rows)
+    
+    def assertQueryBudget(self, url, budget):
+        with capture_queries() as stats:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        self.assertLessEqual(stats.count, budget, f'{url}: {stats.count} statements')
+    
+    def test_list_endpoints_issue_single_query(self):
+        """一覧APIが件数に関わらず1クエリで完結することのテスト"""
+        self.admin_login()
+        urls = ['/api/time-records', '/api/daily-reports', '/api/employees', '/api/users']
+        
+        self.seed_rows(3)
+        small = {url: self.count_statements(url) for url in urls}
+        self.seed_rows(30, offset=3)
+        large = {url: self.count_statements(url) for url in urls}
+        
+        for url in urls:
+            self.assertEqual(small[url][0], 1, url)
+            self.assertEqual(large[url][0], 1, url)
+            self.assertGreater(large[url][1], small[url][1], url)
+    
+    def test_query_budgets(self):
+        """各エンドポイントのSQL発行数が上限以内であることのテスト"""
+        self.admin_login()
+        self.seed_rows(20)
+        for url, budget in self.QUERY_BUDGETS.items():
+            self.assertQueryBudget(url, budget)
+    
+    def test_repeated_select_flagged_as_n_plus_one(self):
+        """同じ形の SELECT の繰り返しが N+1 の疑いとして検出されることのテスト"""
+        self.seed_rows(6)
+        db_session = get_db_session()
+        try:
+            with capture_queries() as stats:
+                for i in range(6):
+                    db_session.query(Employee).filter_by(employee_id=f'BULK{i:03d}').first()
+                db_session.query(Employee).filter(
+                    Employee.employee_id.in_(['BULK000', 'BULK001'])).all()
+                db_session.query(Employee).filter(
+                    Employee.employee_id.in_(['BULK000', 'BULK001', 'BULK002'])).all()
+        finally:
+            db_session.close()
+        
+        self.assertEqual(stats.count, 8)
+        self.assertEqual([count for _, count in stats.repeated_statements()], [6])
+        self.assertEqual([count for _, count in stats.repeated_statements(threshold=2)], [6, 2])
+        self.assertEqual(statement_shape('SELECT a FROM t WHERE id IN (?, ?,\n ?)'),
+                         'SELECT a FROM t WHERE id IN (?)')
+    
+    def test_query_stats_header_and_metrics(self):
+        """デバッグ時のヘッダーとメトリクスにSQL発行数が出ることのテスト"""
+        self.admin_login()
+        response = self.client.get('/api/employees')
+        self.assertNotIn('X-Query-Stats', response.headers)
+        
+        self.app.config['DEBUG'] = True
+        try:
+            response = self.client.get('/api/users')
+        finally:
+            self.app.config['DEBUG'] = False
+        self.assertTrue(response.headers['X-Query-Stats'].startswith('count=1; '))
+        
+        summary = request_metrics.summary()['list_users']
+        self.assertGreaterEqual(summary['db_statements'], 1)
+        self.assertEqual(summary['db_max_statements'], 1)
+        self.assertIn('timecard_db_statements_total{endpoint="list_users"}',
+                      self.client.get('/api/metrics').get_data(as_text=True))
+
+class SlowQueryLogTests(TimeCardTestCase):
+    """遅いクエリの記録のテスト"""
+    
+    def setUp(self):
+        super().setUp()
+        threshold, sample_rate = slow_query_log.threshold, slow_query_log.sample_rate
+        self.addCleanup(setattr, slow_query_log, 'threshold', threshold)
+        self.addCleanup(setattr, slow_query_log, 'sample_rate', sample_rate)
+        self.addCleanup(setattr, slow_query_log, 'log_parameters', slow_query_log.log_parameters)
+        self.admin_login()
+        # 全ての文を遅いクエリとして記録する
+        slow_query_log.threshold = 0
+        slow_query_log.sample_rate = 1.0
+        slow_query_log.clear()
+    
+    def test_full_scan_captured_with_plan(self):
+        """部分一致検索が実行計画・エンドポイント付きで記録され、パラメータは型と長さのみのテスト"""
+        db_session = get_db_session()
+        try:
+            db_session.add_all([Tag(name=name, notion_id=f'notion-{i}')
+                                for i, name in enumerate(['渋谷現場', '新宿現場', '本社'])])
+            db_session.commit()
+        finally:
+            db_session.close()
+        
+        response = self.client.get('/api/tags?query=現場')
+        self.assertEqual(len(json.loads(response.data)), 2)
+        
+        entries = [entry for entry in slow_query_log.top(100) if 'LIKE' in entry['statement']]
+        self.assertEqual(len(entries), 1)
+        entry = entries[0]
+        self.assertEqual(entry['endpoints'], ['list_tags'])
+        self.assertTrue(any(detail.startswith('SCAN') for detail in entry['plan']), entry['plan'])
+        self.assertIn("'str[4]'", entry['parameters'])
+        self.assertNotIn('現場', entry['parameters'])
+        self.assertEqual(entry['rows'], 2)  # 取得した行数（文は再実行しない）
+        
+        slow_query_log.clear()
+        slow_query_log.log_parameters = True
+        self.client.get('/api/tags?query=新宿')
+        entry = next(entry for entry in slow_query_log.top(100) if 'LIKE' in entry['statement'])
+        self.assertIn('%新宿%', entry['parameters'])
+    
+    def test_write_parameters_redacted(self):
+        """更新系の遅いクエリは件数を記録し、パスワードハッシュを出さないことのテスト"""
+        self.client.post('/api/logout')
+        self.login()
+        entries = [entry for entry in slow_query_log.top(100) if entry['statement'].startswith('UPDATE users')]
+        self.assertTrue(entries)
+        for entry in entries:
+            self.assertEqual(entry['rows'], 1)
+            self.assertNotIn('pbkdf2', entry['parameters'])
+            self.assertNotIn('scrypt', entry['parameters'])
+    
+    def test_sampling_and_admin_endpoint(self):
+        """サンプリング率0では記録されず、上位N件を管理者のみ取得できることのテスト"""
+        slow_query_log.sample_rate = 0
+        self.client.get('/api/tags?query=x')
+        self.assertEqual(slow_query_log.top(), [])
+        
+        slow_query_log.sample_rate = 1.0
+        self.client.get('/api/tags?query=x')
+        self.client.get('/api/employees')
+        data = json.loads(self.client.get('/api/slow-queries?limit=1').data)
+        self.assertEqual(data['threshold_ms'], 0)
+        self.assertEqual(len(data['queries']), 1)
+        self.assertGreaterEqual(data['queries'][0]['count'], 1)
+        
+        self.client.post('/api/logout')
+        self.login()
+        self.assertEqual(self.client.get('/api/slow-queries').status_code, 403)
+
+
+class ServerTimingTests(TimeCardTestCase):
+    """Server-Timing ヘッダーのテスト"""
+    
+    def enable_server_timing(self):
+        self.app.config['SERVER_TIMING'] = True
+        self.addCleanup(self.app.config.__setitem__, 'SERVER_TIMING', False)
+    
+    def timing_phases(self, response):
+        return {entry.split(';')[0]: entry for entry in response.headers['Server-Timing'].split(', ')}
+    
+    def test_disabled_by_default(self):
+        """既定では Server-Timing ヘッダーを付けないことのテスト"""
+        self.login()
+        response = self.client.get('/api/tags')
+        self.assertNotIn('Server-Timing', response.headers)
+    
+    def test_record_time_phases(self):
+        """打刻の各段階とDB時間・全体時間がヘッダーに出ることのテスト"""
+        self.enable_server_timing()
+        self.login()
+        response = self.client.post('/api/time-record', data={'employee_id': 'TEST001', 'type': 'check_in'})
+        self.assertEqual(response.status_code, 201)
+        
+        phases = self.timing_phases(response)
+        self.assertEqual(list(phases), ['auth', 'lookup', 'commit', 'serialize', 'db', 'total'])
+        self.assertRegex(phases['auth'], r'^auth;dur=\d+\.\d{2}$')
+        self.assertRegex(phases['db'], r'^db;dur=\d+\.\d{2};desc="\d+ queries"$')
+    
+    def test_validation_phase(self):
+        """入力検証デコレータの段階が計測されることのテスト"""
+        self.enable_server_timing()
+        response = self.login()
+        self.assertIn('validate', self.timing_phases(response))
+    
+    def test_phase_timer_outside_request(self):
+        """リクエスト外では何もしないことのテスト"""
+        with phase_timer('noop') as timer:
+            pass
+        self.assertIsNone(timer.phases)
+
+
+class PhotoIngestionTests(TimeCardTestCase):
+    """打刻写真の非同期保存のテスト"""
+    
+    def setUp(self):
+        super().setUp()
+        upload_folder = self.app.config['UPLOAD_FOLDER']
+        self.addCleanup(self.app.config.__setitem__, 'UPLOAD_FOLDER', upload_folder)
+        self.photo_dir = tempfile.mkdtemp(prefix='timecard_photos_')
+        self.addCleanup(shutil.rmtree, self.photo_dir, ignore_errors=True)
+        self.app.config['UPLOAD_FOLDER'] = self.photo_dir
+        self.addCleanup(photo_packs.clear)
+        self.login()
+    
+    def punch_with_photo(self, data=b'\xff\xd8photo-bytes', record_type='check_in'):
+        return self.client.post('/api/time-record', data={
+            'employee_id': 'TEST001',
+            'type': record_type,
+            'photo': (io.BytesIO(data), 'camera.jpg')
+        }, content_type='multipart/form-data')
+    
+    def stored_files(self):
+        """ストアに保存されたファイル名（一時ファイルを含む）"""
+        return sorted(name for _, _, names in os.walk(self.photo_dir) for name in names)
+    
+    def test_photo_saved_after_commit(self):
+        """打刻は pending で返り、保存後に ready となって写真を取得できることのテスト"""
+        data = os.urandom(256 * 1024)
+        response = self.punch_with_photo(data)
+        self.assertEqual(response.status_code, 201)
+        body = json.loads(response.data)
+        self.assertEqual(body['photo_status'], 'pending')
+        
+        photo_writer.join()
+        db_session = get_db_session()
+        try:
+            record = db_session.get(TimeRecord, body['record_id'])
+            self.assertEqual(record.photo_status, 'ready')
+            self.assertEqual(record.photo_path, hashlib.sha256(data).hexdigest())
+        finally:
+            db_session.close()
+        self.assertEqual(self.stored_files(), [record.photo_path])
+        
+        photo = self.client.get(f"/api/photo/{body['record_id']}")
+        self.assertEqual(photo.status_code, 200)
+        self.assertEqual(photo.mimetype, 'image/jpeg')
+        self.assertEqual(photo.data, data)
+        records = json.loads(self.client.get('/api/time-records').data)['records']
+        self.assertEqual(records[0]['photo_status'], 'ready')
+    
+    def test_pending_photo_returns_202(self):
+        """保存待ちの写真は 202 と Retry-After を返すことのテスト"""
+        db_session = get_db_session()
+        try:
+            record = TimeRecord(employee_id='TEST001', timestamp=datetime.now(JST),
+                                record_type='check_in', photo_status='pending')
+            db_session.add(record)
+            db_session.commit()
+            record_id = record.id
+        finally:
+            db_session.close()
+        
+        response = self.client.get(f'/api/photo/{record_id}')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.headers['Retry-After'], '1')
+    
+    def test_stale_pending_photos_recovered(self):
+        """保存が止まった pending の写真を保存待ちのファイルから回復し、無ければ failed とすることのテスト"""
+        store = PhotoStore(self.photo_dir)
+        stale = datetime.now(JST) - timedelta(minutes=10)
+        db_session = get_db_session()
+        try:
+            records = [TimeRecord(employee_id='TEST001', timestamp=timestamp, record_type='check_in',
+                                  photo_status='pending') for timestamp in (stale, stale, datetime.now(JST))]
+            db_session.add_all(records)
+            db_session.commit()
+            spooled, lost, recent = (record.id for record in records)
+        finally:
+            db_session.close()
+        data = os.urandom(1024)
+        store.spool(spooled, io.BytesIO(data), '.jpg')
+        store.spool(recent, io.BytesIO(b'recent'), '.jpg')
+        
+        result = recover_pending_photos(self.photo_dir)
+        self.assertEqual(result, {'recovered': 1, 'failed': 1, 'removed_spools': 0})
+        photo = self.client.get(f'/api/photo/{spooled}')
+        self.assertEqual((photo.status_code, photo.mimetype, photo.data), (200, 'image/jpeg', data))
+        self.assertEqual(self.client.get(f'/api/photo/{lost}').status_code, 404)
+        self.assertEqual(self.client.get(f'/api/photo/{recent}').status_code, 202)
+        self.assertEqual(self.stored_files(), sorted([hashlib.sha256(data).hexdigest(), f'{recent}.jpg']))
+    
+    def test_recovery_does_not_race_writer(self):
+        """ワーカーが保存する打刻は回復せず、回復中の打刻はワーカーが反映しないことのテスト"""
+        store = PhotoStore(self.photo_dir)
+        stale = datetime.now(JST) - timedelta(minutes=10)
+        db_session = get_db_session()
+        try:
+            # claimed は別のプロセスが回復中（recovering）の打刻
+            records = [TimeRecord(employee_id='TEST001', timestamp=stale, record_type='check_in',
+                                  photo_status=status) for status in ('pending', 'recovering')]
+            db_session.add_all(records)
+            db_session.commit()
+            queued, claimed = (record.id for record in records)
+        finally:
+            db_session.close()
+        data = os.urandom(1024)
+        writer = PhotoWriter(workers=0)
+        self.assertTrue(writer.submit(queued, store, store.spool(queued, io.BytesIO(data), '.jpg'), 'image/jpeg'))
+        
+        spool_path = store.spool(claimed, io.BytesIO(data), '.jpg')
+        
+        # キュー内・回復中の打刻は回復の対象外で、保存待ちのファイルも残す
+        result = recover_pending_photos(self.photo_dir, stale_seconds=0, writer=writer)
+        self.assertEqual(result, {'recovered': 0, 'failed': 0, 'removed_spools': 0})
+        self.assertEqual(self.stored_files(), [f'{queued}.jpg', f'{claimed}.jpg'])
+        
+        # 回復中の打刻は、ワーカーが保存しても反映しない
+        self.assertFalse(writer.write(claimed, store, spool_path, 'image/jpeg'))
+        self.assertTrue(os.path.exists(spool_path))
+        self.assertEqual(self.client.get(f'/api/photo/{claimed}').status_code, 202)
+        db_session = get_db_session()
+        try:
+            self.assertEqual(db_session.get(TimeRecord, claimed).photo_status, 'recovering')
+            self.assertIsNone(db_session.get(PhotoBlob, hashlib.sha256(data).hexdigest()))
+        finally:
+            db_session.close()
+    
+    def test_queue_full_saves_synchronously(self):
+        """キューが満杯の場合はコミット後に同期で保存することのテスト"""
+        self.addCleanup(setattr, photo_writer, 'submit', photo_writer.submit)
+        photo_writer.submit = lambda *job: False
+        response = self.punch_with_photo()
+        self.assertEqual(json.loads(response.data)['photo_status'], 'ready')
+        self.assertEqual(len(self.stored_files()), 1)
+    
+    def test_bounded_queue_and_failed_write(self):
+        """上限を超えた予約の拒否と、保存失敗時の failed のテスト"""
+        attached = []
+        store = PhotoStore(self.photo_dir)
+        writer = PhotoWriter(queue_size=1, workers=0, attach=lambda *result: attached.append(result) or True)
+        self.assertTrue(writer.submit(1, store, store.spool(1, io.BytesIO(b'a'))))
+        self.assertFalse(writer.submit(2, store, store.spool(2, io.BytesIO(b'b'))))
+        self.assertEqual(writer.stats()['rejected'], 1)
+        
+        not_a_directory = os.path.join(self.photo_dir, 'file')
+        open(not_a_directory, 'wb').close()
+        self.assertFalse(writer.write(3, PhotoStore(not_a_directory), store.spool(3, io.BytesIO(b'c'))))
+        self.assertEqual(attached, [(3, None, 'failed', 0, None, 'pending')])
+        self.assertEqual(self.stored_files(), ['1', '2', 'file'])
+    
+    def test_identical_uploads_deduplicated(self):
+        """同じ内容の写真は1ファイルだけ保存し、参照数を数えることのテスト"""
+        data = os.urandom(4096)
+        self.punch_with_photo(data)
+        self.punch_with_photo(data, record_type='check_out')
+        photo_writer.join()
+        
+        digest = hashlib.sha256(data).hexdigest()
+        self.assertEqual(self.stored_files(), [digest])
+        self.assertTrue(os.path.exists(os.path.join(self.photo_dir, digest[:2], digest[2:4], digest)))
+        db_session = get_db_session()
+        try:
+            blob = db_session.get(PhotoBlob, digest)
+            self.assertEqual((blob.refcount, blob.size, blob.content_type), (2, 4096, 'image/jpeg'))
+        finally:
+            db_session.close()
+    
+    def camera_jpeg(self, width=1600, height=1200):
+        """縮小版のテスト用の JPEG"""
+        image = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=90)
+        return output.getvalue()
+    
+    def test_derivatives_created_at_ingest(self):
+        """保存時に縮小版が作られ、?size= で WebP を返すことのテスト"""
+        data = self.camera_jpeg()
+        record_id = json.loads(self.punch_with_photo(data).data)['record_id']
+        photo_writer.join()
+        digest = hashlib.sha256(data).hexdigest()
+        self.assertEqual(self.stored_files(), [digest, f'{digest}.display.webp', f'{digest}.thumb.webp'])
+        
+        for size, max_px in (('thumb', 240), ('display', 1280)):
+            response = self.client.get(f'/api/photo/{record_id}?size={size}')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'image/webp')
+            with Image.open(io.BytesIO(response.data)) as image:
+                self.assertEqual(max(image.size), max_px)
+            self.assertLess(len(response.data), len(data))
+        self.assertEqual(self.client.get(f'/api/photo/{record_id}').data, data)
+        self.assertEqual(self.client.get(f'/api/photo/{record_id}?size=huge').status_code, 400)
+    
+    def test_derivatives_created_lazily(self):
+        """同期保存した写真は初回の要求時に縮小版を作り、画像でなければ元の写真を返すことのテスト"""
+        self.addCleanup(setattr, photo_writer, 'submit', photo_writer.submit)
+        photo_writer.submit = lambda *job: False
+        data = self.camera_jpeg()
+        record_id = json.loads(self.punch_with_photo(data).data)['record_id']
+        digest = hashlib.sha256(data).hexdigest()
+        self.assertEqual(self.stored_files(), [digest])
+        
+        response = self.client.get(f'/api/photo/{record_id}?size=thumb')
+        self.assertEqual(response.mimetype, 'image/webp')
+        self.assertEqual(self.stored_files(), [digest, f'{digest}.thumb.webp'])
+        
+        not_an_image = json.loads(self.punch_with_photo(b'not an image', record_type='check_out').data)['record_id']
+        response = self.client.get(f'/api/photo/{not_an_image}?size=thumb')
+        self.assertEqual((response.status_code, response.data), (200, b'not an image'))
+    
+    def test_photo_cache_headers(self):
+        """digest の ETag と immutable で返し、再検証は DB・ファイルに触れず 304 となることのテスト"""
+        data = os.urandom(64 * 1024)
+        record_id = json.loads(self.punch_with_photo(data).data)['record_id']
+        photo_writer.join()
+        digest = hashlib.sha256(data).hexdigest()
+        
+        response = self.client.get(f'/api/photo/{record_id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_etag(), (digest, False))
+        self.assertTrue(response.cache_control.immutable)
+        self.assertTrue(response.cache_control.private)
+        self.assertEqual(response.cache_control.max_age, 365 * 24 * 3600)
+        thumb = self.client.get(f'/api/photo/{record_id}?size=thumb')
+        self.assertEqual(thumb.get_etag(), (digest, False))  # 画像でない写真は元の写真
+        
+        shutil.rmtree(self.photo_dir)
+        with capture_queries() as stats:
+            response = self.client.get(f'/api/photo/{record_id}', headers={'If-None-Match': f'"{digest}"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_etag(), (digest, False))
+        self.assertEqual(stats.count, 0)
+        self.assertEqual(self.client.get(f'/api/photo/{record_id}').status_code, 404)
+    
+    def test_photo_range_request(self):
+        """Range 指定で部分レスポンス（206）を返すことのテスト"""
+        data = os.urandom(64 * 1024)
+        record_id = json.loads(self.punch_with_photo(data).data)['record_id']
+        photo_writer.join()
+        
+        response = self.client.get(f'/api/photo/{record_id}', headers={'Range': 'bytes=100-199'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, data[100:200])
+        self.assertEqual(response.headers['Content-Range'], f'bytes 100-199/{len(data)}')
+    
+    def test_photo_send_modes(self):
+        """x-accel / x-sendfile ではパスのヘッダーだけを返すことのテスト"""
+        self.addCleanup(self.app.config.__setitem__, 'PHOTO_SEND_MODE', self.app.config['PHOTO_SEND_MODE'])
+        data = self.camera_jpeg()
+        record_id = json.loads(self.punch_with_photo(data).data)['record_id']
+        photo_writer.join()
+        digest = hashlib.sha256(data).hexdigest()
+        
+        self.app.config['PHOTO_SEND_MODE'] = 'x-accel'
+        response = self.client.get(f'/api/photo/{record_id}?size=thumb')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.mimetype, 'image/webp')
+        self.assertEqual(response.headers['X-Accel-Redirect'], f'/protected-photos/{digest[:2]}/{digest[2:4]}/{digest}.thumb.webp')
+        self.assertEqual(response.get_etag(), (f'{digest}.thumb', False))
+        
+        self.app.config['PHOTO_SEND_MODE'] = 'x-sendfile'
+        response = self.client.get(f'/api/photo/{record_id}')
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.mimetype, 'image/jpeg')
+        self.assertEqual(response.headers['X-Sendfile'], os.path.abspath(PhotoStore(self.photo_dir).path(digest)))
+    
+    def test_archive_photos(self):
+        """保存期間を過ぎた写真が月別のパックに移り、パックから配信されることのテスト"""
+        image, other = self.camera_jpeg(), b'old photo'
+        recent = os.urandom(1024)
+        record_ids = [json.loads(self.punch_with_photo(data, record_type).data)['record_id']
+                      for data, record_type in [(image, 'check_in'), (other, 'check_out'), (recent, 'check_in')]]
+        photo_writer.join()
+        old_date = datetime.now(JST).date() - timedelta(days=120)
+        db_session = get_db_session()
+        try:
+            db_session.query(TimeRecord).filter(TimeRecord.id.in_(record_ids[:2])).update(
+                {'work_date': old_date}, synchronize_session=False)
+            db_session.commit()
+        finally:
+            db_session.close()
+        image_digest, other_digest, recent_digest = (hashlib.sha256(data).hexdigest() for data in (image, other, recent))
+        
+        result = archive_photos(engine, self.photo_dir, 90)
+        self.assertEqual((result['archived'], result['missing'], result['files_removed']), (2, 0, 4))
+        self.assertEqual(self.stored_files(), sorted([recent_digest, '.lock', f"{old_date.strftime('%Y-%m')}.pack"]))
+        db_session = get_db_session()
+        try:
+            variants = sorted((entry.digest, entry.variant) for entry in db_session.query(PhotoPackEntry))
+        finally:
+            db_session.close()
+        self.assertEqual(variants, sorted([(image_digest, 'original'), (image_digest, 'display'),
+                                           (image_digest, 'thumb'), (other_digest, 'original')]))
+        
+        photo = self.client.get(f'/api/photo/{record_ids[0]}')
+        self.assertEqual((photo.status_code, photo.mimetype, photo.data), (200, 'image/jpeg', image))
+        self.assertEqual(photo.get_etag(), (image_digest, False))
+        self.assertTrue(photo.cache_control.immutable)
+        thumb = self.client.get(f'/api/photo/{record_ids[0]}?size=thumb')
+        self.assertEqual((thumb.status_code, thumb.mimetype), (200, 'image/webp'))
+        self.assertEqual(thumb.get_etag(), (f'{image_digest}.thumb', False))
+        part = self.client.get(f'/api/photo/{record_ids[1]}?size=thumb', headers={'Range': 'bytes=4-8'})
+        self.assertEqual((part.status_code, part.data), (206, b'photo'))
+        self.assertEqual(self.client.get(f'/api/photo/{record_ids[2]}').data, recent)
+        
+        self.assertEqual(archive_photos(engine, self.photo_dir, 90)['archived'], 0)
+        
+        # 追記の途中で止まった空のパックは 404
+        photo_packs.clear()
+        open(os.path.join(self.photo_dir, 'packs', f"{old_date.strftime('%Y-%m')}.pack"), 'wb').close()
+        self.assertEqual(self.client.get(f'/api/photo/{record_ids[0]}').status_code, 404)
+    
+    def test_migrate_flat_photos(self):
+        """平置きの写真がストアに移動され、記録が digest に書き換わることのテスト"""
+        contents = [b'photo-1', b'photo-2', b'photo-1']
+        db_session = get_db_session()
+        try:
+            records = []
+            for i, content in enumerate(contents):
+                path = os.path.join(self.photo_dir, f'TEST001_2024010{i}_090000_camera.jpg')
+                with open(path, 'wb') as f:
+                    f.write(content)
+                records.append(TimeRecord(employee_id='TEST001', timestamp=datetime.now(JST), record_type='check_in',
+                                          photo_path=path, photo_status='ready'))
+            records.append(TimeRecord(employee_id='TEST001', timestamp=datetime.now(JST), record_type='check_in',
+                                      photo_path=os.path.join(self.photo_dir, 'missing.jpg'), photo_status='ready'))
+            db_session.add_all(records)
+            db_session.commit()
+            record_ids = [record.id for record in records]
+        finally:
+            db_session.close()
+        
+        result = migrate_flat_photos(engine, self.photo_dir, batch_size=2)
+        self.assertEqual(result, {'migrated': 2, 'deduplicated': 1, 'missing': 1, 'removed_leftovers': 0})
+        digests = sorted({hashlib.sha256(content).hexdigest() for content in contents})
+        self.assertEqual(self.stored_files(), digests)
+        self.assertEqual(sorted(os.listdir(self.photo_dir)), sorted({digest[:2] for digest in digests}))
+        
+        photo = self.client.get(f'/api/photo/{record_ids[2]}')
+        self.assertEqual((photo.data, photo.mimetype), (b'photo-1', 'image/jpeg'))
+        db_session = get_db_session()
+        try:
+            self.assertEqual(db_session.get(PhotoBlob, hashlib.sha256(b'photo-1').hexdigest()).refcount, 2)
+        finally:
+            db_session.close()
+        self.assertEqual(migrate_flat_photos(engine, self.photo_dir)['migrated'], 0)
+
+
+class HealthCheckTests(TimeCardTestCase):
+    """ヘルスチェックのテスト"""
+    
+    def setUp(self):
+        super().setUp()
+        self.app.extensions['health_check'].clear()
+    
+    def test_liveness_skips_database(self):
+        """稼働確認はSQLを発行しないことのテスト"""
+        with capture_queries() as stats:
+            response = self.client.get('/api/health')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['status'], 'healthy')
+        self.assertEqual(stats.count, 0)
+    
+    def test_readiness_details_for_admin_only(self):
+        """詳細は管理者のみに返し、一般には各チェックの状態だけを返すことのテスト"""
+        response = self.client.get('/api/health/ready')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(set(data['checks']), {'database', 'disk', 'notion_sync', 'queues'})
+        self.assertTrue(all(isinstance(status, str) for status in data['checks'].values()))
+        
+        self.admin_login()
+        checks = json.loads(self.client.get('/api/health/ready').data)['checks']
+        self.assertEqual(checks['database']['status'], 'ok')
+        self.assertGreaterEqual(checks['database']['latency_ms'], 0)
+        self.assertIn('wal_bytes', checks['database'])
+        self.assertIn('checked_out', checks['database']['pool'])
+        self.assertEqual(set(checks['disk']['paths']), {'photos', 'data'})
+        self.assertIn('queued', checks['queues']['exports'])
+        self.assertIn('capacity', checks['queues']['logging']['security'])
+        self.assertIn('capacity', checks['queues']['photos'])
+    
+    def test_results_cached(self):
+        """キャッシュ期間内はチェックを再実行しないことのテスト"""
+        now = [0.0]
+        health_check = HealthCheck({'probe': lambda: {'status': 'ok'}}, cache_seconds=5, clock=lambda: now[0])
+        first = health_check.report()
+        now[0] = 4.9
+        self.assertIs(health_check.report(), first)
+        self.assertEqual(health_check.runs, 1)
+        now[0] = 5.0
+        health_check.report()
+        self.assertEqual(health_check.runs, 2)
+    
+    def test_failures_reported(self):
+        """DB接続・ディスク容量の失敗が fail となり、例外も fail に変換されることのテスト"""
+        broken = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'missing', 'x.db')}")
+        self.assertEqual(check_database(broken)['status'], 'fail')
+        self.assertEqual(check_disk({'data': 'data'}, min_free_mb=10 ** 12)['status'], 'fail')
+        
+        def explode():
+            raise RuntimeError('boom')
+        report = HealthCheck({'ok': lambda: {'status': 'ok'}, 'broken': explode}).report()
+        self.assertEqual(report['status'], 'fail')
+        self.assertIn('boom', report['checks']['broken']['error'])
+    
+    def test_notion_sync_age(self):
+        """最後の同期からの経過時間と失敗が報告されることのテスト"""
+        sync_status = NotionSyncStatus()
+        self.assertIsNone(check_notion_sync(sync_status)['last_sync_age_seconds'])
+        sync_status.record(tag_count=3)
+        result = check_notion_sync(sync_status)
+        self.assertEqual((result['status'], result['tags']), ('ok', 3))
+        self.assertGreaterEqual(result['last_sync_age_seconds'], 0)
+        sync_status.record(error='timeout')
+        result = check_notion_sync(sync_status)
+        self.assertEqual((result['status'], result['last_error']), ('warn', 'timeout'))
+        self.assertIsNotNone(result['last_sync_age_seconds'])
+
+
+class ProfilingTests(TimeCardTestCase):
+    """リクエストプロファイリングのテスト"""
+    
+    def setUp(self):
+        super().setUp()
+        self.profile_dir = tempfile.mkdtemp(prefix='timecard_profiles_')
+        self.addCleanup(shutil.rmtree, self.profile_dir, ignore_errors=True)
+        self.app.config['PROFILE_DIR'] = self.profile_dir
+        self.app.config['PROFILE_SAMPLE_RATE'] = 0
+    
+    def test_admin_header_profiles_request(self):
+        """管理者の X-Profile ヘッダーでプロファイルが保存・一覧・ダウンロードできることのテスト"""
+        self.admin_login()
+        response = self.client.get('/api/employees', headers={'X-Profile': '1'})
+        self.assertEqual(response.status_code, 200)
+        name = response.headers['X-Profile-Id']
+        self.assertIn('_get_employees_', name)
+        
+        profiles = json.loads(self.client.get('/api/profiles').data)
+        self.assertEqual([profile['name'] for profile in profiles], [name])
+        self.assertEqual(profiles[0]['endpoint'], 'get_employees')
+        
+        stats = pstats.Stats(os.path.join(self.profile_dir, name + '.prof'))
+        self.assertTrue(any(func[2] == 'get_employees' for func in stats.stats))
+        
+        collapsed = self.client.get(f'/api/profiles/{name}.collapsed')
+        self.assertEqual(collapsed.status_code, 200)
+        self.assertIn('attachment', collapsed.headers['Content-Disposition'])
+        lines = collapsed.get_data(as_text=True).splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(all(re.match(r'^.+ \d+$', line) for line in lines))
+        self.assertEqual(self.client.get('/api/profiles/..%2Fsecurity.log').status_code, 404)
+    
+    def test_header_ignored_for_non_admin(self):
+        """一般ユーザーのヘッダー指定ではプロファイルしないことのテスト"""
+        self.login()
+        response = self.client.get('/api/tags', headers={'X-Profile': '1'})
+        self.assertNotIn('X-Profile-Id', response.headers)
+        self.assertEqual(os.listdir(self.profile_dir), [])
+        self.assertEqual(self.client.get('/api/profiles').status_code, 403)
+    
+    def test_sampling_and_streamed_response(self):
+        """サンプリングで保存され、ストリーミング応答は送信完了後に保存されることのテスト"""
+        self.admin_login()
+        self.app.config['PROFILE_SAMPLE_RATE'] = 1.0
+        try:
+            response = self.client.get('/api/export-csv')
+            self.assertTrue(response.is_streamed)
+            response.get_data()
+            response.close()
+        finally:
+            self.app.config['PROFILE_SAMPLE_RATE'] = 0
+        
+        self.assertNotIn('X-Profile-Id', response.headers)
+        names = [profile['name'] for profile in json.loads(self.client.get('/api/profiles').data)]
+        self.assertEqual(len(names), 1)
+        stats = pstats.Stats(os.path.join(self.profile_dir, names[0] + '.prof'))
+        self.assertTrue(any(func[2] == '_iter_csv' for func in stats.stats))
+    
+    def test_concurrent_profile_skipped(self):
+        """他のリクエストを計測中は計測せずに応答することのテスト"""
+        self.admin_login()
+        self.assertTrue(profiling._profile_lock.acquire(blocking=False))
+        try:
+            response = self.client.get('/api/employees', headers={'X-Profile': '1'})
+        finally:
+            profiling._profile_lock.release()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Profile-Skipped'], 'busy')
+        self.assertNotIn('X-Profile-Id', response.headers)
+        self.assertEqual(os.listdir(self.profile_dir), [])
+        
+        response = self.client.get('/api/employees', headers={'X-Profile': '1'})
+        self.assertIn('X-Profile-Id', response.headers)
+        self.assertFalse(profiling._profile_lock.locked())
+    
+    def test_collapsed_stacks(self):
+        """呼び出し経路ごとの collapsed stack が生成されることのテスト"""
+        def inner():
+            return sum(i * i for i in range(20000))
+        
+        def outer():
+            return inner() + inner()
+        
+        profiler = cProfile.Profile()
+        profiler.runcall(outer)
+        lines = collapsed_stacks(pstats.Stats(profiler))
+        self.assertTrue(any(re.search(r'^outer \(.*\);inner \(.*\);.*<genexpr> \(.*\) \d+$', line) for line in lines),
+                        lines)
+
+
+class ResponseCacheTests(TimeCardTestCase):
+    """レスポンスキャッシュのテスト"""
+    
+    def test_lru_eviction(self):
+        """件数上限で最も古く参照されたエントリが追い出されることのテスト"""
+        cache = ResponseCache(max_entries=2)
+        cache.set('a', 1, 60)
+        cache.set('b', 2, 60)
+        cache.get('a')
+        cache.set('c', 3, 60)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+    
+    def test_byte_limit_and_ttl(self):
+        """バイト数上限と有効期限のテスト"""
+        cache = ResponseCache(max_bytes=10)
+        cache.set('big', b'x' * 11, 60, size=11)
+        self.assertIsNone(cache.get('big'))
+        cache.set('a', b'x' * 6, 60, size=6)
+        cache.set('b', b'x' * 6, 60, size=6)
+        self.assertIsNone(cache.get('a'))
+        self.assertLessEqual(cache.stats()['bytes'], 10)
+        
+        cache.set('expired', 1, 0)
+        self.assertIsNone(cache.get('expired'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+    
+    def test_tag_invalidation(self):
+        """タグ単位の破棄のテスト"""
+        cache = ResponseCache()
+        cache.set('employees:1', 1, 60, tags=('employees',))
+        cache.set('summary:1', 2, 60, tags=('attendance', 'employees'))
+        cache.set('tags:1', 3, 60, tags=('tags',))
+        self.assertEqual(cache.invalidate('employees'), 2)
+        self.assertIsNone(cache.get('summary:1'))
+        self.assertEqual(cache.get('tags:1'), 3)
+    
+    def test_endpoint_cached_until_write(self):
+        """書き込みまでキャッシュが返り、書き込み後に更新されることのテスト"""
+        self.admin_login()
+        before = response_cache.stats()
+        first = self.client.get('/api/employees')
+        second = self.client.get('/api/employees')
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(first.data, second.data)
+        
+        self.client.post('/api/employees',
+                         data=json.dumps({'employee_id': 'TEST002', 'name': '追加ユーザー'}),
+                         content_type='application/json')
+        third = self.client.get('/api/employees')
+        self.assertEqual(third.headers['X-Cache'], 'MISS')
+        self.assertIn('TEST002', [e['employee_id'] for e in json.loads(third.data)])
+        
+        stats = json.loads(self.client.get('/api/cache/stats').data)
+        self.assertEqual(stats['hits'] - before['hits'], 1)
+        self.assertEqual(stats['invalidations'] - before['invalidations'], 1)
+    
+    def test_cache_key_includes_principal(self):
+        """利用者ごとにキャッシュが分かれることのテスト"""
+        self.admin_login()
+        self.client.get('/api/tags')
+        self.client.post('/api/logout')
+        
+        self.login()
+        response = self.client.get('/api/tags')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+    
+    def test_record_time_invalidates_summary(self):
+        """打刻で出勤サマリーのキャッシュが破棄されることのテスト"""
+        self.admin_login()
+        self.client.get('/api/admin/attendance/summary')
+        self.client.post('/api/time-record', data={'employee_id': 'TEST001', 'type': 'check_in'})
+        
+        response = self.client.get('/api/admin/attendance/summary')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        summary = {row['employeeId']: row for row in json.loads(response.data)['summary']}
+        self.assertTrue(summary['TEST001']['isPresent'])
+
+    def test_daily_report_invalidates_reports(self):
+        """日報の作成・更新で日報一覧のキャッシュが破棄されることのテスト"""
+        self.login()
+        first = self.client.get('/api/daily-reports')
+        self.assertEqual(json.loads(first.data), [])
+        self.assertEqual(self.client.get('/api/daily-reports').headers['X-Cache'], 'HIT')
+        
+        for content in ('配線作業', '配線作業と点検'):
+            response = self.client.post('/api/daily-report', data=json.dumps({
+                'report_date': '2024-04-01', 'work_content': content
+            }), content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+            
+            response = self.client.get('/api/daily-reports')
+            self.assertEqual(response.headers['X-Cache'], 'MISS')
+            self.assertEqual([report['work_content'] for report in json.loads(response.data)], [content])
+
+class RequestMetricsTests(TimeCardTestCase):
+    """リクエストメトリクスのテスト"""
+    
+    def test_quantile_estimate(self):
+        """バケットからの分位点推定のテスト"""
+        metrics = RequestMetrics()
+        for duration in [0.002] * 90 + [0.2] * 9 + [20.0]:
+            metrics.start('e')
+            metrics.finish('e', 'GET', 200, duration, 100)
+        
+        summary = metrics.summary()['e']
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['in_flight'], 0)
+        self.assertTrue(0.001 < summary['p50'] <= 0.0025)
+        self.assertTrue(0.1 < summary['p95'] <= 0.25)
+        self.assertEqual(summary['p99'], 0.25)
+        self.assertIsNone(estimate_quantile(0.5, DURATION_BUCKETS, [0] * (len(DURATION_BUCKETS) + 1)))
+    
+    def test_prometheus_format(self):
+        """Prometheus のテキスト形式で累積バケットと合計が出力されることのテスト"""
+        metrics = RequestMetrics()
+        metrics.start('get_employees')
+        metrics.finish('get_employees', 'GET', 200, 0.003, 2000)
+        metrics.start('get_employees')
+        metrics.finish('get_employees', 'GET', 500, 0.3)
+        metrics.start('get_employees')
+        
+        lines = metrics.render_prometheus().splitlines()
+        self.assertIn('timecard_http_requests_total{endpoint="get_employees",method="GET",status="200"} 1', lines)
+        self.assertIn('timecard_http_requests_total{endpoint="get_employees",method="GET",status="500"} 1', lines)
+        self.assertIn('timecard_http_request_duration_seconds_bucket{endpoint="get_employees",le="0.005"} 1', lines)
+        self.assertIn('timecard_http_request_duration_seconds_bucket{endpoint="get_employees",le="+Inf"} 2', lines)
+        self.assertIn('timecard_http_request_duration_seconds_count{endpoint="get_employees"} 2', lines)
+        self.assertIn('timecard_http_response_size_bytes_count{endpoint="get_employees"} 1', lines)
+        self.assertIn('timecard_http_response_size_bytes_sum{endpoint="get_employees"} 2000', lines)
+        self.assertIn('timecard_http_requests_in_flight{endpoint="get_employees"} 1', lines)
+    
+    def test_requests_recorded_app_wide(self):
+        """全エンドポイントのリクエストが記録され、/api/metrics は管理者のみ取得できることのテスト"""
+        request_metrics.clear()
+        self.login()
+        self.assertEqual(self.client.get('/api/metrics').status_code, 403)
+        self.client.get('/api/no-such-endpoint')
+        
+        self.client.post('/api/logout')
+        self.admin_login()
+        response = self.client.get('/api/employees')
+        
+        summary = request_metrics.summary()
+        self.assertEqual(summary['login']['count'], 2)
+        self.assertEqual(summary['unmatched']['count'], 1)
+        self.assertEqual(summary['get_employees']['in_flight'], 0)
+        
+        metrics_response = self.client.get('/api/metrics')
+        self.assertEqual(metrics_response.status_code, 200)
+        self.assertTrue(metrics_response.content_type.startswith('text/plain; version=0.0.4'))
+        body = metrics_response.get_data(as_text=True)
+        self.assertIn('timecard_http_requests_total{endpoint="get_metrics",method="GET",status="403"} 1', body)
+        self.assertIn(
+            f'timecard_http_response_size_bytes_sum{{endpoint="get_employees"}} {len(response.data)}', body
+        )
+        self.assertIn('timecard_http_requests_in_flight{endpoint="get_metrics"} 1', body)
+
+
+def _shared_rate_limit_worker(path, attempts, limit):
+    """別プロセスから共有のレート制限を叩き、許可された件数を返す"""
+    manager = SecurityManager(SqliteStateBackend(path))
+    return sum(manager.check_rate_limit('203.0.113.7', limit, 1) for _ in range(attempts))
+
+
+def _shared_failed_login_worker(path, attempts):
+    """別プロセスからログイン失敗を記録"""
+    manager = SecurityManager(SqliteStateBackend(path))
+    for _ in range(attempts):
+        manager.failed_attempts.add('testuser:203.0.113.7', 15 * 60)
+    manager.blocked_ips.add(f'198.51.100.{os.getpid() % 256}')
+
+
+class SharedSecurityStateTests(unittest.TestCase):
+    """複数ワーカープロセスで共有するセキュリティ状態のテスト"""
+    
+    WORKERS = 4
+    
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(prefix='timecard_security_'), 'state.db')
+        self.pool = multiprocessing.get_context('fork').Pool(self.WORKERS)
+    
+    def tearDown(self):
+        self.pool.close()
+        self.pool.join()
+    
+    def test_rate_limit_holds_across_processes(self):
+        """プロセス数に関わらずレート制限の上限が守られることのテスト"""
+        allowed = self.pool.starmap(_shared_rate_limit_worker, [(self.path, 20, 20)] * self.WORKERS)
+        self.assertEqual(sum(allowed), 20)
+    
+    def test_failed_logins_converge_across_processes(self):
+        """ログイン失敗とブロックIPが全プロセスで共有されることのテスト"""
+        self.pool.starmap(_shared_failed_login_worker, [(self.path, 3)] * self.WORKERS)
+        
+        manager = SecurityManager(SqliteStateBackend(self.path))
+        self.assertEqual(manager.failed_attempts.count('testuser:203.0.113.7', 15 * 60), 12)
+        self.assertFalse(manager.check_failed_login_attempts('testuser:203.0.113.7'))
+        self.assertGreaterEqual(len(manager.blocked_ips), 1)
+        self.assertIn(next(iter(manager.blocked_ips)), manager.blocked_ips)
+    
+    def test_sweep_bounds_tracked_keys(self):
+        """共有カウンタの識別子数の上限とアクセスの途絶えた識別子の破棄のテスト"""
+        now = [1000.0]
+        counter = SqliteStateBackend(self.path).counter('rate_limits')
+        counter.clock = lambda: now[0]
+        counter.max_keys = 10
+        for i in range(30):
+            counter.hit(f'10.0.0.{i}', 5, 60)
+        self.assertEqual(counter.sweep(), 20)
+        self.assertEqual(len(counter), 10)
+        
+        now[0] += 120
+        counter.sweep()
+        self.assertEqual(len(counter), 0)
+    
+    def test_backend_selection(self):
+        """保持先の切り替えのテスト"""
+        self.assertEqual(create_state_backend('memory').name, 'memory')
+        self.assertEqual(create_state_backend('sqlite', self.path).name, 'sqlite')
+        with self.assertRaises(ValueError):
+            create_state_backend('redis')
+
+class MaliciousContentScanTests(unittest.TestCase):
+    """悪意のあるコンテンツ検出・サニタイズの等価性（ファズ）と最悪時間のテスト"""
+    
+    FRAGMENTS = [
+        '<script', '<SCRIPT x>', '>', '</script>', 'update', 'UPDATE ', 'set', ' SET', '\nset',
+        ' ', '  ', '\n', '\t', ' \n ', '\u3000', '\x0b', 'on', 'onclick', 'button', '=', ' =',
+        'union', 'select', 'drop', 'table', 'insert', 'into', 'delete', 'from', 'exec', 'eval',
+        'system', '(', '../', '.', '/', '%2e%2e%2f', '%252e%252e%252f', 'javascript', ':',
+        '&', '"', "'", '\x00', '\x7f', 'x', '作業', 'İ', '_', '1'
+    ]
+    
+    def test_scanner_matches_legacy_patterns(self):
+        """従来の正規表現と判定が一致することのテスト"""
+        rng = random.Random(20240401)
+        for _ in range(20000):
+            text = ''.join(rng.choice(self.FRAGMENTS) for _ in range(rng.randint(0, 12)))
+            self.assertEqual(
+                security_manager.contains_malicious_content(text),
+                legacy_security.contains_malicious_content(text),
+                repr(text)
+            )
+    
+    def test_sanitize_matches_legacy(self):
+        """サニタイズ結果が従来と一致することのテスト"""
+        rng = random.Random(20240402)
+        for _ in range(5000):
+            text = ''.join(rng.choice(self.FRAGMENTS) for _ in range(rng.randint(0, 30)))
+            max_length = rng.randint(1, 60)
+            self.assertEqual(
+                security_manager.sanitize_string(text, max_length),
+                legacy_security.sanitize_string(text, max_length),
+                repr(text)
+            )
+    
+    def test_large_inputs_scan_in_linear_time(self):
+        """100KBの入力（後戻りが膨らむ入力を含む）が validate_input を短時間で通ることのテスト"""
+        rules = {'work_content': {'type': str, 'max_length': 200 * 1024}}
+        for name, text in legacy_security.content_scan_inputs(100 * 1024).items():
+            started = time.perf_counter()
+            errors = security_manager.validate_input({'work_content': text}, rules)
+            sanitized = security_manager.sanitize_string(text, max_length=len(text) * 6)
+            elapsed = time.perf_counter() - started
+            self.assertLess(elapsed, 0.5, name)
+            self.assertEqual(errors, [], name)
+            self.assertEqual(sanitized, legacy_security.sanitize_string(text, max_length=len(text) * 6))
+    
+    def test_large_malicious_inputs_detected(self):
+        """長い本文の末尾に埋め込まれた攻撃文字列を検出することのテスト"""
+        padding = '本日の作業内容です。' * 10000
+        for payload in ['<script>alert(1)</script>', 'UPDATE users\n  SET is_admin=1',
+                        '<img src=x onerror = alert(1)>', '../../etc/passwd']:
+            self.assertTrue(security_manager.contains_malicious_content(padding + payload), payload)
+
+class LogPipelineTests(unittest.TestCase):
+    """キュー経由ログ出力のテスト"""
+    
+    def make_handler(self, maxsize=0, window_seconds=10):
+        self.now = 0.0
+        log_queue = queue.Queue(maxsize=maxsize)
+        handler = CoalescingQueueHandler(log_queue, window_seconds=window_seconds, clock=lambda: self.now)
+        logger = logging.getLogger(f'test.log_pipeline.{id(handler)}')
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        return handler, logger, log_queue
+    
+    def drain(self, log_queue):
+        records = []
+        while not log_queue.empty():
+            records.append(log_queue.get_nowait())
+        return records
+    
+    def test_identical_events_coalesced(self):
+        """同一イベントが窓の間1件にまとめられ、抑止件数が後で出力されることのテスト"""
+        handler, logger, log_queue = self.make_handler()
+        key = ('FAILED_LOGIN_ATTEMPT', 'WARNING', '10.0.0.1', 'Anonymous', 'Identifier: x')
+        for _ in range(100):
+            logger.warning('Security Event: %s', 'FAILED_LOGIN_ATTEMPT', extra={'coalesce_key': key})
+        logger.warning('Security Event: %s', 'OTHER', extra={'coalesce_key': ('OTHER',)})
+        
+        records = self.drain(log_queue)
+        self.assertEqual([r.getMessage() for r in records],
+                         ['Security Event: FAILED_LOGIN_ATTEMPT', 'Security Event: OTHER'])
+        self.assertEqual(handler.stats()['coalesced'], 99)
+        
+        # 窓の終了後の最初のイベントで抑止件数の集約レコードが出る
+        self.now = 11.0
+        logger.warning('Security Event: %s', 'FAILED_LOGIN_ATTEMPT', extra={'coalesce_key': key})
+        records = self.drain(log_queue)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0].suppressed, 99)
+        self.assertEqual(records[1].getMessage(), 'Security Event: FAILED_LOGIN_ATTEMPT')
+        
+        # 終了時には集約中の抑止件数も出力される
+        logger.warning('Security Event: %s', 'FAILED_LOGIN_ATTEMPT', extra={'coalesce_key': key})
+        handler.flush_all()
+        self.assertEqual([r.suppressed for r in self.drain(log_queue)], [1])
+    
+    def test_pipeline_reports_last_burst(self):
+        """後続のレコードが無くても抑止件数がタイマーと停止時に出力されることのテスト"""
+        records = []
+        collector = logging.Handler()
+        collector.emit = records.append
+        key = ('FAILED_LOGIN_ATTEMPT', 'WARNING', '10.0.0.1', 'Anonymous', 'Identifier: x')
+        
+        for window_seconds, expected in ((0.2, 'timer'), (60, 'stop')):
+            del records[:]
+            logger = logging.getLogger(f'test.log_pipeline.{expected}')
+            logger.propagate = False
+            pipeline = LogPipeline(logger, [collector], window_seconds=window_seconds)
+            pipeline.start()
+            for _ in range(5):
+                logger.warning('Security Event: %s', 'FAILED_LOGIN_ATTEMPT', extra={'coalesce_key': key})
+            if expected == 'timer':
+                deadline = time.time() + 5
+                while len(records) < 2 and time.time() < deadline:
+                    time.sleep(0.05)
+                self.assertEqual(pipeline.stats()['coalescing_keys'], 0)
+            pipeline.stop()
+            self.assertEqual([getattr(r, 'suppressed', None) for r in records], [None, 4], expected)
+    
+    def test_full_queue_drops_are_reported(self):
+        """キュー満杯時は破棄して件数を数え、空きができたら破棄件数を出力することのテスト"""
+        handler, logger, log_queue = self.make_handler(maxsize=2)
+        for i in range(5):
+            logger.info('message %d', i)
+        self.assertEqual(handler.stats()['dropped'], 3)
+        self.assertEqual(len(self.drain(log_queue)), 2)
+        
+        logger.info('after drain')
+        records = self.drain(log_queue)
+        self.assertEqual(records[0].dropped, 3)
+        self.assertEqual(records[1].getMessage(), 'after drain')
+    
+    def test_json_formatter(self):
+        """JSON形式で extra の項目と例外が出力されることのテスト"""
+        handler, logger, log_queue = self.make_handler()
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.exception('failed %s', 'here', extra={'client_ip': '10.0.0.1', 'coalesce_key': ('k',)})
+        
+        entry = json.loads(JsonFormatter().format(self.drain(log_queue)[0]))
+        self.assertEqual(entry['message'], 'failed here')
+        self.assertEqual(entry['level'], 'ERROR')
+        self.assertEqual(entry['client_ip'], '10.0.0.1')
+        self.assertIn('ValueError: boom', entry['exc_info'])
+        self.assertNotIn('coalesce_key', entry)
+    
+    def test_security_event_outside_request(self):
+        """リクエスト外からでもセキュリティイベントを記録できることのテスト"""
+        entry = security_manager.log_security_event('TEST_EVENT', 'details')
+        self.assertEqual(entry['event_type'], 'TEST_EVENT')
+        self.assertIsNone(entry['client_ip'])
+
+
 class PerformanceTests(TimeCardTestCase):
     """パフォーマンステスト"""
     
@@ -398,7 +2124,26 @@ def run_all_tests():
         TimeRecordTests,
         SecurityTests,
         APITests,
+        PaginationTests,
+        ExportTests,
+        ExportJobTests,
         DataValidationTests,
+        DatabaseProfileTests,
+        HealthCheckTests,
+        PhotoIngestionTests,
+        MigrationTests,
+        WorkDateTests,
+        DailyAttendanceTests,
+        QueryPlanTests,
+        StatementCountTests,
+        SlowQueryLogTests,
+        ServerTimingTests,
+        ProfilingTests,
+        ResponseCacheTests,
+        RequestMetricsTests,
+        SharedSecurityStateTests,
+        MaliciousContentScanTests,
+        LogPipelineTests,
         PerformanceTests
     ]
     
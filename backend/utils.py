@@ -11,12 +11,12 @@ def allowed_file(filename):
 
 
 def generate_csv(records):
-    """打刻記録からCSVデータを生成"""
+    """打刻記録からCSVデータを生成（serializers.time_record_rows の行を受け取る）"""
     lines = ['従業員ID,従業員名,日付,時刻,種別,写真\n']
     
     for record in records:
         line = f"{record.employee_id},"
-        line += f"{record.employee.name},"
+        line += f"{record.employee_name},"
         line += f"{record.timestamp.strftime('%Y-%m-%d')},"
         line += f"{record.timestamp.strftime('%H:%M:%S')},"
         line += f"{'出勤' if record.record_type == 'check_in' else '退勤'},"
@@ -1,38 +1,84 @@
 # 最適化されたユーティリティ関数
+import base64
+import json
 import logging
+import os
+import threading
 import time
+from collections import OrderedDict
 from functools import wraps
-from datetime import datetime
+from datetime import datetime, date
 import pytz
-from flask import g, request, jsonify
+from flask import g, request, jsonify, session, current_app, make_response
+from sqlalchemy import and_, or_
+
+from log_pipeline import configure_logging
+from metrics import request_metrics, UNMATCHED_ENDPOINT
 
 JST = pytz.timezone('Asia/Tokyo')
 
-# ロギング設定
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# ロギング設定（logs/app.log とコンソールへキュー経由で出力）
+configure_logging()
 logger = logging.getLogger(__name__)
 
+SLOW_ENDPOINT_SECONDS = 1.0
+
+
+def _begin_request_metrics():
+    # プロキシ（request / g）へのアクセスは1回数マイクロ秒かかるため、必要な値はここでまとめて保持
+    req = request._get_current_object()
+    endpoint = req.endpoint or UNMATCHED_ENDPOINT
+    request_metrics.start(endpoint)
+    g._metrics_start = (time.perf_counter(), endpoint, req.method)
+
+
+def _finish_request_metrics(status, size=None):
+    """開始済みのリクエストを1度だけ記録"""
+    started = g.pop('_metrics_start', None)
+    if started is None:
+        return
+    start, endpoint, method = started
+    execution_time = time.perf_counter() - start
+    request_metrics.finish(endpoint, method, status, execution_time, size)
+    
+    # 遅いエンドポイントを記録（1秒以上）
+    if execution_time > SLOW_ENDPOINT_SECONDS:
+        logger.warning("Slow endpoint: %s took %.2fs", endpoint, execution_time)
+
+
+def init_performance_monitor(app):
+    """全エンドポイントのレイテンシ・ステータス・サイズ・処理中件数を記録"""
+    app.before_request(_begin_request_metrics)
+    
+    @app.after_request
+    def record_request_metrics(response):
+        size = None if response.is_streamed else response.calculate_content_length()
+        _finish_request_metrics(response.status_code, size)
+        return response
+    
+    @app.teardown_request
+    def record_failed_request_metrics(error=None):
+        # 例外が無ければ after_request で記録済み。例外時は未記録の場合のみ500として記録
+        if error is not None:
+            _finish_request_metrics(500)
+
+
 def performance_monitor(f):
-    """パフォーマンス監視デコレータ"""
+    """パフォーマンス監視デコレータ（init_performance_monitor 未適用のアプリ向け）"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        start_time = time.time()
+        if '_metrics_start' in g:
+            return f(*args, **kwargs)
+        _begin_request_metrics()
         try:
-            result = f(*args, **kwargs)
-            execution_time = time.time() - start_time
-            
-            # 遅いクエリを記録（1秒以上）
-            if execution_time > 1.0:
-                logger.warning(f"Slow endpoint: {request.endpoint} took {execution_time:.2f}s")
-            
-            return result
+            response = current_app.make_response(f(*args, **kwargs))
         except Exception as e:
-            execution_time = time.time() - start_time
-            logger.error(f"Error in {request.endpoint} after {execution_time:.2f}s: {str(e)}")
+            logger.error("Error in %s: %s", request.endpoint, e)
+            _finish_request_metrics(500)
             raise
+        size = None if response.is_streamed else response.calculate_content_length()
+        _finish_request_metrics(response.status_code, size)
+        return response
     return decorated_function
 
 def validate_date_range(start_date_str, end_date_str, max_days=90):
@@ -79,24 +125,150 @@ def sanitize_input(value, max_length=100, allow_empty=False):
     
     return value
 
-def cache_response(timeout=300):
-    """レスポンスキャッシュデコレータ"""
+class ResponseCache:
+    """TTL付きLRUのレスポンスキャッシュ（プロセス内）
+
+    件数とボディの合計バイト数の両方で上限を設け、超えた分は最も古く参照された
+    エントリから追い出す。エントリにはタグを付け、書き込み系の処理から
+    invalidate(タグ) で関連するエントリをまとめて破棄する。
+    """
+    
+    def __init__(self, max_entries=1024, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (有効期限, タグ, 値, バイト数)
+        self._tag_index = {}  # tag -> {key, ...}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+    
+    def _remove(self, key):
+        _, tags, _, size = self._entries.pop(key)
+        self._bytes -= size
+        for tag in tags:
+            keys = self._tag_index.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tag_index[tag]
+    
+    def get(self, key):
+        """有効なエントリを返す（無ければ None）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+    
+    def set(self, key, value, ttl, tags=(), size=0):
+        """エントリを登録（上限を超えた分は古い順に追い出す）"""
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, tuple(tags), value, size)
+            self._bytes += size
+            for tag in tags:
+                self._tag_index.setdefault(tag, set()).add(key)
+            
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+    
+    def invalidate(self, *tags):
+        """タグの付いたエントリを破棄して件数を返す"""
+        with self._lock:
+            keys = set()
+            for tag in tags:
+                keys |= self._tag_index.get(tag, set())
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tag_index.clear()
+            self._bytes = 0
+    
+    def stats(self):
+        """ヒット率などの統計"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+
+response_cache = ResponseCache(
+    max_entries=int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 1024)),
+    max_bytes=int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+)
+
+
+def invalidate_cache(*tags):
+    """書き込み後に関連するキャッシュを破棄"""
+    return response_cache.invalidate(*tags)
+
+
+def cache_response(timeout=300, tags=()):
+    """レスポンスキャッシュデコレータ
+
+    キーはエンドポイント・利用者（管理者は共通）・クエリ文字列。認証デコレータの
+    内側に付けること。破棄はプロセス内のキャッシュにしか届かないため、ブラウザには
+    キャッシュさせず（private, no-cache）、複数プロセス構成では timeout が鮮度の上限になる。
+    """
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            # キャッシュキーの生成
-            cache_key = f"{request.endpoint}:{request.query_string.decode()}"
-            
-            # キャッシュからの取得を試行（実装に応じて）
-            # 実際の本格運用時にはRedisなどを使用
+            if request.method != 'GET':
+                return f(*args, **kwargs)
             
-            result = f(*args, **kwargs)
+            # キャッシュキーの生成
+            principal = 'admin' if session.get('is_admin') else f"user:{session.get('user_id')}"
+            cache_key = f"{request.endpoint}:{principal}:{request.query_string.decode()}"
             
-            # レスポンスにキャッシュヘッダーを追加
-            if hasattr(result, 'headers'):
-                result.headers['Cache-Control'] = f'public, max-age={timeout}'
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                body, status, headers = cached
+                response = current_app.response_class(body, status=status, headers=headers)
+                response.headers['X-Cache'] = 'HIT'
+                return response
             
-            return result
+            response = make_response(f(*args, **kwargs))
+            response.headers['Cache-Control'] = 'private, no-cache'
+            if response.status_code == 200 and not response.is_streamed:
+                body = response.get_data()
+                response_cache.set(
+                    cache_key,
+                    (body, response.status_code, list(response.headers.items())),
+                    timeout, tags, size=len(body)
+                )
+            response.headers['X-Cache'] = 'MISS'
+            return response
         return decorated_function
     return decorator
 
@@ -129,7 +301,7 @@ def build_error_response(message, code=400, details=None):
     return jsonify(response), code
 
 def paginate_query(query, page=1, per_page=50, max_per_page=100):
-    """クエリのページネーション"""
+    """クエリのページネーション（OFFSET方式：深いページほど遅いため一覧APIでは keyset_paginate を使用）"""
     # パラメータの検証
     page = max(1, int(page))
     per_page = min(max(1, int(per_page)), max_per_page)
@@ -153,6 +325,91 @@ def paginate_query(query, page=1, per_page=50, max_per_page=100):
         'total_returned': len(items)
     }
 
+def encode_cursor(values):
+    """キー値の組を不透明なカーソル文字列に変換"""
+    raw = json.dumps(
+        [value.isoformat() if isinstance(value, (datetime, date)) else value for value in values],
+        separators=(',', ':')
+    )
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, key_columns):
+    """カーソル文字列をキー列の型に合わせて復元"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw_values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        if not isinstance(raw_values, list) or len(raw_values) != len(key_columns):
+            raise ValueError
+        
+        values = []
+        for column, raw in zip(key_columns, raw_values):
+            python_type = column.type.python_type
+            if python_type is datetime:
+                values.append(datetime.fromisoformat(raw))
+            elif python_type is date:
+                values.append(date.fromisoformat(raw))
+            else:
+                values.append(python_type(raw))
+        return values
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError('カーソルが不正です')
+
+
+def _keyset_after(key_columns, values, descending):
+    """(c1, c2, ...) が values より後ろの行を表す条件（先頭列は範囲条件としてインデックスを利用可能）"""
+    column, value = key_columns[0], values[0]
+    strict = column < value if descending else column > value
+    if len(key_columns) == 1:
+        return strict
+    inclusive = column <= value if descending else column >= value
+    return and_(inclusive, or_(strict, _keyset_after(key_columns[1:], values[1:], descending)))
+
+
+def get_page_params(default_limit=50, max_limit=500):
+    """リクエストからカーソルと件数を取得"""
+    limit = request.args.get('limit', default_limit, type=int)
+    return request.args.get('cursor') or None, min(max(1, limit), max_limit)
+
+
+def keyset_paginate(query, key_columns, cursor=None, limit=50, descending=True, key_func=None):
+    """キーセット（カーソル）方式のページネーション
+
+    key_columns は一意になる列の組（末尾は主キー）。どのページも先頭ページと同じ
+    インデックス範囲走査で取得できる。key_func は結果行からキー値を取り出す関数で、
+    省略時は列名の属性を参照する。
+    """
+    if cursor:
+        query = query.filter(_keyset_after(key_columns, decode_cursor(cursor, key_columns), descending))
+    
+    order = [column.desc() if descending else column.asc() for column in key_columns]
+    items = query.order_by(*order).limit(limit + 1).all()
+    
+    has_more = len(items) > limit
+    if has_more:
+        items = items[:limit]
+    
+    next_cursor = None
+    if has_more:
+        last = items[-1]
+        key_values = key_func(last) if key_func else [getattr(last, column.key) for column in key_columns]
+        next_cursor = encode_cursor(key_values)
+    
+    return {
+        'items': items,
+        'limit': limit,
+        'has_more': has_more,
+        'next_cursor': next_cursor
+    }
+
+
+def set_pagination_headers(response, page):
+    """配列を返す一覧APIで次ページのカーソルをヘッダーに設定"""
+    if page['next_cursor']:
+        response.headers['X-Next-Cursor'] = page['next_cursor']
+    return response
+
+
 class DatabaseManager:
     """データベース接続の最適化管理"""
     
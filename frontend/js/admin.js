@@ -89,8 +89,7 @@ function showTab(tabName) {
 // 従業員リストの読み込み
 async function loadEmployees() {
     try {
-        const response = await fetch('/api/employees');
-        employees = await response.json();
+        employees = await fetchAllPages('/api/employees');
         
         displayEmployeeList();
         updateEmployeeSelects();
@@ -322,8 +321,7 @@ async function searchReports() {
         if (startDate) params.append('start_date', startDate);
         if (endDate) params.append('end_date', endDate);
         
-        const response = await fetch(`/api/daily-reports?${params}`);
-        const reports = await response.json();
+        const reports = await fetchAllPages(`/api/daily-reports?${params}`);
         
         displayReports(reports);
         
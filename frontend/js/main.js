@@ -73,12 +73,7 @@ async function logout() {
 // 従業員リストの読み込み
 async function loadEmployees() {
     try {
-        const response = await fetch('/api/employees');
-        if (!response.ok) {
-            throw new Error('従業員リストの取得に失敗しました');
-        }
-        
-        const employees = await response.json();
+        const employees = await fetchAllPages('/api/employees');
         const select = document.getElementById('employeeId');
         
         // 既存のオプションをクリア
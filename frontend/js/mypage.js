@@ -13,8 +13,7 @@ async function logout() {
 // ユーザー情報の読み込み
 async function loadUserInfo() {
     try {
-        const response = await fetch('/api/employees');
-        const list = await response.json();
+        const list = await fetchAllPages('/api/employees');
         const info = list.find(emp => emp.employee_id === currentUser.employee_id);
 
         document.getElementById('accountUsername').value = currentUser.username;
@@ -231,8 +230,7 @@ async function loadReportHistory() {
         if (startDate) url += `start_date=${startDate}&`;
         if (endDate) url += `end_date=${endDate}`;
         
-        const response = await fetch(url);
-        const reports = await response.json();
+        const reports = await fetchAllPages(url);
         
         displayReportHistory(reports);
         
@@ -0,0 +1,24 @@
+// カーソル方式の一覧APIを最後のページまで取得
+// 一覧APIは配列を返し、続きがある場合は X-Next-Cursor ヘッダーにカーソルを設定する
+async function fetchAllPages(url) {
+    const items = [];
+    let cursor = null;
+    
+    do {
+        let pageUrl = url;
+        if (cursor) {
+            const separator = url.includes('?') ? (/[?&]$/.test(url) ? '' : '&') : '?';
+            pageUrl = `${url}${separator}cursor=${encodeURIComponent(cursor)}`;
+        }
+        
+        const response = await fetch(pageUrl);
+        if (!response.ok) {
+            throw new Error(`一覧の取得に失敗しました (${response.status})`);
+        }
+        
+        items.push(...await response.json());
+        cursor = response.headers.get('X-Next-Cursor');
+    } while (cursor);
+    
+    return items;
+}